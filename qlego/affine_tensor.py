@@ -0,0 +1,362 @@
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from qlego.progress import CancellationToken, check_cancelled
+from qlego.pte_storage import estimate_entry_bytes
+from qlego.simple_poly import SimplePoly
+
+
+def _to_int(key: Tuple[int, ...]) -> int:
+    """Bit i of the result is key[i]."""
+    res = 0
+    for i, b in enumerate(key):
+        if b:
+            res |= 1 << i
+    return res
+
+
+def _to_key(x: int, length: int) -> Tuple[int, ...]:
+    return tuple((x >> i) & 1 for i in range(length))
+
+
+def _reduce(x: int, rows: Dict[int, int]) -> int:
+    """Reduces x by rows, indexed by their highest (pivot) bit."""
+    while x:
+        row = rows.get(x.bit_length() - 1)
+        if row is None:
+            return x
+        x ^= row
+    return 0
+
+
+def _reduced_basis(vectors: Iterable[int]) -> List[int]:
+    """Basis of the span of vectors in reduced row echelon form.
+
+    Rows are sorted by their pivot (highest) bit, and every pivot bit is set in its own row
+    only, so the coordinates of a vector of the span are its bits at the pivots.
+    """
+    rows: Dict[int, int] = {}
+    for v in vectors:
+        v = _reduce(v, rows)
+        if v:
+            rows[v.bit_length() - 1] = v
+    basis = [rows[p] for p in sorted(rows)]
+    for i in range(len(basis)):
+        for j in range(i):
+            if (basis[i] >> (basis[j].bit_length() - 1)) & 1:
+                basis[i] ^= basis[j]
+    return basis
+
+
+def _affine_basis(point: int, vectors: Iterable[int]) -> Tuple[List[int], int]:
+    """Reduced basis and offset of point + span(vectors), the offset is zero on the pivots."""
+    basis = _reduced_basis(vectors)
+    for row in basis:
+        if (point >> (row.bit_length() - 1)) & 1:
+            point ^= row
+    return basis, point
+
+
+def _solve(columns: List[int], target: int) -> Tuple[Optional[int], List[int]]:
+    """Solves sum_i x_i * columns[i] = target over GF2.
+
+    Returns a particular solution (None if there is none) and a basis of the kernel, both
+    as bitmasks of x.
+    """
+    pivots: Dict[int, Tuple[int, int]] = {}
+    kernel = []
+    for i, v in enumerate(columns):
+        m = 1 << i
+        while v:
+            top = v.bit_length() - 1
+            if top not in pivots:
+                pivots[top] = (v, m)
+                break
+            pv, pm = pivots[top]
+            v ^= pv
+            m ^= pm
+        if not v:
+            kernel.append(m)
+    v, m = target, 0
+    while v:
+        top = v.bit_length() - 1
+        if top not in pivots:
+            return None, kernel
+        pv, pm = pivots[top]
+        v ^= pv
+        m ^= pm
+    return m, kernel
+
+
+class AffineMap:
+    """The GF2 affine map x -> A x + b on vectors stored as int bitmasks.
+
+    columns[i] is the image of the i-th unit vector and constant is b. Evaluation XORs
+    precomputed tables of the images of each byte of x.
+    """
+
+    def __init__(self, columns: List[int], constant: int = 0):
+        self.columns = list(columns)
+        self.constant = constant
+        self._tables = []
+        for start in range(0, len(self.columns), 8):
+            cols = self.columns[start : start + 8]
+            table = [0] * (1 << len(cols))
+            for b in range(1, len(table)):
+                low = b & -b
+                table[b] = table[b ^ low] ^ cols[low.bit_length() - 1]
+            self._tables.append(table)
+
+    @staticmethod
+    def from_positions(positions: Dict[int, int], length: int) -> "AffineMap":
+        """Moves bit p of a length bit vector to bit positions[p], dropping the others."""
+        columns = [0] * length
+        for p, q in positions.items():
+            columns[p] = 1 << q
+        return AffineMap(columns)
+
+    def __call__(self, x: int) -> int:
+        res = self.constant
+        for table in self._tables:
+            res ^= table[x & 0xFF]
+            x >>= 8
+        return res
+
+    def linear(self, x: int) -> int:
+        return self(x) ^ self.constant
+
+    def then(self, other: "AffineMap") -> "AffineMap":
+        """The composition other(self(x))."""
+        return AffineMap([other.linear(c) for c in self.columns], other(self.constant))
+
+
+class AffineTensor:
+    """A PTE tensor whose keys lie in the affine subspace offset + span(basis).
+
+    The support of a stabilizer PTE is a coset of the stabilizers restricted to its legs, so
+    instead of full keys of key_length bits, the polynomials are stored under the
+    coordinates of their key in the basis, a rank bit integer. Keys and basis vectors are
+    int bitmasks, bit i being the i-th element of the key tuple.
+
+    Merges and self traces solve for the basis of the result and then map coordinates to
+    coordinates with affine maps, without ever building the keys. The dict-like interface
+    (items, get, ...) works with key tuples, like any other PTE tensor.
+    """
+
+    def __init__(
+        self,
+        key_length: int,
+        basis: List[int],
+        offset: int,
+        polys: Dict[int, SimplePoly],
+    ):
+        self.key_length = key_length
+        self.basis = basis
+        self.offset = offset
+        self.polys = polys
+        self._decode = AffineMap(basis, offset)
+        # the offset is zero on the pivots, so the coordinates are the bits at the pivots
+        self._encode = AffineMap.from_positions(
+            {row.bit_length() - 1: i for i, row in enumerate(basis)}, key_length
+        )
+
+    @staticmethod
+    def from_items(
+        items: Iterable[Tuple[Tuple[int, ...], SimplePoly]], key_length: int
+    ) -> "AffineTensor":
+        items = [(_to_int(k), v) for k, v in items]
+        if len(items) == 0:
+            return AffineTensor(key_length, [], 0, {})
+        first = items[0][0]
+        basis, offset = _affine_basis(first, (x ^ first for x, _ in items))
+        tensor = AffineTensor(key_length, basis, offset, {})
+        for x, v in items:
+            tensor.polys[tensor._encode(x)] = v
+        return tensor
+
+    @property
+    def rank(self) -> int:
+        return len(self.basis)
+
+    @property
+    def estimated_bytes(self) -> int:
+        return sum(estimate_entry_bytes(1, len(v)) for v in self.polys.values())
+
+    def __str__(self):
+        return f"AffineTensor[{len(self)} keys of length {self.key_length} in rank {self.rank} subspace]"
+
+    def __repr__(self):
+        return str(self)
+
+    def coordinates(self, key: Tuple[int, ...]) -> Optional[int]:
+        """Coordinates of key in the basis, None if key is not in the subspace."""
+        x = _to_int(key)
+        c = self._encode(x)
+        return c if self._decode(c) == x else None
+
+    def key(self, coordinates: int) -> Tuple[int, ...]:
+        return _to_key(self._decode(coordinates), self.key_length)
+
+    def __len__(self):
+        return len(self.polys)
+
+    def items(self):
+        for c, v in self.polys.items():
+            yield self.key(c), v
+
+    def keys(self):
+        for c in self.polys:
+            yield self.key(c)
+
+    def values(self):
+        return self.polys.values()
+
+    def __iter__(self):
+        return self.keys()
+
+    def get(self, key, default=None):
+        c = self.coordinates(key)
+        if c is None:
+            return default
+        return self.polys.get(c, default)
+
+    def __getitem__(self, key):
+        res = self.get(key)
+        if res is None:
+            raise KeyError(key)
+        return res
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _join_map(self, join: List[int]) -> AffineMap:
+        return self._decode.then(
+            AffineMap.from_positions({p: i for i, p in enumerate(join)}, self.key_length)
+        )
+
+    def _out_map(self, out: Dict[int, int]) -> AffineMap:
+        return self._decode.then(AffineMap.from_positions(out, self.key_length))
+
+    def merge(
+        self,
+        other: "AffineTensor",
+        join1: List[int],
+        join2: List[int],
+        out1: Dict[int, int],
+        out2: Dict[int, int],
+        out_length: int,
+        truncate: Callable[[SimplePoly], Optional[SimplePoly]],
+        truncate_length: Optional[int] = None,
+        cancel: Optional[CancellationToken] = None,
+    ) -> "AffineTensor":
+        """Sums the products of the polynomials of keys agreeing on the join positions.
+
+        The bit at position p of a key of this (other) tensor goes to position out1[p]
+        (out2[p]) of the key of the result, truncate is applied to every polynomial before
+        the products, which are truncated at truncate_length.
+        """
+        j1 = self._join_map(join1)
+        j2 = other._join_map(join2)
+        e1 = self._out_map(out1)
+        e2 = other._out_map(out2)
+
+        # the pairs of coordinates (c1, c2) with j1(c1) == j2(c2) are particular + kernel,
+        # their keys are the image of that under (e1, e2)
+        particular, kernel = _solve(j1.columns + j2.columns, j1.constant ^ j2.constant)
+        if particular is None:
+            return AffineTensor(out_length, [], 0, {})
+        low_mask = (1 << self.rank) - 1
+
+        def image(m):
+            return e1.linear(m & low_mask) ^ e2.linear(m >> self.rank)
+
+        basis, offset = _affine_basis(
+            image(particular) ^ e1.constant ^ e2.constant, (image(m) for m in kernel)
+        )
+        result = AffineTensor(out_length, basis, offset, {})
+        # the coordinates of the result are f1(c1) ^ f2(c2)
+        f1 = e1.then(result._encode)
+        f2 = e2.then(result._encode)
+
+        index = defaultdict(list)
+        for c2, wep2 in check_cancelled(other.polys.items(), cancel):
+            wep2 = truncate(wep2)
+            if wep2 is None:
+                continue
+            min_w2 = wep2.minw()[0] if truncate_length is not None else 0
+            index[j2(c2)].append((min_w2, f2(c2), wep2))
+        if truncate_length is not None:
+            for matches in index.values():
+                matches.sort(key=lambda match: match[0])
+
+        polys = result.polys
+        for c1, wep1 in check_cancelled(self.polys.items(), cancel):
+            matches = index.get(j1(c1))
+            if matches is None:
+                continue
+            wep1 = truncate(wep1)
+            if wep1 is None:
+                continue
+            g1 = f1(c1)
+            min_w1 = wep1.minw()[0] if truncate_length is not None else 0
+            for min_w2, g2, wep2 in matches:
+                if truncate_length is None:
+                    prod = wep1 * wep2
+                elif min_w1 + min_w2 > truncate_length:
+                    break
+                else:
+                    prod = wep1.mul_truncated(wep2, truncate_length)
+                existing = polys.get(g1 ^ g2)
+                if existing is None:
+                    polys[g1 ^ g2] = prod
+                else:
+                    existing.add_inplace(prod)
+        return result
+
+    def self_trace(
+        self,
+        join1: List[int],
+        join2: List[int],
+        out: Dict[int, int],
+        out_length: int,
+        truncate: Callable[[SimplePoly], Optional[SimplePoly]],
+        cancel: Optional[CancellationToken] = None,
+    ) -> "AffineTensor":
+        """Sums the polynomials of the keys agreeing on join1 and join2 by their out positions."""
+        j1 = self._join_map(join1)
+        j2 = self._join_map(join2)
+        diff = AffineMap(
+            [a ^ b for a, b in zip(j1.columns, j2.columns)], j1.constant ^ j2.constant
+        )
+        e = self._out_map(out)
+
+        particular, kernel = _solve(diff.columns, diff.constant)
+        if particular is None:
+            return AffineTensor(out_length, [], 0, {})
+        basis, offset = _affine_basis(e(particular), (e.linear(m) for m in kernel))
+        result = AffineTensor(out_length, basis, offset, {})
+        f = e.then(result._encode)
+
+        polys = result.polys
+        for c, wep in check_cancelled(self.polys.items(), cancel):
+            if diff(c) != 0:
+                continue
+            wep = truncate(wep)
+            if wep is None:
+                continue
+            g = f(c)
+            existing = polys.get(g)
+            if existing is None:
+                polys[g] = SimplePoly(wep)
+            else:
+                existing.add_inplace(wep)
+        return result
+
+    def truncated(self, truncate_length: int) -> "AffineTensor":
+        """Drops the keys beyond truncate_length and keeps the leading order terms of the rest."""
+        polys = {}
+        for c, v in self.polys.items():
+            if v.minw()[0] > truncate_length:
+                continue
+            polys[c] = v.leading_order_poly()
+        return AffineTensor(self.key_length, self.basis, self.offset, polys)
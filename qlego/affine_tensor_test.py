@@ -0,0 +1,65 @@
+from qlego.affine_tensor import AffineTensor
+from qlego.legos import Legos
+from qlego.simple_poly import SimplePoly
+from qlego.stabilizer_tensor_enumerator import StabilizerCodeTensorEnumerator
+
+
+def test_affine_tensor_from_items():
+    tensor = StabilizerCodeTensorEnumerator(
+        Legos.enconding_tensor_512, idx=0
+    ).stabilizer_enumerator_polynomial(open_legs=[0, 1, 2])
+    affine = AffineTensor.from_items(tensor.items(), key_length=6)
+
+    # the 512 tensor has 4 stabilizers, 16 elements restricted to any 3 legs
+    assert affine.rank == 4
+    assert len(affine) == len(tensor) == 16
+    assert dict(affine.items()) == tensor
+    for k, v in tensor.items():
+        assert affine[k] == v
+    assert affine.get((1, 0, 0, 0, 0, 0)) is None
+
+
+def test_affine_tensor_coset():
+    tensor = {
+        (1, 0, 0): SimplePoly({1: 1}),
+        (0, 1, 0): SimplePoly({2: 1}),
+        (1, 1, 1): SimplePoly({0: 3}),
+    }
+    affine = AffineTensor.from_items(tensor.items(), key_length=3)
+    assert affine.rank == 2
+    assert dict(affine.items()) == tensor
+    # in the coset, but not in the tensor
+    assert affine.coordinates((0, 0, 1)) is not None
+    assert affine.get((0, 0, 1)) is None
+    # outside the coset
+    assert affine.coordinates((0, 0, 0)) is None
+
+
+def test_affine_tensor_merge_and_self_trace():
+    tensor1 = {
+        (0, 0, 0, 0): SimplePoly({0: 1}),
+        (1, 0, 1, 1): SimplePoly({2: 1}),
+        (0, 1, 1, 0): SimplePoly({1: 2}),
+        (1, 1, 1, 1): SimplePoly({3: 1}),
+    }
+    tensor2 = {
+        (0, 0): SimplePoly({0: 1}),
+        (1, 0): SimplePoly({1: 1}),
+        (0, 1): SimplePoly({1: 1}),
+        (1, 1): SimplePoly({1: 1}),
+    }
+    a1 = AffineTensor.from_items(tensor1.items(), 4)
+    a2 = AffineTensor.from_items(tensor2.items(), 2)
+
+    # join leg 1 of tensor1 (bits 1, 3) with the only leg of tensor2, keep leg 0
+    merged = a1.merge(a2, [1, 3], [0, 1], {0: 0, 2: 1}, {}, 2, lambda p: p)
+    expected = {}
+    for k1, v1 in tensor1.items():
+        for k2, v2 in tensor2.items():
+            if (k1[1], k1[3]) == k2:
+                key = (k1[0], k1[2])
+                expected[key] = expected.get(key, SimplePoly()) + v1 * v2
+    assert dict(merged.items()) == expected
+
+    traced = a1.self_trace([0, 2], [1, 3], {}, 0, lambda p: p)
+    assert dict(traced.items()) == {(): SimplePoly({0: 1, 3: 1})}
@@ -0,0 +1,122 @@
+import heapq
+from typing import Any, Dict, Iterable, List, Tuple
+
+import attrs
+import numpy as np
+from galois import GF2
+
+from qlego.linalg import gauss, rank
+from qlego.simple_poly import SimplePoly
+from qlego.stabilizer_tensor_enumerator import (
+    StabilizerCodeTensorEnumerator,
+    _index_leg,
+)
+
+KEY_PRIORITIES = ("min_weight", "mass")
+
+
+@attrs.define
+class ApproximationReport:
+    """What an approximate (top-K keys) contraction discarded and how much it can be off.
+
+    discarded_keys and discarded_mass are per step, the mass of a polynomial being the sum
+    of its coefficients. exact_mass is the mass of the exact unnormalized result, so
+    computed_mass falls short of it by exactly the mass lost to the discarded keys (and to
+    truncation). As all coefficients are non-negative, no coefficient of the result is more
+    than error_bound below the exact one.
+    """
+
+    max_keys: int
+    key_priority: str
+    discarded_keys: List[int] = attrs.Factory(list)
+    discarded_mass: List[int] = attrs.Factory(list)
+    exact_mass: int = 0
+    computed_mass: int = 0
+    # the result is divided by this, the bound is in the same units
+    normalization: int = 1
+
+    @property
+    def error_bound(self) -> int:
+        return -(-(self.exact_mass - self.computed_mass) // self.normalization)
+
+    @property
+    def is_exact(self) -> bool:
+        return self.computed_mass == self.exact_mass
+
+
+def poly_mass(poly: SimplePoly) -> int:
+    return sum(poly._dict.values())
+
+
+def select_top_keys(
+    items: Iterable[Tuple[Any, SimplePoly]], max_keys: int, key_priority: str
+) -> Tuple[List[Tuple[Any, SimplePoly]], int, int]:
+    """Picks the max_keys items with the lowest minimum weight or the largest mass.
+
+    Ties are broken by the other criterion, then by the key, so the pick doesn't depend
+    on the order of the items. Returns the picked items, and the number and the total
+    mass of the rest.
+    """
+    if key_priority == "min_weight":
+        priority = lambda item: (-item[1].minw()[0], poly_mass(item[1]), item[0])
+    elif key_priority == "mass":
+        priority = lambda item: (poly_mass(item[1]), -item[1].minw()[0], item[0])
+    else:
+        raise ValueError(
+            f"Unknown key priority {key_priority}, it should be one of {KEY_PRIORITIES}"
+        )
+    n_items = 0
+    total_mass = 0
+
+    def tally(items):
+        nonlocal n_items, total_mass
+        for item in items:
+            n_items += 1
+            total_mass += poly_mass(item[1])
+            yield item
+
+    kept = heapq.nlargest(max_keys, tally(items), key=priority)
+    return (
+        kept,
+        n_items - len(kept),
+        total_mass - sum(poly_mass(v) for _, v in kept),
+    )
+
+
+def contraction_mass(
+    nodes: Dict[Any, StabilizerCodeTensorEnumerator], traces: List[Tuple]
+) -> int:
+    """Sum of the coefficients of the exact, unnormalized contraction of nodes along traces.
+
+    Each term of the contraction is a tuple of node stabilizers agreeing on all traced
+    legs, and those form a GF2 vector space: its dimension is the number of node generators
+    minus the rank of the constraints the traces put on their coefficients.
+    """
+    generators = {}
+    offsets = {}
+    n_vars = 0
+    for idx, node in nodes.items():
+        h = node.h if len(node.h.shape) == 2 else node.h.reshape(1, -1)
+        h = gauss(h)
+        generators[idx] = h[~np.all(h == 0, axis=1)]
+        offsets[idx] = n_vars
+        n_vars += len(generators[idx])
+
+    def column(node_idx, leg, part):
+        node = nodes[node_idx]
+        col = node.legs.index(_index_leg(node_idx, leg)) + part * node.n
+        row = np.zeros(n_vars, dtype=np.uint8)
+        h = generators[node_idx]
+        row[offsets[node_idx] : offsets[node_idx] + len(h)] = h[:, col]
+        return row
+
+    constraints = []
+    for node_idx1, node_idx2, join_legs1, join_legs2 in traces:
+        for leg1, leg2 in zip(join_legs1, join_legs2):
+            for part in (0, 1):
+                constraints.append(
+                    column(node_idx1, leg1, part) ^ column(node_idx2, leg2, part)
+                )
+    if len(constraints) == 0:
+        return 2**n_vars
+    return 2 ** (n_vars - rank(GF2(np.array(constraints))))
@@ -0,0 +1,32 @@
+from qlego.approximation import contraction_mass, poly_mass, select_top_keys
+from qlego.codes.surface_code import SurfaceCodeTN
+from qlego.simple_poly import SimplePoly
+
+
+def test_select_top_keys():
+    items = [
+        ("a", SimplePoly({2: 1})),
+        ("b", SimplePoly({0: 1, 4: 3})),
+        ("c", SimplePoly({1: 5})),
+        ("d", SimplePoly({1: 1})),
+    ]
+    kept, n_discarded, discarded_mass = select_top_keys(items, 2, "min_weight")
+    assert [k for k, _ in kept] == ["b", "c"]
+    assert (n_discarded, discarded_mass) == (2, 2)
+
+    kept, n_discarded, discarded_mass = select_top_keys(items, 2, "mass")
+    assert [k for k, _ in kept] == ["c", "b"]
+    assert (n_discarded, discarded_mass) == (2, 2)
+
+    ties = [(k, SimplePoly({1: 1})) for k in "efg"]
+    for priority in ("min_weight", "mass"):
+        assert select_top_keys(ties, 2, priority) == select_top_keys(
+            ties[::-1], 2, priority
+        )
+
+
+def test_contraction_mass():
+    tn = SurfaceCodeTN(d=3)
+    # the code has 12 independent stabilizers and the contraction counts each once
+    assert contraction_mass(tn.nodes, tn.traces) == 2**12
+    assert poly_mass(tn.stabilizer_enumerator_polynomial(cotengra=False)) == 2**12
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import pickle
+import time
+import uuid
+import weakref
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from qlego.simple_poly import SimplePoly
+
+_MANIFEST = "manifest.pkl"
+_PTE_PREFIX = "pte_"
+
+# Number of entries per pickled chunk of a PTE file.
+_CHUNK_SIZE = 4096
+
+
+def contraction_fingerprint(
+    nodes: Dict[Any, Any],
+    traces: List[Tuple],
+    open_legs_per_node: Dict[Any, List[Tuple]],
+    truncate_length: Optional[int],
+) -> str:
+    """Digest of everything a checkpoint depends on, independent of the trace order."""
+    parts = sorted(
+        repr((idx, node.h.tolist(), node.legs, node.coset_flipped_legs))
+        for idx, node in nodes.items()
+    )
+    parts += sorted(
+        repr((n1, n2, list(legs1), list(legs2))) for n1, n2, legs1, legs2 in traces
+    )
+    parts += sorted(repr((idx, legs)) for idx, legs in open_legs_per_node.items())
+    parts.append(repr(truncate_length))
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def write_tensor(
+    path: str, items: Iterable[Tuple[Tuple[int, ...], SimplePoly]], key_length: int
+):
+    """Writes (key, poly) items as pickled chunks of bit-packed keys and coefficient dicts.
+
+    The file is written under a temporary name and moved in place, so a crash never leaves
+    a partial file behind under path.
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+
+        def dump(keys, polys):
+            packed = np.packbits(
+                np.array(keys, dtype=np.uint8).reshape(len(keys), key_length), axis=1
+            )
+            pickle.dump((packed, polys), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        keys, polys = [], []
+        for k, v in items:
+            keys.append(k)
+            polys.append(v._dict)
+            if len(keys) >= _CHUNK_SIZE:
+                dump(keys, polys)
+                keys, polys = [], []
+        if len(keys) > 0:
+            dump(keys, polys)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_tensor(
+    path: str, key_length: int
+) -> Iterator[Tuple[Tuple[int, ...], SimplePoly]]:
+    """Streams the (key, poly) items of a file written by write_tensor."""
+    with open(path, "rb") as f:
+        while True:
+            try:
+                packed, polys = pickle.load(f)
+            except EOFError:
+                return
+            keys = np.unpackbits(packed, axis=1, count=key_length)
+            for row, poly in zip(keys, polys):
+                yield tuple(row.tolist()), SimplePoly(poly)
+
+
+class ContractionCheckpoint:
+    """Periodically saves the state of a contraction to a directory.
+
+    The state is the live PTEs, legs_left_to_join, the trace schedule and the cursor into
+    it. Every PTE tensor is written to its own file once, checkpoints after that only
+    write the PTEs created since the previous one and a small manifest, which is replaced
+    atomically. Files no longer referenced by the manifest are removed.
+
+    A checkpoint is due every `every_steps` steps or `interval` seconds, whichever comes
+    first (None disables either).
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fingerprint: str,
+        every_steps: Optional[int] = None,
+        interval: Optional[float] = 600.0,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.every_steps = every_steps
+        self.interval = interval
+        self._written: Dict[frozenset, Tuple[weakref.ref, str]] = {}
+        self._steps_since_save = 0
+        self._last_save = time.monotonic()
+
+    def register(self, pte, file: str):
+        """Marks pte as already stored in file (e.g. after resuming from it)."""
+        self._written[frozenset(pte.nodes)] = (weakref.ref(pte), file)
+
+    def step_done(
+        self,
+        cursor: int,
+        traces: List[Tuple],
+        ptes: Dict[Any, Any],
+        legs_left_to_join: Dict[Any, List],
+    ) -> bool:
+        """Saves a checkpoint if one is due, returns whether it did."""
+        self._steps_since_save += 1
+        due = (
+            self.every_steps is not None and self._steps_since_save >= self.every_steps
+        ) or (
+            self.interval is not None
+            and time.monotonic() - self._last_save >= self.interval
+        )
+        if not due:
+            return False
+        self.save(cursor, traces, ptes, legs_left_to_join)
+        return True
+
+    def save(
+        self,
+        cursor: int,
+        traces: List[Tuple],
+        ptes: Dict[Any, Any],
+        legs_left_to_join: Dict[Any, List],
+    ):
+        records = []
+        written = {}
+        for pte in {id(pte): pte for pte in ptes.values()}.values():
+            nodes = frozenset(pte.nodes)
+            ref, file = self._written.get(nodes, (None, None))
+            if ref is None or ref() is not pte:
+                file = f"{_PTE_PREFIX}{uuid.uuid4().hex}.bin"
+                write_tensor(
+                    os.path.join(self.directory, file),
+                    pte.tensor.items(),
+                    2 * len(pte.tracable_legs),
+                )
+            written[nodes] = (weakref.ref(pte), file)
+            records.append(
+                {
+                    "nodes": set(pte.nodes),
+                    "tracable_legs": list(pte.tracable_legs),
+                    "file": file,
+                }
+            )
+
+        manifest = {
+            "fingerprint": self.fingerprint,
+            "cursor": cursor,
+            "traces": traces,
+            "legs_left_to_join": legs_left_to_join,
+            "ptes": records,
+        }
+        path = os.path.join(self.directory, _MANIFEST)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        live_files = {file for _, file in written.values()}
+        for file in os.listdir(self.directory):
+            if file.startswith(_PTE_PREFIX) and file not in live_files:
+                os.remove(os.path.join(self.directory, file))
+
+        self._written = written
+        self._steps_since_save = 0
+        self._last_save = time.monotonic()
+
+
+def load_checkpoint(directory: str, fingerprint: str) -> Dict[str, Any]:
+    """Reads the manifest of the checkpoint in directory.
+
+    PTE tensors are not loaded, read them with read_tensor from the "file" of each record
+    in "ptes".
+    """
+    with open(os.path.join(directory, _MANIFEST), "rb") as f:
+        manifest = pickle.load(f)
+    if manifest["fingerprint"] != fingerprint:
+        raise ValueError(
+            f"Checkpoint in {directory} was saved for a different network, open legs or truncate length."
+        )
+    return manifest
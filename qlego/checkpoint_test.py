@@ -0,0 +1,22 @@
+import os
+
+from qlego.checkpoint import read_tensor, write_tensor
+from qlego.simple_poly import SimplePoly
+
+
+def test_write_read_tensor_roundtrip(tmp_path):
+    tensor = {
+        (i % 2, (i >> 1) % 2, 1, 0, (i >> 2) % 2, 1, 1, 0, 1, 0): SimplePoly(
+            {i % 3: i + 1}
+        )
+        for i in range(8)
+    }
+    path = os.path.join(tmp_path, "pte.bin")
+    write_tensor(path, tensor.items(), key_length=10)
+    assert dict(read_tensor(path, key_length=10)) == tensor
+
+    write_tensor(path, {(): SimplePoly({0: 1, 2: 3})}.items(), key_length=0)
+    assert dict(read_tensor(path, key_length=0)) == {(): SimplePoly({0: 1, 2: 3})}
+
+    write_tensor(path, [], key_length=4)
+    assert dict(read_tensor(path, key_length=4)) == {}
@@ -0,0 +1,245 @@
+import argparse
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+import os
+import queue
+import secrets
+import subprocess
+import sys
+import threading
+import traceback
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+# the authkey of workers started from the command line, hex encoded
+AUTHKEY_ENV = "QLEGO_CLUSTER_AUTHKEY"
+
+Address = Tuple[str, int]
+
+
+class WorkerLost(Exception):
+    """Raised from the futures of calls whose worker disconnected."""
+
+
+def _handle(conn: Connection):
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message[0] == "close":
+            return
+        _, fn, args = message
+        try:
+            reply = ("ok", fn(*args))
+        except Exception as e:
+            reply = ("error", e)
+        try:
+            conn.send(reply)
+        except (EOFError, OSError):
+            # the coordinator disconnected
+            return
+        except Exception:
+            # unpicklable results and exceptions are sent as text
+            conn.send(("error", RuntimeError(traceback.format_exc())))
+
+
+def serve(
+    address: Address,
+    authkey: bytes,
+    ready: Optional[Callable[[Address], None]] = None,
+    max_sessions: Optional[int] = None,
+):
+    """Runs a worker: serves the calls of one coordinator after the other.
+
+    Calls are pickled over multiprocessing.connection, which authenticates both ends
+    with the shared authkey. Functions are pickled by reference, so the worker needs the
+    same version of qlego as the coordinator. As unpickling can run arbitrary code, only
+    listen on trusted networks.
+
+    ready is called with the address the worker listens on, the port can be 0 to pick a
+    free one.
+    """
+    with Listener(address, authkey=authkey) as listener:
+        if ready is not None:
+            ready(listener.address)
+        sessions = 0
+        while max_sessions is None or sessions < max_sessions:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError, OSError):
+                # e.g. a wrong authkey or a connection closed during the handshake
+                continue
+            with conn:
+                try:
+                    _handle(conn)
+                except (EOFError, OSError):
+                    pass
+            sessions += 1
+
+
+class Cluster(Executor):
+    """An Executor that runs calls on the workers at the given addresses.
+
+    Each worker takes the next call from a shared queue as soon as it is done with the
+    previous one, so faster workers take more of the work. broadcast runs a call on all
+    workers, e.g. to set up the state the following calls share.
+    """
+
+    def __init__(self, addresses: List[Address], authkey: bytes):
+        self._queue: queue.Queue = queue.Queue()
+        self._conns = [Client(address, authkey=authkey) for address in addresses]
+        self._locks = [threading.Lock() for _ in self._conns]
+        self._alive = len(self._conns)
+        self._state_lock = threading.Lock()
+        self._shutdown = False
+        self._threads = [
+            threading.Thread(target=self._dispatch, args=(i,), daemon=True)
+            for i in range(len(self._conns))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def n_workers(self) -> int:
+        return self._alive
+
+    def _call(self, i: int, fn, args) -> Tuple[str, Any]:
+        with self._locks[i]:
+            self._conns[i].send(("call", fn, args))
+            return self._conns[i].recv()
+
+    def _dispatch(self, i: int):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                status, value = self._call(i, fn, args)
+            except (EOFError, OSError) as e:
+                future.set_exception(WorkerLost(f"worker {i} disconnected: {e}"))
+                self._worker_lost()
+                return
+            except Exception as e:
+                # e.g. unpicklable arguments
+                future.set_exception(e)
+                continue
+            if status == "error":
+                future.set_exception(value)
+            else:
+                future.set_result(value)
+
+    def _worker_lost(self):
+        with self._state_lock:
+            self._alive -= 1
+            if self._alive > 0:
+                return
+        # nobody is left to run the queued calls
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None and item[0].set_running_or_notify_cancel():
+                item[0].set_exception(WorkerLost("all workers disconnected"))
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        if self._shutdown:
+            raise RuntimeError("Can't submit to a cluster that was shut down.")
+        if kwargs:
+            raise TypeError("Cluster calls only take positional arguments.")
+        future = Future()
+        if self._alive == 0:
+            future.set_exception(WorkerLost("all workers disconnected"))
+            return future
+        self._queue.put((future, fn, args))
+        return future
+
+    def broadcast(self, fn, *args) -> List[Any]:
+        """Runs fn(*args) on every worker, after the calls they are running."""
+        results = []
+        for i in range(len(self._conns)):
+            status, value = self._call(i, fn, args)
+            if status == "error":
+                raise value
+            results.append(value)
+        return results
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        if self._shutdown:
+            return
+        self._shutdown = True
+        if cancel_futures:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    item[0].cancel()
+        for _ in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        for i, conn in enumerate(self._conns):
+            with self._locks[i]:
+                try:
+                    conn.send(("close",))
+                except OSError:
+                    pass
+                conn.close()
+
+
+@contextmanager
+def local_cluster(
+    n_workers: int, authkey: Optional[bytes] = None
+) -> Iterator[Cluster]:
+    """A Cluster of n_workers worker subprocesses on localhost, stopped on exit."""
+    authkey = authkey if authkey is not None else secrets.token_bytes(32)
+    env = dict(os.environ, **{AUTHKEY_ENV: authkey.hex()})
+    processes = []
+    try:
+        addresses = []
+        for _ in range(n_workers):
+            process = subprocess.Popen(
+                [sys.executable, "-m", "qlego.cluster", "--port", "0"],
+                stdout=subprocess.PIPE,
+                env=env,
+                text=True,
+            )
+            processes.append(process)
+            host, port = process.stdout.readline().split()
+            addresses.append((host, int(port)))
+        cluster = Cluster(addresses, authkey)
+        try:
+            yield cluster
+        finally:
+            cluster.shutdown(cancel_futures=True)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+            process.stdout.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=f"Runs a qlego cluster worker, the hex authkey is in {AUTHKEY_ENV}"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    args = parser.parse_args()
+
+    def ready(address):
+        print(*address, flush=True)
+
+    serve((args.host, args.port), bytes.fromhex(os.environ[AUTHKEY_ENV]), ready)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+import operator
+import socket
+import threading
+import time
+
+import pytest
+
+from qlego.cluster import Cluster, WorkerLost, local_cluster, serve
+
+
+def test_local_cluster():
+    with local_cluster(2) as cluster:
+        assert cluster.n_workers == 2
+        futures = [cluster.submit(operator.add, i, 1) for i in range(10)]
+        assert [f.result() for f in futures] == list(range(1, 11))
+        assert cluster.broadcast(operator.mul, 3, 4) == [12, 12]
+        with pytest.raises(ZeroDivisionError):
+            cluster.submit(operator.truediv, 1, 0).result()
+        # errors in a call don't take the worker down
+        assert cluster.submit(operator.add, 1, 1).result() == 2
+
+
+def _start_worker(authkey, max_sessions=None):
+    ready = threading.Event()
+    addresses = []
+
+    def on_ready(address):
+        addresses.append(address)
+        ready.set()
+
+    worker = threading.Thread(
+        target=serve,
+        args=(("127.0.0.1", 0), authkey, on_ready),
+        kwargs=dict(max_sessions=max_sessions),
+        daemon=True,
+    )
+    worker.start()
+    ready.wait()
+    return worker, addresses
+
+
+def test_wrong_authkey_is_rejected_and_lost_workers_are_reported():
+    _, addresses = _start_worker(b"secret", max_sessions=1)
+    with pytest.raises(AuthenticationError):
+        Cluster(addresses, b"wrong")
+
+    cluster = Cluster(addresses, b"secret")
+    assert cluster.submit(operator.add, 1, 2).result() == 3
+    # as if the worker was gone
+    cluster._conns[0].close()
+    with pytest.raises(WorkerLost):
+        cluster.submit(operator.add, 1, 2).result()
+    assert cluster.n_workers == 0
+    cluster.shutdown()
+
+
+def test_workers_outlive_dropped_connections():
+    worker, addresses = _start_worker(b"secret", max_sessions=2)
+    # e.g. a port scan, closed before the handshake
+    socket.create_connection(addresses[0]).close()
+
+    # a coordinator that disconnects during a call
+    conn = Client(addresses[0], authkey=b"secret")
+    conn.send(("call", time.sleep, (0.2,)))
+    conn.close()
+
+    cluster = Cluster(addresses, b"secret")
+    assert cluster.submit(operator.add, 1, 2).result() == 3
+    cluster.shutdown()
+    worker.join(timeout=10)
+    assert not worker.is_alive()
@@ -96,3 +96,6 @@ class RotatedSurfaceCodeTN(TensorNetwork):
 
     def n_qubits(self):
         return self.n
+
+    def node_coordinates(self):
+        return {idx: idx for idx in self.nodes}
@@ -156,3 +156,6 @@ class SurfaceCodeTN(TensorNetwork):
 
     def n_qubits(self):
         return self.n
+
+    def node_coordinates(self):
+        return {idx: idx for idx in self.nodes}
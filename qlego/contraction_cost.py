@@ -0,0 +1,674 @@
+from collections import defaultdict
+import math
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import attrs
+from cotengra.scoring import Objective
+import numpy as np
+from galois import GF2
+
+from qlego.contraction_schedule import UnionFind, fuse_traces
+from qlego.linalg import rank
+from qlego.pte_storage import estimate_entry_bytes
+from qlego.stabilizer_tensor_enumerator import StabilizerCodeTensorEnumerator
+
+
+@attrs.define
+class ContractionStepCost:
+    """Predicted cost of a single (fused) step of a contraction schedule."""
+
+    step: int
+    kind: str
+    traces: Tuple
+    n_nodes: int
+    legs: int
+    keys: int
+    terms_per_key: int
+    bytes: int
+    operations: int
+    peak_bytes: int
+    # rank of the parity check of the PTE's subnetwork
+    generators: int = 0
+
+
+@attrs.define
+class ContractionCostReport:
+    """Predicted key counts, memory and operation counts of a contraction schedule.
+
+    Key counts are exact (up to truncation, which can only drop keys), the byte and
+    operation counts are estimates based on them.
+    """
+
+    steps: List[ContractionStepCost]
+    node_keys: int
+    node_bytes: int
+    brute_force_operations: int
+    peak_bytes: int
+    total_operations: int
+    max_keys: int
+    max_legs: int
+
+    def __str__(self):
+        lines = [
+            f"{'step':>5} {'kind':>13} {'nodes':>6} {'legs':>5} {'keys':>12} {'terms':>6} {'bytes':>12} {'ops':>12} {'peak bytes':>12}"
+        ]
+        for s in self.steps:
+            lines.append(
+                f"{s.step:>5} {s.kind:>13} {s.n_nodes:>6} {s.legs:>5} {s.keys:>12.4g} {s.terms_per_key:>6} {s.bytes:>12.4g} {s.operations:>12.4g} {s.peak_bytes:>12.4g}"
+            )
+        lines.append(
+            f"node tensors: {self.node_keys} keys, {self.node_bytes} bytes, {self.brute_force_operations} brute force operations"
+        )
+        lines.append(
+            f"peak bytes: {self.peak_bytes:.4g}, total operations: {self.total_operations:.4g}, max keys: {self.max_keys:.4g}, max legs: {self.max_legs}"
+        )
+        return "\n".join(lines)
+
+
+def _h(enum: StabilizerCodeTensorEnumerator) -> GF2:
+    return enum.h if len(enum.h.shape) == 2 else enum.h.reshape(1, -1)
+
+
+def _leg_columns(enum: StabilizerCodeTensorEnumerator, legs) -> List[int]:
+    cols = [enum.legs.index(leg) for leg in legs]
+    return cols + [c + enum.n for c in cols]
+
+
+def support_rank(enum: StabilizerCodeTensorEnumerator, legs) -> int:
+    """Dimension of the stabilizer group of enum restricted to legs.
+
+    A PTE on the given legs has exactly 2**support_rank keys.
+    """
+    if len(legs) == 0:
+        return 0
+    return rank(_h(enum)[:, _leg_columns(enum, legs)])
+
+
+class _Component:
+    def __init__(self, enum, nodes, tracable_legs, truncate_length):
+        self.enum = enum
+        self.nodes = nodes
+        self.tracable_legs = tracable_legs
+        self._size(
+            rank(_h(enum)), support_rank(enum, tracable_legs), enum.n, truncate_length
+        )
+
+    def _size(self, generators, support, n_legs, truncate_length):
+        self.generators = generators
+        self.support = support
+        self.keys = 2**self.support
+        dangling_legs = n_legs - len(self.tracable_legs)
+        # every key carries the 2**(generators - support) stabilizers restricting to it,
+        # spread over the weights 0...dangling_legs
+        self.terms = min(dangling_legs + 1, 2 ** (self.generators - self.support))
+        if truncate_length is not None:
+            self.terms = 1
+        self.bytes = self.keys * estimate_entry_bytes(
+            2 * len(self.tracable_legs), self.terms
+        )
+
+
+def _bit_basis(rows: Iterable[int]) -> List[int]:
+    """A basis of the span of GF2 row vectors given as ints."""
+    pivots: Dict[int, int] = {}
+    for row in rows:
+        while row:
+            top = row.bit_length() - 1
+            if top not in pivots:
+                pivots[top] = row
+                break
+            row ^= pivots[top]
+    return list(pivots.values())
+
+
+def _bit_legs(row: int, positions: List[int]) -> int:
+    """The (x, z) bit pairs of a row on the legs at positions, in their order."""
+    res = 0
+    for j, i in enumerate(positions):
+        res |= ((row >> (2 * i)) & 3) << (2 * j)
+    return res
+
+
+class _BitComponent(_Component):
+    """A _Component on the generators of its parity check as ints.
+
+    The (x, z) bits of the i-th leg are the bits 2i and 2i + 1. Merges take microseconds
+    instead of the milliseconds of conjoining GF2 matrices, for scoring many trees. The
+    nodes are not kept, so merges don't take longer as components grow.
+    """
+
+    def __init__(self, rows, legs, tracable_legs, truncate_length):
+        self.rows = _bit_basis(rows)
+        self.legs = legs
+        self.position = {leg: i for i, leg in enumerate(legs)}
+        self.tracable_legs = tracable_legs
+        mask = 0
+        for leg in tracable_legs:
+            mask |= 3 << (2 * self.position[leg])
+        self._size(
+            len(self.rows),
+            len(_bit_basis(row & mask for row in self.rows)),
+            len(legs),
+            truncate_length,
+        )
+
+    @staticmethod
+    def of_node(enum: StabilizerCodeTensorEnumerator, tracable_legs):
+        h = np.array(_h(enum), dtype=int)
+        n = enum.n
+        rows = [
+            sum((int(row[q]) | int(row[q + n]) << 1) << (2 * q) for q in range(n))
+            for row in h
+        ]
+        return _BitComponent(rows, list(enum.legs), tracable_legs, None)
+
+    def merged(
+        self, other: "_BitComponent", join_legs1, join_legs2, truncate_length
+    ) -> Tuple["_BitComponent", int]:
+        """As _merged: the stabilizers with equal Paulis on the joined legs."""
+        positions1 = [self.position[leg] for leg in join_legs1]
+        positions2 = [other.position[leg] for leg in join_legs2]
+        j1 = [_bit_legs(row, positions1) for row in self.rows]
+        j2 = [_bit_legs(row, positions2) for row in other.rows]
+        dim1 = len(_bit_basis(j1))
+        dim2 = len(_bit_basis(j2))
+        dim_intersection = dim1 + dim2 - len(_bit_basis(j1 + j2))
+        pairs = (self.keys * other.keys * 2**dim_intersection) // (2**dim1 * 2**dim2)
+        operations = self.keys + other.keys + pairs * self.terms * other.terms
+
+        n1 = len(self.legs)
+        tracable_legs = [leg for leg in self.tracable_legs if leg not in join_legs1] + [
+            leg for leg in other.tracable_legs if leg not in join_legs2
+        ]
+        component = _BitComponent._traced(
+            self.rows + [row << (2 * n1) for row in other.rows],
+            self.legs + other.legs,
+            [(a, n1 + b) for a, b in zip(positions1, positions2)],
+            tracable_legs,
+            truncate_length,
+        )
+        return component, operations
+
+    def self_traced(
+        self, join_legs1, join_legs2, truncate_length
+    ) -> Tuple["_BitComponent", int]:
+        """As the self traces of _replay_steps: join_legs1 traced with join_legs2."""
+        tracable_legs = [
+            leg
+            for leg in self.tracable_legs
+            if leg not in join_legs1 and leg not in join_legs2
+        ]
+        component = _BitComponent._traced(
+            list(self.rows),
+            self.legs,
+            [
+                (self.position[leg1], self.position[leg2])
+                for leg1, leg2 in zip(join_legs1, join_legs2)
+            ],
+            tracable_legs,
+            truncate_length,
+        )
+        return component, self.keys
+
+    @staticmethod
+    def _traced(rows, legs, pairs, tracable_legs, truncate_length):
+        """The rows equal on the legs of each pair of positions, without those legs."""
+        for a, b in pairs:
+            for bit in (2 * a, 2 * a + 1):
+                other_bit = bit + 2 * (b - a)
+                mismatched = [((row >> bit) ^ (row >> other_bit)) & 1 for row in rows]
+                if not any(mismatched):
+                    continue
+                i = mismatched.index(1)
+                pivot = rows.pop(i)
+                del mismatched[i]
+                rows = [row ^ pivot if m else row for row, m in zip(rows, mismatched)]
+        joined = {i for pair in pairs for i in pair}
+        kept = [i for i in range(len(legs)) if i not in joined]
+        return _BitComponent(
+            [_bit_legs(row, kept) for row in rows],
+            [legs[i] for i in kept],
+            tracable_legs,
+            truncate_length,
+        )
+
+
+def _matching_pairs(c1: _Component, c2: _Component, join_legs1, join_legs2) -> int:
+    """Number of key pairs of the two components that agree on the join legs."""
+    j1 = _h(c1.enum)[:, _leg_columns(c1.enum, join_legs1)]
+    j2 = _h(c2.enum)[:, _leg_columns(c2.enum, join_legs2)]
+    dim1 = rank(j1)
+    dim2 = rank(j2)
+    dim_intersection = dim1 + dim2 - rank(GF2(np.vstack([j1, j2])))
+    return (c1.keys * c2.keys * 2**dim_intersection) // (2**dim1 * 2**dim2)
+
+
+def _merged(
+    c1: _Component,
+    c2: _Component,
+    join_legs1: List[Tuple],
+    join_legs2: List[Tuple],
+    truncate_length: Optional[int],
+) -> Tuple[_Component, int]:
+    """The component of merging c1 and c2 on the join legs, and the operation count."""
+    enum = c1.enum.conjoin(c2.enum, join_legs1, join_legs2)
+    pairs = _matching_pairs(c1, c2, join_legs1, join_legs2)
+    operations = c1.keys + c2.keys + pairs * c1.terms * c2.terms
+    tracable_legs = [leg for leg in c1.tracable_legs if leg not in join_legs1] + [
+        leg for leg in c2.tracable_legs if leg not in join_legs2
+    ]
+    component = _Component(enum, c1.nodes | c2.nodes, tracable_legs, truncate_length)
+    return component, operations
+
+
+def _node_components(
+    nodes: Dict[Any, StabilizerCodeTensorEnumerator],
+    open_legs_per_node: Dict[Any, List[Tuple]],
+) -> Dict[Any, _Component]:
+    return {
+        node_idx: _Component(
+            node,
+            {node_idx},
+            list(open_legs_per_node[node_idx]),
+            truncate_length=None,
+        )
+        for node_idx, node in nodes.items()
+    }
+
+
+def _replay_steps(
+    components: Dict[Any, _Component],
+    traces: List[Tuple],
+    truncate_length: Optional[int],
+) -> Iterator[Tuple[int, List[Tuple], str, _Component, _Component, _Component, int]]:
+    """Replays the fused steps of traces on the parity checks of the components.
+
+    Yields the step index, the fused traces, the kind of the step, the two input
+    components, the resulting one and the operation count of the step. components (the
+    component of each node) is kept by the root of the merged nodes along the way.
+    """
+    roots = UnionFind()
+    for step, fused in enumerate(fuse_traces(traces)):
+        node_idx1, node_idx2, _, _ = fused[0]
+        join_legs1 = [leg for _, _, legs1, _ in fused for leg in legs1]
+        join_legs2 = [leg for _, _, _, legs2 in fused for leg in legs2]
+        root1, root2 = roots.find(node_idx1), roots.find(node_idx2)
+        c1 = components[root1]
+        c2 = components[root2]
+        if c1 is c2:
+            kind = "self_trace"
+            enum = c1.enum.self_trace(join_legs1, join_legs2)
+            nodes_in_component = c1.nodes
+            operations = c1.keys
+            tracable_legs = [
+                leg
+                for leg in c1.tracable_legs
+                if leg not in join_legs1 and leg not in join_legs2
+            ]
+            component = _Component(
+                enum, nodes_in_component, tracable_legs, truncate_length
+            )
+        else:
+            kind = "merge"
+            component, operations = _merged(
+                c1, c2, join_legs1, join_legs2, truncate_length
+            )
+            del components[root1], components[root2]
+        components[roots.union(root1, root2)] = component
+        yield step, fused, kind, c1, c2, component, operations
+
+
+def estimate_step_operations(
+    nodes: Dict[Any, StabilizerCodeTensorEnumerator],
+    traces: List[Tuple],
+    open_legs_per_node: Dict[Any, List[Tuple]],
+    truncate_length: Optional[int] = None,
+) -> List[int]:
+    """Operation counts of the fused steps of traces, as in estimate_contraction_cost.
+
+    The steps are replayed on parity checks as ints (see _BitComponent), cheap enough
+    to weigh the steps of a schedule before every contraction.
+    """
+    components = {
+        node_idx: _BitComponent.of_node(node, list(open_legs_per_node[node_idx]))
+        for node_idx, node in nodes.items()
+    }
+    # the component of each set of merged nodes, by its root
+    roots = UnionFind()
+    operations = []
+    for fused in fuse_traces(traces):
+        node_idx1, node_idx2, _, _ = fused[0]
+        join_legs1 = [leg for _, _, legs1, _ in fused for leg in legs1]
+        join_legs2 = [leg for _, _, _, legs2 in fused for leg in legs2]
+        root1, root2 = roots.find(node_idx1), roots.find(node_idx2)
+        c1 = components[root1]
+        c2 = components[root2]
+        if c1 is c2:
+            component, step_operations = c1.self_traced(
+                join_legs1, join_legs2, truncate_length
+            )
+        else:
+            component, step_operations = c1.merged(
+                c2, join_legs1, join_legs2, truncate_length
+            )
+            del components[root1], components[root2]
+        components[roots.union(root1, root2)] = component
+        operations.append(step_operations)
+    return operations
+
+
+def estimate_contraction_cost(
+    nodes: Dict[Any, StabilizerCodeTensorEnumerator],
+    traces: List[Tuple],
+    open_legs_per_node: Dict[Any, List[Tuple]],
+    truncate_length: Optional[int] = None,
+) -> ContractionCostReport:
+    """Predicts the cost of contracting nodes along traces without enumerating anything.
+
+    The same schedule is replayed on parity check matrices: the subnetwork of each PTE is
+    conjoined, and its key count is 2 to the GF2 rank of its parity check restricted to the
+    tracable legs of the PTE.
+    """
+    components = _node_components(nodes, open_legs_per_node)
+    live = {id(c): c for c in components.values()}
+    node_keys = sum(c.keys for c in live.values())
+    node_bytes = sum(c.bytes for c in live.values())
+    brute_force_operations = sum(2**c.generators for c in live.values())
+    peak_bytes = node_bytes
+    steps = []
+
+    for step, fused, kind, c1, c2, component, operations in _replay_steps(
+        components, traces, truncate_length
+    ):
+        live_bytes = sum(c.bytes for c in live.values())
+        del live[id(c1)]
+        live.pop(id(c2), None)
+        live[id(component)] = component
+
+        step_peak = live_bytes + component.bytes
+        peak_bytes = max(peak_bytes, step_peak)
+        steps.append(
+            ContractionStepCost(
+                step=step,
+                kind=kind,
+                traces=tuple(fused),
+                n_nodes=len(component.nodes),
+                legs=len(component.tracable_legs),
+                keys=component.keys,
+                terms_per_key=component.terms,
+                bytes=component.bytes,
+                operations=operations,
+                peak_bytes=step_peak,
+                generators=component.generators,
+            )
+        )
+
+    if len(live) > 1:
+        # disjoint components are tensored together at the end
+        keys = 1
+        legs = 0
+        terms = 1
+        for c in live.values():
+            keys *= c.keys
+            legs += len(c.tracable_legs)
+            terms *= c.terms
+        final_bytes = keys * estimate_entry_bytes(2 * legs, terms)
+        step_peak = sum(c.bytes for c in live.values()) + final_bytes
+        peak_bytes = max(peak_bytes, step_peak)
+        steps.append(
+            ContractionStepCost(
+                step=len(steps),
+                kind="tensor_product",
+                traces=(),
+                n_nodes=len(nodes),
+                legs=legs,
+                keys=keys,
+                terms_per_key=terms,
+                bytes=final_bytes,
+                operations=keys * terms,
+                peak_bytes=step_peak,
+            )
+        )
+
+    return ContractionCostReport(
+        steps=steps,
+        node_keys=node_keys,
+        node_bytes=node_bytes,
+        brute_force_operations=brute_force_operations,
+        peak_bytes=peak_bytes,
+        total_operations=brute_force_operations + sum(s.operations for s in steps),
+        max_keys=max([s.keys for s in steps], default=node_keys),
+        max_legs=max([s.legs for s in steps], default=0),
+    )
+
+
+class PTECostObjective(Objective):
+    """A cotengra objective that scores contraction trees by their estimated PTE cost.
+
+    cotengra's own model sees a dense tensor of 2**legs entries per subtree, while the
+    PTE of a subtree has 2 to the GF2 rank of its parity check restricted to its
+    tracable legs keys, each with a polynomial of up to dangling legs + 1 terms. The
+    contractions of a tree are replayed on conjoined parity checks as in
+    estimate_contraction_cost, memoized by their set of leaves, so the subtrees that
+    trials share are only estimated once.
+
+    minimize is "operations" (the total operation count) or "size" (the largest PTE in
+    bytes), the other one breaks ties. The trial's flops, write and size are reported
+    in the same units. Subtree reconfiguration optimizes cotengra's own flops or size
+    in place of it.
+    """
+
+    __slots__ = ("minimize", "truncate_length", "_joins", "_subtrees")
+
+    def __init__(
+        self,
+        nodes: Dict[Any, StabilizerCodeTensorEnumerator],
+        input_names: List[Any],
+        traces: List[Tuple],
+        open_legs_per_node: Dict[Any, List[Tuple]],
+        truncate_length: Optional[int] = None,
+        minimize: str = "operations",
+    ):
+        if minimize not in ("operations", "size"):
+            raise ValueError(f"Can't minimize {minimize}, only operations or size.")
+        self.minimize = minimize
+        self.truncate_length = truncate_length
+        leaf_of = {node_idx: i for i, node_idx in enumerate(input_names)}
+        # the legs traced to other leaves, by leaf: (other leaf, own legs, its legs)
+        self._joins = defaultdict(list)
+        for node_idx1, node_idx2, join_legs1, join_legs2 in traces:
+            leaf1, leaf2 = leaf_of[node_idx1], leaf_of[node_idx2]
+            if leaf1 != leaf2:
+                self._joins[leaf1].append((leaf2, join_legs1, join_legs2))
+                self._joins[leaf2].append((leaf1, join_legs2, join_legs1))
+        self._subtrees: Dict[frozenset, Tuple[_BitComponent, int]] = {
+            frozenset([leaf]): (
+                _BitComponent.of_node(
+                    nodes[node_idx], list(open_legs_per_node[node_idx])
+                ),
+                0,
+            )
+            for node_idx, leaf in leaf_of.items()
+        }
+
+    def __repr__(self):
+        return f"PTECostObjective(minimize={self.minimize})"
+
+    def get_dynamic_programming_minimize(self) -> str:
+        return "flops" if self.minimize == "operations" else "size"
+
+    def cost_local_tree_node(self, tree, node) -> float:
+        if self.minimize == "operations":
+            return tree.get_flops(node)
+        return tree.get_size(node)
+
+    def _subtree(self, parent: frozenset, l: frozenset, r: frozenset):
+        if parent not in self._subtrees:
+            join_legs1, join_legs2 = [], []
+            for leaf in l:
+                for other, legs, other_legs in self._joins[leaf]:
+                    if other in r:
+                        join_legs1 += legs
+                        join_legs2 += other_legs
+            self._subtrees[parent] = self._subtrees[l][0].merged(
+                self._subtrees[r][0], join_legs1, join_legs2, self.truncate_length
+            )
+        return self._subtrees[parent]
+
+    def __call__(self, trial) -> float:
+        operations = 0
+        max_bytes = 1
+        written = 0
+        for parent, l, r in trial["tree"].traverse():
+            component, step_operations = self._subtree(
+                frozenset(parent), frozenset(l), frozenset(r)
+            )
+            operations += step_operations
+            max_bytes = max(max_bytes, component.bytes)
+            written += component.bytes
+        trial["flops"] = max(operations, 1)
+        trial["write"] = max(written, 1)
+        trial["size"] = max_bytes
+        primary, secondary = math.log2(trial["flops"]), math.log2(max_bytes)
+        if self.minimize == "size":
+            primary, secondary = secondary, primary
+        return primary + 1e-3 * secondary
+
+
+# Cost of enumerating a single stabilizer by brute force, and the fixed cost of setting
+# up an enumeration, in units of the operations of a PTE step, measured on surface code
+# networks.
+BRUTE_FORCE_COST = 0.6
+BRUTE_FORCE_OVERHEAD = 1e4
+
+
+def _brute_force_cost(generators: int) -> float:
+    return BRUTE_FORCE_OVERHEAD + BRUTE_FORCE_COST * 2**generators
+
+
+@attrs.define
+class HybridDecision:
+    """How a subtree of the contraction schedule is computed, and the estimates for it.
+
+    step is the last step of the subtree. contract_operations is the cost of contracting
+    it (with the best strategy for each of its own subtrees), brute_force_operations the
+    cost of enumerating its conjoined parity check by brute force instead.
+    """
+
+    step: int
+    strategy: str
+    n_nodes: int
+    generators: int
+    legs: int
+    contract_operations: float
+    brute_force_operations: float
+
+
+@attrs.define
+class HybridPlan:
+    """The subtrees of a schedule to compute by brute force instead of contraction.
+
+    brute_force has the conjoined parity check, nodes and tracable legs (in the order of
+    the keys of the PTE) of each brute forced subtree, under its last step. The other
+    steps of those subtrees are in skipped.
+    """
+
+    decisions: List[HybridDecision]
+    brute_force: Dict[int, Tuple[StabilizerCodeTensorEnumerator, Set, List[Tuple]]]
+    skipped: Set[int]
+
+
+def plan_hybrid_contraction(
+    nodes: Dict[Any, StabilizerCodeTensorEnumerator],
+    traces: List[Tuple],
+    open_legs_per_node: Dict[Any, List[Tuple]],
+    truncate_length: Optional[int] = None,
+    excluded_nodes: Set = frozenset(),
+) -> HybridPlan:
+    """Picks for each subtree of the schedule whether to contract it or brute force it.
+
+    A subtree is brute forced when enumerating the 2**generators stabilizers of its
+    conjoined parity check (see BRUTE_FORCE_COST) is estimated to be cheaper than
+    enumerating its node tensors and contracting them, which is the case for
+    subnetworks with few generators but many tracable legs. Subtrees with excluded_nodes
+    are always contracted. The largest subtrees are decided first, and a brute forced
+    subtree is not looked into any further.
+    """
+    components = _node_components(nodes, open_legs_per_node)
+    node_cost = {
+        node_idx: _brute_force_cost(c.generators)
+        for node_idx, c in components.items()
+    }
+    nodes_of = UnionFind()
+    last_step: Dict[Any, int] = {}
+    children: List[List[int]] = []
+    contract_cost: List[float] = []
+    brute_force_cost: List[float] = []
+    eligible: List[bool] = []
+    candidates = {}
+    sizes = []
+
+    for step, fused, _, _, _, component, operations in _replay_steps(
+        components, traces, truncate_length
+    ):
+        node_idx1, node_idx2, _, _ = fused[0]
+        step_children = []
+        cost = operations
+        for node_idx in {nodes_of.find(node_idx1), nodes_of.find(node_idx2)}:
+            if node_idx in last_step:
+                child = last_step.pop(node_idx)
+                step_children.append(child)
+                cost += min(contract_cost[child], brute_force_cost[child])
+            else:
+                # the root of a component without steps is its only node
+                cost += node_cost[node_idx]
+        last_step[nodes_of.union(node_idx1, node_idx2)] = step
+        children.append(step_children)
+        contract_cost.append(cost)
+        eligible.append(
+            all(eligible[c] for c in step_children)
+            and excluded_nodes.isdisjoint((node_idx1, node_idx2))
+        )
+        brute_force_cost.append(
+            _brute_force_cost(component.generators) if eligible[-1] else math.inf
+        )
+        if brute_force_cost[-1] <= cost:
+            candidates[step] = (
+                component.enum,
+                component.nodes,
+                list(component.tracable_legs),
+            )
+        sizes.append(
+            (len(component.nodes), component.generators, len(component.tracable_legs))
+        )
+
+    decisions = []
+    brute_force = {}
+    skipped = set()
+    stack = list(last_step.values())
+    while stack:
+        step = stack.pop()
+        n_nodes, generators, legs = sizes[step]
+        chosen = "brute_force" if step in candidates else "contract"
+        decisions.append(
+            HybridDecision(
+                step=step,
+                strategy=chosen,
+                n_nodes=n_nodes,
+                generators=generators,
+                legs=legs,
+                contract_operations=contract_cost[step],
+                brute_force_operations=brute_force_cost[step],
+            )
+        )
+        if chosen == "brute_force":
+            brute_force[step] = candidates[step]
+            below = list(children[step])
+            while below:
+                child = below.pop()
+                skipped.add(child)
+                below.extend(children[child])
+        else:
+            stack.extend(children[step])
+    decisions.sort(key=lambda d: d.step)
+    return HybridPlan(decisions=decisions, brute_force=brute_force, skipped=skipped)
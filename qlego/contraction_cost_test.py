@@ -0,0 +1,187 @@
+import cotengra as ctg
+import pytest
+
+from qlego.codes.compass_code import CompassCodeTN
+from qlego.codes.rotated_surface_code import RotatedSurfaceCodeTN
+from qlego import contraction_cost
+from qlego.contraction_cost import (
+    ContractionCostReport,
+    PTECostObjective,
+    estimate_contraction_cost,
+    estimate_step_operations,
+    plan_hybrid_contraction,
+)
+from qlego.legos import Legos
+from qlego.stabilizer_tensor_enumerator import StabilizerCodeTensorEnumerator
+from qlego.tensor_network import TensorNetwork, _PartiallyTracedEnumerator
+
+
+def _record_pte_sizes(monkeypatch):
+    sizes = []
+    merge_with = _PartiallyTracedEnumerator.merge_with
+    self_trace = _PartiallyTracedEnumerator.self_trace
+
+    def recording_merge_with(self, *args, **kwargs):
+        res = merge_with(self, *args, **kwargs)
+        sizes.append(len(res.tensor))
+        return res
+
+    def recording_self_trace(self, *args, **kwargs):
+        res = self_trace(self, *args, **kwargs)
+        sizes.append(len(res.tensor))
+        return res
+
+    monkeypatch.setattr(_PartiallyTracedEnumerator, "merge_with", recording_merge_with)
+    monkeypatch.setattr(_PartiallyTracedEnumerator, "self_trace", recording_self_trace)
+    return sizes
+
+
+def test_estimated_keys_match_contraction(monkeypatch):
+    report = RotatedSurfaceCodeTN(d=3).estimate_cost(cotengra=False)
+    assert isinstance(report, ContractionCostReport)
+
+    sizes = _record_pte_sizes(monkeypatch)
+    RotatedSurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(cotengra=False)
+
+    assert [s.keys for s in report.steps] == sizes
+    assert report.max_keys == max(sizes)
+    assert report.steps[-1].legs == 0
+    assert report.peak_bytes >= max(s.bytes for s in report.steps)
+    assert report.total_operations > report.brute_force_operations
+
+
+def test_estimated_keys_match_contraction_with_open_legs(monkeypatch):
+    open_legs = [((0, 0), 4), ((2, 2), 4)]
+    tn = CompassCodeTN([[1, 1], [2, 1]])
+    report = tn.estimate_cost(open_legs=open_legs, cotengra=False)
+
+    sizes = _record_pte_sizes(monkeypatch)
+    tensor = CompassCodeTN([[1, 1], [2, 1]]).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False
+    )
+
+    assert [s.keys for s in report.steps] == sizes
+    assert report.steps[-1].keys == len(tensor)
+    assert report.steps[-1].legs == len(open_legs)
+
+
+def test_truncation_bounds_terms_per_key():
+    report = RotatedSurfaceCodeTN(d=3).estimate_cost(cotengra=False, truncate_length=2)
+    assert all(s.terms_per_key == 1 for s in report.steps)
+    assert "peak bytes" in str(report)
+
+
+def _plan_rsc(d, excluded_nodes=frozenset()):
+    tn = RotatedSurfaceCodeTN(d=d)
+    free_legs, _, _ = tn._collect_legs()
+    return plan_hybrid_contraction(
+        tn.nodes,
+        tn.traces,
+        tn._open_legs_per_node(free_legs, []),
+        excluded_nodes=excluded_nodes,
+    )
+
+
+def test_hybrid_plan_follows_the_cost_model(monkeypatch):
+    monkeypatch.setattr(contraction_cost, "BRUTE_FORCE_OVERHEAD", 0)
+    monkeypatch.setattr(contraction_cost, "BRUTE_FORCE_COST", 0)
+    # the schedule grows a single PTE from the excluded node
+    plan = _plan_rsc(3, excluded_nodes={(0, 0)})
+    assert plan.brute_force == {} and plan.skipped == set()
+    assert all(d.strategy == "contract" for d in plan.decisions)
+    assert [d.step for d in plan.decisions] == list(range(len(plan.decisions)))
+
+    plan = _plan_rsc(3)
+    # the whole network is a single brute forced subtree
+    [decision] = plan.decisions
+    assert decision.strategy == "brute_force"
+    assert decision.n_nodes == 9 and decision.generators == 8 and decision.legs == 0
+    assert list(plan.brute_force) == [decision.step]
+    assert plan.skipped == set(range(decision.step))
+
+
+def test_pte_objective_matches_the_cost_estimate():
+    tn = RotatedSurfaceCodeTN(d=3)
+    free_legs, leg_indices, index_to_legs = tn._collect_legs()
+    open_legs_per_node = tn._open_legs_per_node(free_legs, [((0, 0), 4), ((2, 2), 4)])
+    tree = tn._cotengra_tree_from_traces(free_legs, leg_indices, index_to_legs)
+    inputs, _, _, input_names = tn._prep_cotengra_inputs(leg_indices, free_legs)
+    traces = tn._traces_from_cotengra_tree(tree, index_to_legs, inputs)
+
+    report = estimate_contraction_cost(tn.nodes, traces, open_legs_per_node)
+    objective = PTECostObjective(tn.nodes, input_names, tn.traces, open_legs_per_node)
+    trial = {"tree": tree}
+    objective(trial)
+
+    assert trial["flops"] == sum(s.operations for s in report.steps)
+    assert trial["size"] == max(s.bytes for s in report.steps)
+    with pytest.raises(ValueError):
+        PTECostObjective(tn.nodes, input_names, tn.traces, {}, minimize="flops")
+
+
+def test_pte_objectives_plan_contractions():
+    tn = RotatedSurfaceCodeTN(d=3)
+    free_legs, leg_indices, index_to_legs = tn._collect_legs()
+    inputs, output, size_dict, input_names = tn._prep_cotengra_inputs(
+        leg_indices, free_legs
+    )
+    open_legs_per_node = tn._open_legs_per_node(free_legs, [])
+    for minimize in ("operations", "size"):
+        objective = PTECostObjective(
+            tn.nodes, input_names, tn.traces, open_legs_per_node, minimize=minimize
+        )
+        # subtree reconfiguration scores subtrees with the objective's local costs
+        opt = ctg.HyperOptimizer(
+            minimize=objective,
+            reconf_opts={},
+            max_repeats=4,
+            parallel=False,
+            on_trial_error="raise",
+        )
+        opt.search(inputs, output, size_dict)
+
+    open_legs = [((0, 0), 4), ((2, 2), 4)]
+    expected = RotatedSurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False
+    )
+    for minimize in ("pte", "pte-size"):
+        tn = RotatedSurfaceCodeTN(d=3)
+        assert tn.estimate_cost(
+            open_legs=open_legs, cotengra_minimize=minimize
+        ).total_operations > 0
+        assert (
+            tn.stabilizer_enumerator_polynomial(
+                open_legs=open_legs, cotengra_minimize=minimize
+            )
+            == expected
+        )
+
+
+def test_step_operations_match_the_cost_estimate():
+    tn = TensorNetwork(
+        [
+            StabilizerCodeTensorEnumerator(Legos.enconding_tensor_512, idx=i)
+            for i in range(3)
+        ]
+    )
+    tn.self_trace(1, 1, [1], [2])
+    tn.self_trace(0, 1, [0], [0])
+    tn.self_trace(1, 2, [3], [3])
+    tn.self_trace(2, 2, [0], [4])
+    tn.self_trace(0, 2, [3], [1])
+    networks = [
+        (tn, []),
+        (RotatedSurfaceCodeTN(d=5, truncate_length=3), [((4, 4), 4)]),
+    ]
+    kinds = set()
+    for tn, open_legs in networks:
+        free_legs, _, _ = tn._collect_legs()
+        open_legs_per_node = tn._open_legs_per_node(free_legs, open_legs)
+        report = estimate_contraction_cost(
+            tn.nodes, tn.traces, open_legs_per_node, tn.truncate_length
+        )
+        assert estimate_step_operations(
+            tn.nodes, tn.traces, open_legs_per_node, tn.truncate_length
+        ) == [s.operations for s in report.steps]
+        kinds |= {s.kind for s in report.steps}
+    assert kinds == {"merge", "self_trace"}
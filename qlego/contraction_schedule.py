@@ -0,0 +1,252 @@
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import attrs
+
+Trace = Tuple[Any, Any, List[Tuple], List[Tuple]]
+
+
+class UnionFind:
+    """Disjoint sets of hashable items with union by size and path halving.
+
+    Items are added on first use, as singletons.
+    """
+
+    def __init__(self):
+        self._parent: Dict[Any, Any] = {}
+        self._size: Dict[Any, int] = {}
+
+    def find(self, item: Any) -> Any:
+        """The root of the set of item."""
+        parent = self._parent
+        while True:
+            p = parent.get(item, item)
+            if p == item:
+                return item
+            grandparent = parent.get(p, p)
+            parent[item] = grandparent
+            item = grandparent
+
+    def union(self, item1: Any, item2: Any) -> Any:
+        """Merges the sets of item1 and item2, returns the root of the merged set."""
+        root1 = self.find(item1)
+        root2 = self.find(item2)
+        if root1 == root2:
+            return root1
+        size1 = self._size.get(root1, 1)
+        size2 = self._size.get(root2, 1)
+        if size1 < size2:
+            root1, root2 = root2, root1
+        self._parent[root2] = root1
+        self._size[root1] = size1 + size2
+        self._size.pop(root2, None)
+        return root1
+
+
+def fuse_traces(traces: List[Trace]) -> List[List[Trace]]:
+    """Groups single leg traces into multi-leg contraction steps.
+
+    When a trace joins two components, every remaining trace between the same two
+    components is pulled into the same step, so the components are merged once on all
+    shared legs instead of one merge followed by self traces over a larger intermediate.
+    Traces within a single component are grouped with the consecutive ones within the same
+    component into one multi-leg self trace.
+
+    Each step is a list of traces oriented so that node_idx1 is always in the same component
+    (the first trace's node_idx1's).
+    """
+    component: Dict[Any, Set[Any]] = {}
+
+    def comp(node_idx):
+        if node_idx not in component:
+            component[node_idx] = {node_idx}
+        return component[node_idx]
+
+    traces_of_node = defaultdict(list)
+    for i, (node_idx1, node_idx2, _, _) in enumerate(traces):
+        traces_of_node[node_idx1].append(i)
+        traces_of_node[node_idx2].append(i)
+
+    done = [False] * len(traces)
+    steps = []
+    i = 0
+    while i < len(traces):
+        if done[i]:
+            i += 1
+            continue
+        node_idx1, node_idx2, _, _ = traces[i]
+        c1 = comp(node_idx1)
+        c2 = comp(node_idx2)
+        step = [traces[i]]
+        done[i] = True
+
+        if c1 is c2:
+            j = i + 1
+            while j < len(traces):
+                if not done[j]:
+                    n1, n2, _, _ = traces[j]
+                    if comp(n1) is not c1 or comp(n2) is not c1:
+                        break
+                    step.append(traces[j])
+                    done[j] = True
+                j += 1
+        else:
+            smaller, larger = (c1, c2) if len(c1) <= len(c2) else (c2, c1)
+            for node_idx in smaller:
+                for j in traces_of_node[node_idx]:
+                    if done[j]:
+                        continue
+                    n1, n2, legs1, legs2 = traces[j]
+                    if comp(n1) is c1 and comp(n2) is c2:
+                        step.append(traces[j])
+                    elif comp(n1) is c2 and comp(n2) is c1:
+                        step.append((n2, n1, legs2, legs1))
+                    else:
+                        continue
+                    done[j] = True
+            larger.update(smaller)
+            for node_idx in smaller:
+                component[node_idx] = larger
+        steps.append(step)
+        i += 1
+    return steps
+
+
+def step_dependencies(steps: List[List[Trace]]) -> List[List[int]]:
+    """For each step, the earlier steps whose results it consumes.
+
+    A step consumes the PTEs of the components of its two nodes, each of which is the
+    result of the last step on that component, or a node tensor if there was none. Every
+    result is consumed at most once, so the steps form a forest.
+    """
+    components = UnionFind()
+    last_step: Dict[Any, int] = {}
+    deps = []
+    for i, step in enumerate(steps):
+        node_idx1, node_idx2, _, _ = step[0]
+        roots = {components.find(node_idx1), components.find(node_idx2)}
+        deps.append(sorted(last_step.pop(r) for r in roots if r in last_step))
+        last_step[components.union(node_idx1, node_idx2)] = i
+    return deps
+
+
+@attrs.define
+class SubtreeTask:
+    """A connected subtree of the step forest, run as a unit.
+
+    steps are step indices in a valid execution order, deps the indices of the tasks
+    whose results the subtree consumes.
+    """
+
+    steps: List[int]
+    deps: List[int]
+    weight: float
+
+
+def subtree_tasks(
+    steps: List[List[Trace]],
+    weights: Sequence[float],
+    max_weight: float,
+    deps: Optional[List[List[int]]] = None,
+) -> List[SubtreeTask]:
+    """Cuts the step forest into subtree tasks of at most max_weight total step weight.
+
+    Bottom up, a step is merged with the tasks of its inputs if their total weight stays
+    within max_weight, and starts a new task depending on them otherwise. Steps heavier
+    than max_weight get a task of their own. The tasks are in a valid execution order.
+    """
+    if deps is None:
+        deps = step_dependencies(steps)
+    tasks: List[Optional[SubtreeTask]] = []
+    task_of_step: List[int] = []
+    for i, step_deps in enumerate(deps):
+        children = [task_of_step[d] for d in step_deps]
+        weight = weights[i] + sum(tasks[t].weight for t in children)
+        if weight <= max_weight:
+            task = SubtreeTask(
+                steps=[s for t in children for s in tasks[t].steps] + [i],
+                deps=[d for t in children for d in tasks[t].deps],
+                weight=weight,
+            )
+            for t in children:
+                tasks[t] = None
+        else:
+            task = SubtreeTask(steps=[i], deps=children, weight=weights[i])
+        task_of_step.append(len(tasks))
+        tasks.append(task)
+
+    new_index = {}
+    for t, task in enumerate(tasks):
+        if task is not None:
+            new_index[t] = len(new_index)
+    res = [task for task in tasks if task is not None]
+    for task in res:
+        task.deps = [new_index[d] for d in task.deps]
+    return res
+
+
+# Orders of the nodes of a lattice for sweep_schedule, by their (r, c) coordinates.
+SWEEPS = {
+    "rows": lambda r, c: (r, c),
+    "columns": lambda r, c: (c, r),
+    "diagonals": lambda r, c: (r + c, r),
+    "antidiagonals": lambda r, c: (r - c, r),
+}
+
+
+@attrs.define
+class SweepPlan:
+    direction: str
+    traces: List[Trace]
+    # the most traced legs of any PTE of the contraction, the frontier of the sweep
+    max_frontier: int
+
+
+def max_traced_legs(traces: List[Trace]) -> int:
+    """The most legs traced to the rest of the network of any PTE of the contraction.
+
+    Open and dangling legs are not counted, they are the same for every schedule.
+    """
+    legs = defaultdict(int)
+    for node_idx1, node_idx2, join_legs1, _ in traces:
+        legs[node_idx1] += len(join_legs1)
+        legs[node_idx2] += len(join_legs1)
+    components = UnionFind()
+    res = 0
+    for step in fuse_traces(traces):
+        n_legs = sum(len(join_legs1) for _, _, join_legs1, _ in step)
+        root1 = components.find(step[0][0])
+        root2 = components.find(step[0][1])
+        if root1 == root2:
+            merged = legs[root1] - 2 * n_legs
+        else:
+            merged = legs[root1] + legs[root2] - 2 * n_legs
+        root = components.union(root1, root2)
+        legs[root] = merged
+        res = max(res, merged)
+    return res
+
+
+def sweep_schedule(
+    traces: List[Trace],
+    coordinates: Dict[Any, Tuple[int, int]],
+    directions: Optional[Sequence[str]] = None,
+) -> SweepPlan:
+    """Orders the traces to sweep across a lattice of nodes, one node at a time.
+
+    The traces of a node to the swept ones come when the sweep reaches it, so the PTEs
+    only have legs on the frontier of the sweep. Of the given directions (default: all
+    SWEEPS), the sweep with the smallest max_frontier wins.
+    """
+    best = None
+    for direction in directions if directions is not None else SWEEPS:
+        order = sorted(coordinates, key=lambda n: SWEEPS[direction](*coordinates[n]))
+        position = {node_idx: i for i, node_idx in enumerate(order)}
+        traces_at = defaultdict(list)
+        for trace in traces:
+            traces_at[max(position[trace[0]], position[trace[1]])].append(trace)
+        swept = [trace for i in range(len(order)) for trace in traces_at[i]]
+        max_frontier = max_traced_legs(swept)
+        if best is None or max_frontier < best.max_frontier:
+            best = SweepPlan(direction, swept, max_frontier)
+    return best
@@ -0,0 +1,158 @@
+from qlego.contraction_schedule import (
+    UnionFind,
+    fuse_traces,
+    step_dependencies,
+    subtree_tasks,
+    max_traced_legs,
+    sweep_schedule,
+)
+from qlego.codes.compass_code import CompassCodeTN
+from qlego.codes.rotated_surface_code import RotatedSurfaceCodeTN
+from qlego.codes.surface_code import SurfaceCodeTN
+from qlego.legos import Legos
+from qlego.tensor_network import (
+    StabilizerCodeTensorEnumerator,
+    TensorNetwork,
+    _PartiallyTracedEnumerator,
+)
+
+
+def test_fuse_traces_groups_traces_between_the_same_components():
+    t_ab0 = ("a", "b", [("a", 0)], [("b", 0)])
+    t_bc = ("b", "c", [("b", 1)], [("c", 0)])
+    t_ab1 = ("a", "b", [("a", 1)], [("b", 2)])
+    t_ca = ("c", "a", [("c", 1)], [("a", 2)])
+    t_ac = ("a", "c", [("a", 3)], [("c", 2)])
+
+    assert fuse_traces([t_ab0, t_bc, t_ab1, t_ca, t_ac]) == [
+        [t_ab0, t_ab1],
+        # the c -> a trace is flipped to be oriented the same way as b -> c
+        [t_bc, ("a", "c", [("a", 2)], [("c", 1)]), t_ac],
+    ]
+
+
+def test_fuse_traces_groups_consecutive_self_traces():
+    t_ab = ("a", "b", [("a", 0)], [("b", 0)])
+    t_bc = ("b", "c", [("b", 1)], [("c", 0)])
+    t_aa = ("a", "a", [("a", 1)], [("a", 2)])
+    t_bb = ("b", "b", [("b", 2)], [("b", 3)])
+    t_cd = ("c", "d", [("c", 1)], [("d", 0)])
+    t_cc = ("c", "c", [("c", 2)], [("c", 3)])
+
+    assert fuse_traces([t_ab, t_aa, t_bb, t_bc, t_cd, t_cc]) == [
+        [t_ab],
+        [t_aa, t_bb],
+        [t_bc],
+        [t_cd],
+        [t_cc],
+    ]
+
+
+def test_shared_legs_are_merged_in_one_step(monkeypatch):
+    calls = []
+    merge_with = _PartiallyTracedEnumerator.merge_with
+    self_trace = _PartiallyTracedEnumerator.self_trace
+
+    def recording_merge_with(self, pte2, join_legs1, join_legs2, **kwargs):
+        calls.append(("merge", len(join_legs1)))
+        return merge_with(self, pte2, join_legs1, join_legs2, **kwargs)
+
+    def recording_self_trace(self, join_legs1, join_legs2, **kwargs):
+        calls.append(("self_trace", len(join_legs1)))
+        return self_trace(self, join_legs1, join_legs2, **kwargs)
+
+    monkeypatch.setattr(_PartiallyTracedEnumerator, "merge_with", recording_merge_with)
+    monkeypatch.setattr(_PartiallyTracedEnumerator, "self_trace", recording_self_trace)
+
+    def four_traces_422_into_422():
+        tn = TensorNetwork(
+            [
+                StabilizerCodeTensorEnumerator(Legos.stab_code_parity_422, idx=0),
+                StabilizerCodeTensorEnumerator(Legos.stab_code_parity_422, idx=1),
+            ]
+        )
+        for leg in range(4):
+            tn.self_trace(0, 1, [leg], [leg])
+        return tn
+
+    expected = four_traces_422_into_422().conjoin_nodes()
+    wep = four_traces_422_into_422().stabilizer_enumerator_polynomial(cotengra=False)
+
+    assert calls == [("merge", 4)]
+    assert wep == expected.stabilizer_enumerator_polynomial()
+
+
+def test_union_find():
+    components = UnionFind()
+    assert components.find("a") == "a"
+    root = components.union("a", "b")
+    assert components.find("a") == components.find("b") == root
+    components.union("c", "d")
+    components.union("d", "e")
+    assert components.find("a") != components.find("e")
+    root = components.union("b", "e")
+    assert {components.find(x) for x in "abcde"} == {root}
+    assert components.union("a", "c") == root
+
+
+def test_traces_round_trip_through_a_cotengra_tree():
+    tn = TensorNetwork(
+        [
+            StabilizerCodeTensorEnumerator(Legos.enconding_tensor_512, idx=i)
+            for i in range(6)
+        ]
+    )
+    for i in range(5):
+        tn.self_trace(i, i + 1, [1], [0])
+    tn.self_trace(0, 5, [2], [2])
+
+    free_legs, leg_indices, index_to_legs = tn._collect_legs()
+    assert len(free_legs) == 6 * 5 - 12
+    tree = tn._cotengra_tree_from_traces(free_legs, leg_indices, index_to_legs)
+    inputs, _, _, _ = tn._prep_cotengra_inputs(leg_indices, free_legs)
+    traces = tn._traces_from_cotengra_tree(tree, index_to_legs, inputs)
+    assert sorted(map(str, traces)) == sorted(map(str, tn.traces))
+
+
+def test_subtree_tasks():
+    # ((a b) (c d)) e, then a self trace
+    steps = fuse_traces(
+        [
+            ("a", "b", [("a", 0)], [("b", 0)]),
+            ("c", "d", [("c", 0)], [("d", 0)]),
+            ("b", "c", [("b", 1)], [("c", 1)]),
+            ("d", "e", [("d", 1)], [("e", 0)]),
+            ("a", "a", [("a", 1)], [("a", 2)]),
+        ]
+    )
+    assert step_dependencies(steps) == [[], [], [0, 1], [2], [3]]
+
+    tasks = subtree_tasks(steps, [1, 1, 1, 1, 1], max_weight=5)
+    assert [(t.steps, t.deps) for t in tasks] == [([0, 1, 2, 3, 4], [])]
+
+    tasks = subtree_tasks(steps, [1, 1, 4, 1, 1], max_weight=3)
+    assert [(t.steps, t.deps) for t in tasks] == [
+        ([0], []),
+        ([1], []),
+        ([2], [0, 1]),
+        ([3, 4], [2]),
+    ]
+
+
+def test_sweeps_have_a_frontier_linear_in_the_distance():
+    for d in (3, 5, 7):
+        rsc = RotatedSurfaceCodeTN(d=d)
+        plan = rsc.sweep_plan()
+        assert plan.direction == "rows" and plan.max_frontier == d + 1
+        assert sorted(plan.traces) == sorted(rsc.traces)
+        surface = SurfaceCodeTN(d=d).sweep_plan()
+        assert surface.direction == "antidiagonals"
+        assert surface.max_frontier == 2 * (d - 1)
+
+    compass = CompassCodeTN([[1, 1], [2, 1]])
+    assert compass.sweep_plan().max_frontier == 4
+    diagonal = sweep_schedule(
+        rsc.traces, rsc.node_coordinates(), directions=["diagonals"]
+    )
+    assert diagonal.direction == "diagonals" and diagonal.max_frontier == 12
+    assert max_traced_legs(rsc.traces) == diagonal.max_frontier
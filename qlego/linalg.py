@@ -55,6 +55,17 @@ def gauss(mx, noswaps=False, col_subset=None):
     return res
 
 
+def rank(mx):
+    """Rank of a GF2 matrix."""
+    if not isinstance(mx, GF2):
+        raise ValueError(f"Matrix is not of GF2 type, but instead {type(mx)}")
+    if len(mx.shape) == 1:
+        return int(np.count_nonzero(mx) > 0)
+    if mx.shape[0] == 0 or mx.shape[1] == 0:
+        return 0
+    return int(np.count_nonzero(np.any(gauss(mx) != 0, axis=1)))
+
+
 def gauss_row_augmented(mx):
     (rows, cols) = mx.shape
     res: np.ndarray = deepcopy(mx)
@@ -1,7 +1,7 @@
 from galois import GF2
 import numpy as np
 
-from qlego.linalg import gauss, right_kernel
+from qlego.linalg import gauss, rank, right_kernel
 
 
 def test_right_kernel():
@@ -86,3 +86,11 @@ def test_gauss_col_subset_fail_to_extract():
             ]
         ),
     )
+
+
+def test_rank():
+    assert rank(GF2([[1, 1, 0], [0, 1, 1], [1, 0, 1]])) == 2
+    assert rank(GF2([[1, 0, 0], [0, 1, 0], [0, 0, 1]])) == 3
+    assert rank(GF2([[0, 0], [0, 0]])) == 0
+    assert rank(GF2([1, 0])) == 1
+    assert rank(GF2.Zeros((2, 0))) == 0
@@ -0,0 +1,127 @@
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from qlego.simple_poly import SimplePoly
+
+Leg = Tuple[Any, int]
+Tensor = Dict[Tuple[int, ...], SimplePoly]
+
+# Maps the (x, z) bits on the dropped legs to the weight they add, None drops the key
+_Contribution = Callable[[List[Tuple[int, int]]], Optional[int]]
+
+
+def _weighted(paulis: List[Tuple[int, int]]) -> int:
+    return sum(1 for x, z in paulis if x or z)
+
+
+class OpenLegTensor:
+    """A tensor keyed by the Paulis on open legs, answering queries on fewer legs.
+
+    tensor is what stabilizer_enumerator_polynomial returns with open_legs: keys are the
+    X bits of the legs followed by their Z bits, values the unnormalized enumerators of
+    the rest of the network. Summing out a leg (with the weight of its Pauli) or fixing
+    its Pauli gives the tensor with that leg closed, without contracting again.
+
+    With a truncate_length, terms of a higher degree are dropped, as in the truncated
+    contraction.
+
+    On a coset, the keys are the Paulis of the stabilizers and flips maps the open legs
+    with a coset flipped Pauli to its (x, z) bits. Closing a leg weighs, fixes or drops
+    the Pauli of the coset element, the key flipped by it.
+    """
+
+    def __init__(
+        self,
+        open_legs: Sequence[Leg],
+        tensor: Tensor,
+        truncate_length: Optional[int] = None,
+        flips: Optional[Dict[Leg, Tuple[int, int]]] = None,
+    ):
+        self.open_legs = list(open_legs)
+        self.tensor = tensor
+        self.truncate_length = truncate_length
+        self.flips = dict(flips) if flips is not None else {}
+
+    def __str__(self):
+        return f"OpenLegTensor[{len(self.tensor)} keys on {self.open_legs}]"
+
+    def __repr__(self):
+        return str(self)
+
+    def _positions(self, legs: Sequence[Leg]) -> List[int]:
+        missing = [leg for leg in legs if leg not in self.open_legs]
+        if missing:
+            raise ValueError(f"Legs {missing} are not open in {self}")
+        return [self.open_legs.index(leg) for leg in legs]
+
+    def _reduce(self, kept: List[Leg], contribution: _Contribution) -> "OpenLegTensor":
+        n = len(self.open_legs)
+        kept_positions = self._positions(kept)
+        dropped_positions = [i for i in range(n) if i not in kept_positions]
+        dropped_flips = [
+            self.flips.get(self.open_legs[i], (0, 0)) for i in dropped_positions
+        ]
+        res: Tensor = {}
+        for key, poly in self.tensor.items():
+            shift = contribution(
+                [
+                    (key[i] ^ fx, key[i + n] ^ fz)
+                    for i, (fx, fz) in zip(dropped_positions, dropped_flips)
+                ]
+            )
+            if shift is None:
+                continue
+            new_key = tuple(key[i] for i in kept_positions) + tuple(
+                key[i + n] for i in kept_positions
+            )
+            terms = {
+                power + shift: coeff
+                for power, coeff in poly._dict.items()
+                if self.truncate_length is None
+                or power + shift <= self.truncate_length
+            }
+            res.setdefault(new_key, SimplePoly()).add_inplace(SimplePoly(terms))
+        return OpenLegTensor(
+            kept,
+            res,
+            self.truncate_length,
+            {leg: flip for leg, flip in self.flips.items() if leg in kept},
+        )
+
+    def _without(self, legs: Sequence[Leg]) -> List[Leg]:
+        self._positions(legs)
+        return [leg for leg in self.open_legs if leg not in legs]
+
+    def marginalized(self, legs: Sequence[Leg]) -> "OpenLegTensor":
+        """Sums out legs, counting their Paulis in the weight like any dangling leg."""
+        return self._reduce(self._without(legs), _weighted)
+
+    def sliced(self, leg_values: Dict[Leg, Tuple[int, int]]) -> "OpenLegTensor":
+        """Fixes the Pauli, as (x, z) bits, on some legs and removes them."""
+        values = [
+            tuple(leg_values[leg]) for leg in self.open_legs if leg in leg_values
+        ]
+        return self._reduce(
+            self._without(list(leg_values)),
+            lambda paulis: 0 if paulis == values else None,
+        )
+
+    def punctured(self, legs: Sequence[Leg]) -> "OpenLegTensor":
+        """Sums out legs without counting their Paulis, as if the qubits were gone."""
+        return self._reduce(self._without(legs), lambda paulis: 0)
+
+    def shortened(self, legs: Sequence[Leg]) -> "OpenLegTensor":
+        """Keeps the stabilizers with the identity on legs, then removes the legs."""
+        return self.sliced({leg: (0, 0) for leg in legs})
+
+    def query(self, open_legs: Sequence[Leg] = ()) -> Union[SimplePoly, Tensor]:
+        """What stabilizer_enumerator_polynomial returns for a subset of the open legs.
+
+        The other legs are marginalized. Without open_legs, this is the normalized
+        scalar enumerator, otherwise the tensor keyed by the Paulis on open_legs in
+        their order.
+        """
+        open_legs = list(open_legs)
+        reduced = self._reduce(open_legs, _weighted)
+        if len(open_legs) > 0:
+            return reduced.tensor
+        return reduced.tensor.get((), SimplePoly()).normalize()
@@ -0,0 +1,102 @@
+from collections import Counter
+import itertools
+
+import numpy as np
+import pytest
+
+from qlego.codes.surface_code import SurfaceCodeTN
+from qlego.open_leg_tensor import OpenLegTensor
+from qlego.simple_poly import SimplePoly
+
+LEGS = [((0, 0), 4), ((2, 2), 4), ((4, 4), 4)]
+
+
+def _brute_force_enumerator(tn, weigh) -> SimplePoly:
+    """Counts the coset elements by weigh({leg: whether the Pauli on it is not I})."""
+    code = tn.conjoin_nodes()
+    h = np.array(code.h, dtype=int)
+    coset = np.zeros(2 * code.n, dtype=int)
+    for node in tn.nodes.values():
+        for leg, pauli in node.coset_flipped_legs:
+            q = code.legs.index(leg)
+            coset[q], coset[q + code.n] = int(pauli[0]), int(pauli[1])
+    stabilizers = {
+        tuple(((h[list(rows)].sum(axis=0) + coset) % 2).tolist())
+        for r in range(len(h) + 1)
+        for rows in itertools.combinations(range(len(h)), r)
+    }
+    counts = Counter()
+    for s in stabilizers:
+        paulis = {leg: s[q] or s[q + code.n] for q, leg in enumerate(code.legs)}
+        w = weigh(paulis)
+        if w is not None:
+            counts[w] += 1
+    return SimplePoly(dict(counts)).normalize()
+
+
+def test_queries_match_contraction():
+    tn = SurfaceCodeTN(d=3)
+    tensor = tn.open_leg_tensor(LEGS, cotengra=False)
+    assert tensor.open_legs == LEGS
+
+    for query in ([], LEGS[:1], [LEGS[2], LEGS[0]]):
+        expected = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+            open_legs=query, cotengra=False
+        )
+        assert tensor.query(query) == expected
+        # answered from the cached tensor, without contracting again
+        assert tn.stabilizer_enumerator_polynomial(open_legs=query) == expected
+
+    with pytest.raises(ValueError):
+        tensor.query([((1, 1), 4)])
+
+
+def test_punctured_and_shortened_enumerators():
+    tn = SurfaceCodeTN(d=3)
+    tensor = tn.open_leg_tensor(LEGS, cotengra=False)
+    leg = LEGS[1]
+
+    def punctured(paulis):
+        return sum(p for l, p in paulis.items() if l != leg)
+
+    def shortened(paulis):
+        return None if paulis[leg] else sum(paulis.values())
+
+    assert tensor.punctured([leg]).query() == _brute_force_enumerator(tn, punctured)
+    assert tensor.shortened([leg]).query() == _brute_force_enumerator(tn, shortened)
+    assert tensor.shortened([leg]).tensor == tensor.sliced({leg: (0, 0)}).tensor
+    assert tensor.marginalized([leg]).query() == tensor.query()
+
+
+def test_coset_flips_are_weighed_on_closed_legs():
+    coset_error = ((0, 3), (5,))
+    tn = SurfaceCodeTN(d=3, coset_error=coset_error)
+    tensor = tn.open_leg_tensor(LEGS, cotengra=False)
+    # the X flip of the coset is on the first leg
+    assert tensor.flips == {LEGS[0]: (1, 0)}
+    leg = LEGS[0]
+
+    def punctured(paulis):
+        return sum(p for l, p in paulis.items() if l != leg)
+
+    def shortened(paulis):
+        return None if paulis[leg] else sum(paulis.values())
+
+    expected = SurfaceCodeTN(
+        d=3, coset_error=coset_error
+    ).stabilizer_enumerator_polynomial(cotengra=False)
+    assert tensor.query() == expected
+    assert tensor.query() == _brute_force_enumerator(tn, lambda p: sum(p.values()))
+    assert tn.stabilizer_enumerator_polynomial() == expected
+    assert tensor.punctured([leg]).query() == _brute_force_enumerator(tn, punctured)
+    assert tensor.shortened([leg]).query() == _brute_force_enumerator(tn, shortened)
+    assert tensor.marginalized([LEGS[1]]).query() == expected
+
+
+def test_truncation_drops_shifted_terms():
+    tensor = OpenLegTensor(
+        [("a", 0)],
+        {(0, 0): SimplePoly({0: 1, 2: 1}), (1, 0): SimplePoly({1: 1, 2: 2})},
+        truncate_length=2,
+    )
+    assert tensor.query() == SimplePoly({0: 1, 2: 2})
@@ -0,0 +1,94 @@
+from collections import defaultdict
+import os
+from typing import Any, Dict, List, Tuple
+
+from qlego.contraction_schedule import Trace
+
+# kahypar needs a configuration file, cotengra ships the presets for its versions
+KAHYPAR_PROFILE = "cut_kKaHyPar_sea20.ini"
+
+
+def kahypar_partition(
+    nodes: List[Any],
+    traces: List[Trace],
+    k: int,
+    imbalance: float = 0.03,
+    seed: int = 0,
+) -> Dict[Any, int]:
+    """Splits nodes into k parts of balanced size with as few traced legs between them.
+
+    The nodes are the vertices of a hypergraph with an edge for each pair of traced
+    nodes, weighted by the number of legs traced between them, and kahypar minimizes the
+    total weight of the cut edges. imbalance is the allowed deviation of the part sizes
+    from len(nodes) / k. Returns the part of each node.
+    """
+    if k <= 1 or len(nodes) <= 1:
+        return {node_idx: 0 for node_idx in nodes}
+    if k >= len(nodes):
+        return {node_idx: i for i, node_idx in enumerate(nodes)}
+
+    import kahypar
+    from cotengra.pathfinders.path_kahypar import get_kahypar_profile_dir
+
+    index = {node_idx: i for i, node_idx in enumerate(nodes)}
+    legs_between = defaultdict(int)
+    for node_idx1, node_idx2, join_legs1, _ in traces:
+        if node_idx1 != node_idx2:
+            pair = tuple(sorted((index[node_idx1], index[node_idx2])))
+            legs_between[pair] += len(join_legs1)
+
+    edge_vector = [i for pair in legs_between for i in pair]
+    hypergraph = kahypar.Hypergraph(
+        len(nodes),
+        len(legs_between),
+        list(range(0, len(edge_vector) + 1, 2)),
+        edge_vector,
+        k,
+        list(legs_between.values()),
+        [1] * len(nodes),
+    )
+    context = kahypar.Context()
+    context.loadINIconfiguration(
+        os.path.join(get_kahypar_profile_dir(), KAHYPAR_PROFILE)
+    )
+    context.setK(k)
+    context.setSeed(seed)
+    context.setEpsilon(imbalance)
+    context.suppressOutput(True)
+    kahypar.partition(hypergraph, context)
+    return {node_idx: hypergraph.blockID(index[node_idx]) for node_idx in nodes}
+
+
+def cut_traces(traces: List[Trace], parts: Dict[Any, int]) -> List[Trace]:
+    """The traces between nodes in different parts."""
+    return [t for t in traces if parts[t[0]] != parts[t[1]]]
+
+
+def partitioned_schedule(traces: List[Trace], parts: Dict[Any, int]) -> List[Trace]:
+    """Reorders traces to contract each part on its own, then join them across the cut.
+
+    The traces within each part come first, part by part, followed by the cut traces.
+    Both keep their order in traces, so a schedule optimized for the whole network is
+    kept within the parts. Until the cut traces, the part tensors have their cut legs
+    open, and their subtrees of the schedule are independent.
+    """
+    within: Dict[int, List[Trace]] = defaultdict(list)
+    cut = []
+    for trace in traces:
+        part1, part2 = parts[trace[0]], parts[trace[1]]
+        if part1 == part2:
+            within[part1].append(trace)
+        else:
+            cut.append(trace)
+    return [t for part in sorted(within) for t in within[part]] + cut
+
+
+def partition_summary(
+    traces: List[Trace], parts: Dict[Any, int]
+) -> Tuple[List[int], int]:
+    """The number of nodes in each part and the number of legs traced across the cut."""
+    sizes = defaultdict(int)
+    for part in parts.values():
+        sizes[part] += 1
+    cut_legs = sum(len(t[2]) for t in cut_traces(traces, parts))
+    return [sizes[part] for part in sorted(sizes)], cut_legs
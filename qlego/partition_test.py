@@ -0,0 +1,37 @@
+from qlego.codes.rotated_surface_code import RotatedSurfaceCodeTN
+from qlego.partition import (
+    cut_traces,
+    kahypar_partition,
+    partition_summary,
+    partitioned_schedule,
+)
+
+
+def test_kahypar_partition_is_balanced_with_a_small_cut():
+    tn = RotatedSurfaceCodeTN(d=5)
+    parts = kahypar_partition(list(tn.nodes), tn.traces, 2)
+
+    assert set(parts) == set(tn.nodes)
+    sizes, cut_legs = partition_summary(tn.traces, parts)
+    assert sizes == [12, 13] or sizes == [13, 12]
+    # a 12 / 13 split of the 5x5 lattice needs a cut with a single step in it
+    assert cut_legs <= 6
+
+    assert kahypar_partition(["a", "b"], [], 1) == {"a": 0, "b": 0}
+    assert kahypar_partition(["a", "b"], [], 2) == {"a": 0, "b": 1}
+
+
+def test_partitioned_schedule():
+    t_ab = ("a", "b", [("a", 0)], [("b", 0)])
+    t_bc = ("b", "c", [("b", 1)], [("c", 0)])
+    t_cd = ("c", "d", [("c", 1)], [("d", 0)])
+    t_da = ("d", "a", [("d", 1)], [("a", 1)])
+    parts = {"a": 0, "b": 1, "c": 1, "d": 0}
+
+    assert cut_traces([t_ab, t_bc, t_cd, t_da], parts) == [t_ab, t_cd]
+    assert partitioned_schedule([t_ab, t_bc, t_cd, t_da], parts) == [
+        t_da,
+        t_bc,
+        t_ab,
+        t_cd,
+    ]
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import attrs
+
+_SUFFIX = ".plan.pkl"
+
+
+def structural_hash(
+    nodes: Dict[Any, Any],
+    traces: List[Tuple],
+    objective: str,
+    open_legs_per_node: Optional[Dict[Any, List[Tuple]]] = None,
+) -> str:
+    """Digest of what a contraction plan depends on, independent of the trace order.
+
+    Cosets and truncation don't change which traces a plan runs, so they are left out.
+    Parity checks and open legs only matter to objectives that look at them (the PTE
+    cost model), pass open_legs_per_node for those.
+    """
+    with_checks = open_legs_per_node is not None
+    parts = sorted(
+        repr((idx, node.legs, node.h.tolist() if with_checks else None))
+        for idx, node in nodes.items()
+    )
+    parts += sorted(
+        repr((n1, n2, list(legs1), list(legs2))) for n1, n2, legs1, legs2 in traces
+    )
+    if with_checks:
+        parts += sorted(repr((idx, legs)) for idx, legs in open_legs_per_node.items())
+    parts.append(repr(objective))
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+@attrs.define
+class ContractionPlan:
+    tree: Any
+    traces: List[Tuple]
+    # the objective's score of the tree, lower is better
+    score: float
+
+
+class PlanCache:
+    """Contraction plans by structural_hash, shared between networks and processes.
+
+    The max_entries most recently used plans are kept in memory and, with a directory,
+    as one pickle per plan on disk, where the file modification time tracks use across
+    processes. put only replaces a plan with a better scoring one, so the cache holds
+    the best plan found so far for every structure.
+
+    With refine, networks still search on a hit and keep the better of the cached and
+    the new plan, so repeated runs keep improving the cached plans.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        max_entries: int = 128,
+        refine: bool = False,
+    ):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.refine = refine
+        self._plans: "OrderedDict[str, ContractionPlan]" = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __str__(self):
+        return f"PlanCache[{len(self._plans)} plans in memory, at {self.directory}]"
+
+    def __repr__(self):
+        return str(self)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def get(self, key: str) -> Optional[ContractionPlan]:
+        with self._lock:
+            if key in self._plans:
+                self._plans.move_to_end(key)
+                plan = self._plans[key]
+                if self.directory is not None:
+                    self._touch(key)
+                return plan
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                plan = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._touch(key)
+            self._remember(key, plan)
+        return plan
+
+    def put(self, key: str, plan: ContractionPlan) -> ContractionPlan:
+        """Stores plan unless a better one is cached, returns the cached plan."""
+        cached = self.get(key)
+        if cached is not None and cached.score <= plan.score:
+            return cached
+        with self._lock:
+            self._remember(key, plan)
+            if self.directory is not None:
+                path = self._path(key)
+                tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp, "wb") as f:
+                    pickle.dump(plan, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+                self._evict_files()
+        return plan
+
+    def _remember(self, key: str, plan: ContractionPlan):
+        self._plans[key] = plan
+        self._plans.move_to_end(key)
+        while len(self._plans) > self.max_entries:
+            self._plans.popitem(last=False)
+
+    def _touch(self, key: str):
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict_files(self):
+        files = []
+        for file in os.listdir(self.directory):
+            if not file.endswith(_SUFFIX):
+                continue
+            path = os.path.join(self.directory, file)
+            try:
+                files.append((os.stat(path).st_mtime_ns, path))
+            except FileNotFoundError:
+                # evicted by another process
+                continue
+        files.sort()
+        for _, path in files[: max(0, len(files) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
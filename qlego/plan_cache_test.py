@@ -0,0 +1,106 @@
+import os
+
+import cotengra as ctg
+from galois import GF2
+import pytest
+
+from qlego.codes.rotated_surface_code import RotatedSurfaceCodeTN
+from qlego.plan_cache import ContractionPlan, PlanCache, structural_hash
+
+
+def _fail_search(*args, **kwargs):
+    raise AssertionError("searched despite a cached plan")
+
+
+def test_networks_share_plans_through_the_disk(tmp_path, monkeypatch):
+    cache = PlanCache(str(tmp_path))
+    tn = RotatedSurfaceCodeTN(d=3)
+    wep = tn.stabilizer_enumerator_polynomial(plan_cache=cache)
+    assert len(os.listdir(tmp_path)) == 1
+
+    monkeypatch.setattr(ctg.HyperOptimizer, "search", _fail_search)
+    # another process: a fresh cache on the same directory, cosets and truncation
+    # don't matter
+    other = RotatedSurfaceCodeTN(d=3, coset_error=GF2([1] + [0] * 17))
+    assert other._cotengra_contraction(
+        *other._collect_legs(), plan_cache=PlanCache(str(tmp_path))
+    )[0] == tn._cot_traces
+    assert (
+        RotatedSurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(plan_cache=cache)
+        == wep
+    )
+    assert RotatedSurfaceCodeTN(d=3, truncate_length=2).estimate_cost(
+        plan_cache=cache
+    )
+
+    # other objectives and structures are searched
+    with pytest.raises(AssertionError):
+        RotatedSurfaceCodeTN(d=3).estimate_cost(
+            plan_cache=cache, cotengra_minimize="flops"
+        )
+    with pytest.raises(AssertionError):
+        RotatedSurfaceCodeTN(d=5).estimate_cost(plan_cache=cache)
+
+
+def _count_searches(monkeypatch):
+    searches = []
+    search = ctg.HyperOptimizer.search
+
+    def counting_search(self, *args, **kwargs):
+        searches.append(1)
+        return search(self, *args, **kwargs)
+
+    monkeypatch.setattr(ctg.HyperOptimizer, "search", counting_search)
+    return searches
+
+
+def test_networks_with_a_plan_use_the_cache(tmp_path, monkeypatch):
+    searches = _count_searches(monkeypatch)
+    tn = RotatedSurfaceCodeTN(d=3)
+    tn.estimate_cost()
+    # the plan of the network fills the cache without searching again
+    tn.stabilizer_enumerator_polynomial(plan_cache=PlanCache(str(tmp_path)))
+    assert len(os.listdir(tmp_path)) == 1
+    assert len(searches) == 1
+
+    # refine searches on every call, even with a plan
+    cache = PlanCache(str(tmp_path), refine=True)
+    tn.estimate_cost(plan_cache=cache)
+    tn.estimate_cost(plan_cache=cache)
+    assert len(searches) == 3
+
+
+def test_pte_plans_are_kept_for_their_open_legs(monkeypatch):
+    searches = _count_searches(monkeypatch)
+    tn = RotatedSurfaceCodeTN(d=3)
+    tn.estimate_cost(open_legs=[((0, 0), 4)], cotengra_minimize="pte")
+    tn.estimate_cost(open_legs=[((0, 0), 4)], cotengra_minimize="pte")
+    assert len(searches) == 1
+    tn.estimate_cost(open_legs=[((2, 2), 4)], cotengra_minimize="pte")
+    assert len(searches) == 2
+    # cotengra's objectives don't see the open legs
+    tn.estimate_cost(open_legs=[((0, 0), 4)])
+    tn.estimate_cost(open_legs=[((2, 2), 4)])
+    assert len(searches) == 3
+
+
+def test_keeps_the_best_plan_and_evicts_the_least_recently_used(tmp_path):
+    cache = PlanCache(str(tmp_path), max_entries=2)
+    assert cache.put("a", ContractionPlan(None, ["a"], 2.0)).traces == ["a"]
+    assert cache.put("a", ContractionPlan(None, ["worse"], 3.0)).traces == ["a"]
+    assert cache.put("a", ContractionPlan(None, ["better"], 1.0)).traces == ["better"]
+
+    cache.put("b", ContractionPlan(None, ["b"], 1.0))
+    os.utime(tmp_path / "b.plan.pkl", ns=(0, 0))
+    cache.put("c", ContractionPlan(None, ["c"], 1.0))
+    assert sorted(os.listdir(tmp_path)) == ["a.plan.pkl", "c.plan.pkl"]
+    assert PlanCache(str(tmp_path)).get("b") is None
+    assert PlanCache(str(tmp_path)).get("a").traces == ["better"]
+
+
+def test_structural_hash_ignores_the_trace_order():
+    tn = RotatedSurfaceCodeTN(d=3)
+    key = structural_hash(tn.nodes, tn.traces, "size")
+    assert structural_hash(tn.nodes, tn.traces[::-1], "size") == key
+    assert structural_hash(tn.nodes, tn.traces[1:], "size") != key
+    assert structural_hash(tn.nodes, tn.traces, "flops") != key
@@ -0,0 +1,79 @@
+import threading
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+import attrs
+
+T = TypeVar("T")
+
+# Number of items the inner loops process between two checks of a CancellationToken.
+CHECK_INTERVAL = 4096
+
+
+class ContractionCancelled(Exception):
+    """Raised from a contraction whose CancellationToken was cancelled."""
+
+
+class CancellationToken:
+    """Cooperative cancellation of a running contraction.
+
+    cancel() can be called from any thread, the contraction stops with
+    ContractionCancelled at the next chunk boundary of its inner loops.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise ContractionCancelled()
+
+
+def check_cancelled(
+    items: Iterable[T],
+    cancel: Optional[CancellationToken],
+    every: int = CHECK_INTERVAL,
+) -> Iterable[T]:
+    """Iterates items, checking cancel before the first and then every `every` items."""
+    if cancel is None:
+        return items
+    return _checked(items, cancel, every)
+
+
+def _checked(items: Iterable[T], cancel: CancellationToken, every: int) -> Iterator[T]:
+    for i, item in enumerate(items):
+        if i % every == 0:
+            cancel.check()
+        yield item
+
+
+@attrs.define
+class ContractionProgress:
+    """Passed to the progress callback of a contraction after each step.
+
+    pte_keys is the number of keys of the PTE the step produced and live_bytes the
+    estimated size of all live PTEs after it. For sliced contractions a step is a slice,
+    pte_keys the number of keys of its result and live_bytes its peak.
+    """
+
+    step: int
+    n_steps: int
+    pte_keys: int
+    live_bytes: int
+    elapsed: float
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Seconds left, extrapolated from the average time per step so far."""
+        if self.step == 0:
+            return None
+        return self.elapsed / self.step * (self.n_steps - self.step)
+
+
+ProgressCallback = Callable[[ContractionProgress], None]
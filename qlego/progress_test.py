@@ -0,0 +1,31 @@
+import pytest
+
+from qlego.progress import (
+    CancellationToken,
+    ContractionCancelled,
+    ContractionProgress,
+    check_cancelled,
+)
+
+
+def test_check_cancelled_checks_at_chunk_boundaries():
+    cancel = CancellationToken()
+    seen = []
+    with pytest.raises(ContractionCancelled):
+        for i in check_cancelled(range(100), cancel, every=10):
+            seen.append(i)
+            if i == 13:
+                cancel.cancel()
+    assert cancel.cancelled
+    assert seen == list(range(20))
+
+    items = [1, 2, 3]
+    assert check_cancelled(items, None) is items
+
+
+def test_eta_extrapolates_the_average_step_time():
+    progress = ContractionProgress(
+        step=2, n_steps=10, pte_keys=4, live_bytes=100, elapsed=1.0
+    )
+    assert progress.eta == 4.0
+    assert ContractionProgress(0, 10, 0, 0, 0.0).eta is None
@@ -0,0 +1,280 @@
+import os
+import pickle
+import shutil
+import tempfile
+import weakref
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from qlego.simple_poly import SimplePoly
+
+# Rough CPython footprint of one tensor entry: the key tuple, the SimplePoly
+# object with its dict and the slot in the tensor dict. Measured with tracemalloc
+# on typical PTEs, it is only used to decide when to spill.
+_ENTRY_BYTES = 320
+_KEY_ELEMENT_BYTES = 8
+_TERM_BYTES = 40
+
+# Number of entries buffered per partition before a chunk is written to disk.
+_CHUNK_SIZE = 4096
+
+# Number of hash partitions an accumulator spills into once it is over its limit.
+_ACCUMULATOR_PARTITIONS = 64
+
+
+def estimate_entry_bytes(key_length: int, n_terms: int) -> int:
+    return _ENTRY_BYTES + _KEY_ELEMENT_BYTES * key_length + _TERM_BYTES * n_terms
+
+
+def estimate_tensor_bytes(tensor) -> int:
+    """Estimates the in-memory footprint of a PTE tensor in bytes."""
+    # spilled and compressed tensors keep track of their own estimate
+    if hasattr(tensor, "estimated_bytes"):
+        return tensor.estimated_bytes
+    total = 0
+    for k, v in tensor.items():
+        total += estimate_entry_bytes(len(k), len(v))
+    return total
+
+
+class SpilledTensor:
+    """A PTE tensor stored in hash partitions on disk.
+
+    Each partition is a list of chunks, a chunk is a memory-mapped uint8 key matrix
+    (`.keys.npy`) and the pickled coefficient dicts of the polynomials (`.polys.pkl`).
+    If `keyed` is True, entries are partitioned by `hash(key) % n_partitions`, which is
+    what makes single key lookups possible. Otherwise (e.g. when partitioned by join keys)
+    a key can only be found by scanning.
+
+    The directory is removed once the tensor is garbage collected.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        key_length: int,
+        partitions: List[List[str]],
+        counts: List[int],
+        estimated_bytes: int,
+        keyed: bool = True,
+    ):
+        self.directory = directory
+        self.key_length = key_length
+        self.partitions = partitions
+        self.counts = counts
+        self.estimated_bytes = estimated_bytes
+        self.keyed = keyed
+        self._finalizer = weakref.finalize(self, shutil.rmtree, directory, True)
+
+    def __str__(self):
+        return f"SpilledTensor[{len(self)} keys in {len(self.partitions)} partitions at {self.directory}]"
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def n_partitions(self):
+        return len(self.partitions)
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def iter_partition(self, p: int) -> Iterator[Tuple[Tuple[int, ...], SimplePoly]]:
+        for base in self.partitions[p]:
+            keys = np.load(base + ".keys.npy", mmap_mode="r")
+            with open(base + ".polys.pkl", "rb") as f:
+                polys = pickle.load(f)
+            for row, poly in zip(keys, polys):
+                yield tuple(row.tolist()), SimplePoly(poly)
+
+    def items(self):
+        for p in range(self.n_partitions):
+            yield from self.iter_partition(p)
+
+    def keys(self):
+        for k, _ in self.items():
+            yield k
+
+    def values(self):
+        for _, v in self.items():
+            yield v
+
+    def __iter__(self):
+        return self.keys()
+
+    def get(self, key, default=None):
+        partitions = (
+            [hash(key) % self.n_partitions]
+            if self.keyed
+            else range(self.n_partitions)
+        )
+        for p in partitions:
+            for k, v in self.iter_partition(p):
+                if k == key:
+                    return v
+        return default
+
+    def __getitem__(self, key):
+        res = self.get(key)
+        if res is None:
+            raise KeyError(key)
+        return res
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def cleanup(self):
+        self._finalizer()
+
+
+class _PartitionWriter:
+    """Streams (key, poly) records into hash partitions in chunk files."""
+
+    def __init__(self, directory: str, key_length: int, n_partitions: int):
+        self.directory = directory
+        self.key_length = key_length
+        self.buffers: List[List[Tuple[Tuple[int, ...], Dict]]] = [
+            [] for _ in range(n_partitions)
+        ]
+        self.partitions: List[List[str]] = [[] for _ in range(n_partitions)]
+        self.counts = [0] * n_partitions
+        self.estimated_bytes = 0
+        self._n_chunks = 0
+
+    def add(self, p: int, key: Tuple[int, ...], poly: SimplePoly):
+        self.buffers[p].append((key, poly._dict))
+        self.counts[p] += 1
+        self.estimated_bytes += estimate_entry_bytes(len(key), len(poly))
+        if len(self.buffers[p]) >= _CHUNK_SIZE:
+            self._write_chunk(p)
+
+    def _write_chunk(self, p: int):
+        records = self.buffers[p]
+        if len(records) == 0:
+            return
+        base = os.path.join(self.directory, f"chunk{self._n_chunks}")
+        self._n_chunks += 1
+        keys = np.lib.format.open_memmap(
+            base + ".keys.npy",
+            mode="w+",
+            dtype=np.uint8,
+            shape=(len(records), self.key_length),
+        )
+        if self.key_length > 0:
+            keys[:] = np.array([k for k, _ in records], dtype=np.uint8)
+        keys.flush()
+        del keys
+        with open(base + ".polys.pkl", "wb") as f:
+            pickle.dump([v for _, v in records], f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.partitions[p].append(base)
+        self.buffers[p] = []
+
+    def close(self, keyed: bool) -> SpilledTensor:
+        for p in range(len(self.buffers)):
+            self._write_chunk(p)
+        return SpilledTensor(
+            self.directory,
+            self.key_length,
+            self.partitions,
+            self.counts,
+            self.estimated_bytes,
+            keyed=keyed,
+        )
+
+
+def _make_spill_dir(spill_dir: Optional[str]) -> str:
+    return tempfile.mkdtemp(prefix="qlego_pte_", dir=spill_dir)
+
+
+def spill_tensor(
+    tensor: Iterable[Tuple[Tuple[int, ...], SimplePoly]],
+    key_length: int,
+    n_partitions: int,
+    partition_fn: Optional[Callable[[Tuple[int, ...]], int]] = None,
+    spill_dir: Optional[str] = None,
+) -> SpilledTensor:
+    """Writes the (key, poly) items to a new SpilledTensor.
+
+    Without a partition_fn the items are partitioned by the hash of their key, otherwise
+    by the hash of partition_fn(key), e.g. the join slice of the key for external joins.
+    """
+    writer = _PartitionWriter(_make_spill_dir(spill_dir), key_length, n_partitions)
+    for k, v in tensor:
+        h = hash(k if partition_fn is None else partition_fn(k))
+        writer.add(h % n_partitions, k, v)
+    return writer.close(keyed=partition_fn is None)
+
+
+class TensorAccumulator:
+    """Sums (key, poly) contributions into a tensor, spilling to disk beyond memory_limit.
+
+    Below the limit this is a plain dict of SimplePoly's. Once the estimated footprint
+    exceeds memory_limit, the in-memory sums are flushed as runs into hash partitions on
+    disk, and finalize() reduces each partition separately, so only one partition has to
+    fit in memory at a time.
+    """
+
+    def __init__(
+        self,
+        key_length: int,
+        memory_limit: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+    ):
+        self.key_length = key_length
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.tensor: Dict[Tuple[int, ...], SimplePoly] = {}
+        self.estimated_bytes = 0
+        self._runs: Optional[_PartitionWriter] = None
+
+    def add(self, key: Tuple[int, ...], poly: SimplePoly):
+        existing = self.tensor.get(key)
+        if existing is None:
+            self.tensor[key] = SimplePoly(poly)
+            self.estimated_bytes += estimate_entry_bytes(len(key), len(poly))
+        else:
+            n_terms = len(existing)
+            existing.add_inplace(poly)
+            self.estimated_bytes += _TERM_BYTES * (len(existing) - n_terms)
+        if self.memory_limit is not None and self.estimated_bytes > self.memory_limit:
+            self._flush()
+
+    def _flush(self):
+        if self._runs is None:
+            self._runs = _PartitionWriter(
+                _make_spill_dir(self.spill_dir),
+                self.key_length,
+                _ACCUMULATOR_PARTITIONS,
+            )
+        for k, v in self.tensor.items():
+            self._runs.add(hash(k) % _ACCUMULATOR_PARTITIONS, k, v)
+        self.tensor = {}
+        self.estimated_bytes = 0
+
+    @property
+    def spilled(self):
+        return self._runs is not None
+
+    def finalize(self):
+        """Returns the summed tensor, a dict if it never spilled, a SpilledTensor otherwise."""
+        if self._runs is None:
+            return self.tensor
+        self._flush()
+        runs = self._runs.close(keyed=True)
+        writer = _PartitionWriter(
+            _make_spill_dir(self.spill_dir), self.key_length, runs.n_partitions
+        )
+        for p in range(runs.n_partitions):
+            reduced: Dict[Tuple[int, ...], SimplePoly] = {}
+            for k, v in runs.iter_partition(p):
+                if k in reduced:
+                    reduced[k].add_inplace(v)
+                else:
+                    reduced[k] = v
+            for k, v in reduced.items():
+                writer.add(p, k, v)
+            writer._write_chunk(p)
+        runs.cleanup()
+        self._runs = None
+        return writer.close(keyed=True)
@@ -0,0 +1,58 @@
+import os
+
+from qlego.pte_storage import (
+    SpilledTensor,
+    TensorAccumulator,
+    estimate_tensor_bytes,
+    spill_tensor,
+)
+from qlego.simple_poly import SimplePoly
+
+
+def _random_tensor(n_keys, key_length):
+    return {
+        tuple((i >> b) & 1 for b in range(key_length)): SimplePoly({i % 5: i + 1})
+        for i in range(n_keys)
+    }
+
+
+def test_spill_tensor_roundtrip(tmp_path):
+    tensor = _random_tensor(100, 8)
+    spilled = spill_tensor(tensor.items(), 8, n_partitions=4, spill_dir=tmp_path)
+
+    assert isinstance(spilled, SpilledTensor)
+    assert len(spilled) == 100
+    assert dict(spilled.items()) == tensor
+    assert spilled[(1, 0, 1, 0, 0, 0, 0, 0)] == SimplePoly({0: 6})
+    assert (1, 1, 1, 1, 1, 1, 1, 1) not in spilled
+
+    directory = spilled.directory
+    assert os.path.isdir(directory)
+    spilled.cleanup()
+    assert not os.path.exists(directory)
+
+
+def test_accumulator_below_limit_stays_in_memory():
+    acc = TensorAccumulator(2, memory_limit=10**6)
+    acc.add((0, 1), SimplePoly({1: 1}))
+    acc.add((0, 1), SimplePoly({1: 2, 2: 1}))
+
+    res = acc.finalize()
+    assert not acc.spilled
+    assert res == {(0, 1): SimplePoly({1: 3, 2: 1})}
+
+
+def test_accumulator_spills_and_sums_across_runs(tmp_path):
+    tensor = _random_tensor(256, 8)
+    limit = estimate_tensor_bytes(tensor) // 10
+
+    acc = TensorAccumulator(8, memory_limit=limit, spill_dir=tmp_path)
+    # every key is added twice, in separate passes, so the sums span several runs
+    for _ in range(2):
+        for k, v in tensor.items():
+            acc.add(k, SimplePoly(v))
+    assert acc.spilled
+
+    res = acc.finalize()
+    assert isinstance(res, SpilledTensor)
+    assert dict(res.items()) == {k: v * 2 for k, v in tensor.items()}
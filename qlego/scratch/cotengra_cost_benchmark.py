@@ -0,0 +1,31 @@
+import time
+
+from qlego.codes.compass_code import CompassCodeTN
+from qlego.codes.rotated_surface_code import RotatedSurfaceCodeTN
+from qlego.codes.surface_code import SurfaceCodeTN
+
+# compares contraction trees searched with cotengra's dense size model to the ones
+# searched with the PTE cost model
+
+networks = {
+    **{f"rsc d={d}": (lambda d=d: RotatedSurfaceCodeTN(d=d)) for d in (3, 5, 7)},
+    **{f"surface d={d}": (lambda d=d: SurfaceCodeTN(d=d)) for d in (3, 5)},
+    "compass 4x4": lambda: CompassCodeTN(
+        [[1, 1, 2, 2], [2, 1, 1, 2], [1, 2, 2, 1], [2, 2, 1, 1]]
+    ),
+}
+
+for name, network in networks.items():
+    for minimize in ("size", "pte"):
+        tn = network()
+        start = time.time()
+        report = tn.estimate_cost(cotengra_minimize=minimize)
+        plan_time = time.time() - start
+        start = time.time()
+        tn.stabilizer_enumerator_polynomial(cotengra_minimize=minimize)
+        contract_time = time.time() - start
+        print(
+            f"{name:12} {minimize:5} plan {plan_time:5.1f}s "
+            f"ops {report.total_operations:9.3g} peak {report.peak_bytes:9.3g} "
+            f"max keys {report.max_keys:6} contract {contract_time:6.2f}s"
+        )
@@ -0,0 +1,40 @@
+import time
+
+import numpy as np
+
+from qlego.codes.compass_code import CompassCodeTN
+from qlego.codes.rotated_surface_code import RotatedSurfaceCodeTN
+from qlego.codes.surface_code import SurfaceCodeTN
+
+# compares the built-in sweep plans of the lattice codes to cotengra's plans, by
+# planning time and by the estimated cost of the contraction (nothing is contracted)
+
+families = {
+    "rsc": lambda d: RotatedSurfaceCodeTN(d=d),
+    "surface": lambda d: SurfaceCodeTN(d=d),
+    "compass": lambda d: CompassCodeTN(
+        np.random.default_rng(d).integers(1, 3, size=(d - 1, d - 1)).tolist()
+    ),
+}
+
+for d in range(3, 16, 2):
+    for name, family in families.items():
+        for planner in ("sweep", "cotengra"):
+            tn = family(d)
+            start = time.time()
+            if planner == "sweep":
+                plan = tn.sweep_plan()
+                traces = plan.traces
+                label = f"sweep ({plan.direction}, frontier {plan.max_frontier})"
+            else:
+                traces, _ = tn._cotengra_contraction(*tn._collect_legs())
+                label = planner
+            plan_time = time.time() - start
+            tn.traces = traces
+            report = tn.estimate_cost(cotengra=False)
+            print(
+                f"d={d:2} {name:8} {label:34} plan {plan_time:6.2f}s "
+                f"ops {report.total_operations:9.3g} peak {report.peak_bytes:9.3g} "
+                f"max keys {report.max_keys:9.3g} max legs {report.max_legs:3}",
+                flush=True,
+            )
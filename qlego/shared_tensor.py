@@ -0,0 +1,238 @@
+import os
+import shutil
+import tempfile
+import weakref
+from typing import Iterable, Iterator, Optional, Tuple
+
+import attrs
+import numpy as np
+
+from qlego.pte_storage import estimate_entry_bytes
+from qlego.simple_poly import SimplePoly
+
+_LIMB_BITS = 64
+_LIMB_MASK = (1 << _LIMB_BITS) - 1
+# keys whose terms are copied out of the mapped arrays at a time
+_CHUNK_KEYS = 1 << 14
+
+
+def _default_dir() -> Optional[str]:
+    # RAM backed on Linux, so the files never have to hit the disk
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def _key_rows(key_matrix: np.ndarray) -> np.ndarray:
+    # each key as one void scalar, compared byte by byte, a view of the key matrix
+    return key_matrix.view(np.dtype((np.void, key_matrix.shape[1]))).reshape(-1)
+
+
+def _term_indices(
+    starts: np.ndarray, lengths: np.ndarray, order: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """The indices of the terms of the polynomials starting at starts, in order."""
+    if order is not None:
+        starts = starts[order]
+        lengths = lengths[order]
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(
+        ends[-1] if len(ends) > 0 else 0
+    )
+
+
+@attrs.frozen
+class SharedTensorHandle:
+    """What another process needs to open a SharedTensor: a directory and the layout."""
+
+    directory: str
+    key_length: int
+    n_limbs: int
+
+
+class SharedTensor:
+    """A PTE tensor in memory-mapped arrays, readable from any process by its handle.
+
+    The tensor is stored in CSR layout: a uint8 key matrix sorted by key, the offsets of
+    the terms of each polynomial, and the powers and coefficients of the terms.
+    Coefficients are split into n_limbs uint64 limbs, as they can grow beyond 64 bits.
+    Opening a tensor maps the files read-only, only the handle is pickled. Lookups and
+    joins are binary searches on the mapped key matrix, and only the terms of the keys
+    that are read are copied out, a chunk of keys at a time.
+
+    The owner removes the files once it is garbage collected (or on cleanup()).
+    """
+
+    def __init__(self, handle: SharedTensorHandle, owner: bool = False):
+        self.handle = handle
+        self.key_length = handle.key_length
+        directory = handle.directory
+        self._keys = np.load(os.path.join(directory, "keys.npy"), mmap_mode="r")
+        self._offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        self._powers = np.load(os.path.join(directory, "powers.npy"), mmap_mode="r")
+        self._coeffs = np.load(os.path.join(directory, "coeffs.npy"), mmap_mode="r")
+        self._finalizer = (
+            weakref.finalize(self, shutil.rmtree, directory, True) if owner else None
+        )
+
+    @staticmethod
+    def create(
+        items: Iterable[Tuple[Tuple[int, ...], SimplePoly]],
+        key_length: int,
+        directory: Optional[str] = None,
+        owner: bool = True,
+    ) -> "SharedTensor":
+        """Writes the (key, poly) items to a new SharedTensor under directory.
+
+        With owner=False the files outlive this object, e.g. to hand them over to the
+        process that opens them.
+        """
+        keys = []
+        lengths = []
+        powers = []
+        coeffs = []
+        for k, v in items:
+            keys.append(k)
+            lengths.append(len(v._dict))
+            powers.extend(v._dict.keys())
+            coeffs.extend(v._dict.values())
+        if len(coeffs) > 0 and min(coeffs) < 0:
+            raise ValueError(f"Can't share negative coefficient {min(coeffs)}")
+        max_coeff = max(coeffs, default=0)
+        n_limbs = max(1, -(-max_coeff.bit_length() // _LIMB_BITS))
+
+        key_matrix = np.frombuffer(
+            b"".join(map(bytes, keys)), dtype=np.uint8
+        ).reshape(len(keys), key_length)
+        lengths = np.array(lengths, dtype=np.int64)
+        powers = np.array(powers, dtype=np.int64)
+        if n_limbs == 1:
+            limbs = np.array(coeffs, dtype=np.uint64).reshape(len(coeffs), 1)
+        else:
+            limbs = np.zeros((len(coeffs), n_limbs), dtype=np.uint64)
+            for j in range(n_limbs):
+                limbs[:, j] = [(c >> (_LIMB_BITS * j)) & _LIMB_MASK for c in coeffs]
+        del keys, coeffs
+        if key_length > 0 and len(key_matrix) > 1:
+            order = np.argsort(_key_rows(key_matrix), kind="stable")
+            terms = _term_indices(np.cumsum(lengths) - lengths, lengths, order)
+            key_matrix = key_matrix[order]
+            lengths = lengths[order]
+            powers = powers[terms]
+            limbs = limbs[terms]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        path = tempfile.mkdtemp(
+            prefix="qlego_shared_", dir=directory or _default_dir()
+        )
+
+        def write(name, array):
+            out = np.lib.format.open_memmap(
+                os.path.join(path, name),
+                mode="w+",
+                dtype=array.dtype,
+                shape=array.shape,
+            )
+            out[:] = array
+            out.flush()
+
+        write("keys.npy", key_matrix)
+        write("offsets.npy", offsets)
+        write("powers.npy", powers)
+        write("coeffs.npy", limbs)
+        return SharedTensor(SharedTensorHandle(path, key_length, n_limbs), owner=owner)
+
+    @property
+    def estimated_bytes(self) -> int:
+        return sum(
+            estimate_entry_bytes(self.key_length, int(n))
+            for n in np.diff(self._offsets)
+        )
+
+    def __str__(self):
+        return f"SharedTensor[{len(self)} keys at {self.handle.directory}]"
+
+    def __repr__(self):
+        return str(self)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def find(self, keys: np.ndarray) -> np.ndarray:
+        """The rows of the (n, key_length) uint8 keys, -1 for keys not in the tensor."""
+        if len(self) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        if self.key_length == 0:
+            return np.zeros(len(keys), dtype=np.int64)
+        rows = _key_rows(self._keys)
+        queries = _key_rows(np.ascontiguousarray(keys, dtype=np.uint8))
+        found = np.minimum(np.searchsorted(rows, queries), len(rows) - 1)
+        return np.where(rows[found] == queries, found, -1)
+
+    def matching_rows(
+        self, other: "SharedTensor", start: int = 0, end: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """The rows start to end with a key in other, and the rows of those in other."""
+        rows2 = other.find(self._keys[start:end])
+        rows1 = np.flatnonzero(rows2 >= 0)
+        return rows1 + start, rows2[rows1]
+
+    def polys(self, rows: Iterable[int]) -> Iterator[SimplePoly]:
+        """The polynomials of the given rows, in order."""
+        rows = np.asarray(rows, dtype=np.int64)
+        for chunk in range(0, len(rows), _CHUNK_KEYS):
+            chunk_rows = rows[chunk : chunk + _CHUNK_KEYS]
+            starts = self._offsets[chunk_rows]
+            lengths = self._offsets[chunk_rows + 1] - starts
+            terms = _term_indices(starts, lengths)
+            powers = self._powers[terms].tolist()
+            limbs = self._coeffs[terms]
+            if self.handle.n_limbs == 1:
+                coeffs = limbs[:, 0].tolist()
+            else:
+                coeffs = [
+                    sum(limb << (_LIMB_BITS * j) for j, limb in enumerate(row))
+                    for row in limbs.tolist()
+                ]
+            end = 0
+            for n in lengths.tolist():
+                start, end = end, end + n
+                # single variable terms, SimplePoly doesn't need to check the keys
+                poly = SimplePoly()
+                poly._dict.update(zip(powers[start:end], coeffs[start:end]))
+                yield poly
+
+    def poly(self, i: int) -> SimplePoly:
+        """The polynomial of the i-th key."""
+        return next(self.polys([i]))
+
+    def items(self) -> Iterator[Tuple[Tuple[int, ...], SimplePoly]]:
+        return zip(self.keys(), self.values())
+
+    def keys(self):
+        for chunk in range(0, len(self), _CHUNK_KEYS):
+            yield from map(tuple, self._keys[chunk : chunk + _CHUNK_KEYS].tolist())
+
+    def values(self):
+        for chunk in range(0, len(self), _CHUNK_KEYS):
+            end = min(chunk + _CHUNK_KEYS, len(self))
+            yield from self.polys(range(chunk, end))
+
+    def __iter__(self):
+        return self.keys()
+
+    def get(self, key, default=None):
+        i = int(self.find(np.array(key, dtype=np.uint8).reshape(1, -1))[0])
+        return default if i < 0 else self.poly(i)
+
+    def __getitem__(self, key):
+        res = self.get(key)
+        if res is None:
+            raise KeyError(key)
+        return res
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def cleanup(self):
+        if self._finalizer is not None:
+            self._finalizer()
@@ -0,0 +1,64 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from qlego.pte_storage_test import _random_tensor
+from qlego.shared_tensor import SharedTensor
+from qlego.simple_poly import SimplePoly
+
+
+def _read_back(handle):
+    return dict(SharedTensor(handle).items())
+
+
+def test_shared_tensor_roundtrip(tmp_path):
+    tensor = _random_tensor(100, 8)
+    tensor[(1,) * 8] = SimplePoly({0: 1, 3: 2**70 + 5})
+    shared = SharedTensor.create(tensor.items(), 8, directory=tmp_path)
+
+    assert shared.handle.n_limbs == 2
+    assert len(shared) == 101
+    assert dict(shared.items()) == tensor
+    assert shared[(1, 0, 1, 0, 0, 0, 0, 0)] == SimplePoly({0: 6})
+    assert shared[(1,) * 8] == SimplePoly({0: 1, 3: 2**70 + 5})
+    assert (0, 1, 1, 1, 1, 1, 1, 1) not in shared
+
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        assert pool.submit(_read_back, shared.handle).result() == tensor
+
+    directory = shared.handle.directory
+    shared.cleanup()
+    assert not os.path.exists(directory)
+
+
+def test_shared_tensors_are_joined_on_their_keys(tmp_path):
+    tensor1 = _random_tensor(64, 8)
+    tensor2 = {k: v for k, v in _random_tensor(200, 8).items() if sum(k) % 2 == 0}
+    shared1 = SharedTensor.create(tensor1.items(), 8, directory=tmp_path)
+    shared2 = SharedTensor.create(tensor2.items(), 8, directory=tmp_path)
+
+    rows1, rows2 = shared1.matching_rows(shared2)
+    keys1 = list(shared1.keys())
+    keys2 = list(shared2.keys())
+    assert [keys1[i] for i in rows1] == [keys2[j] for j in rows2]
+    assert sorted(keys1[i] for i in rows1) == sorted(set(tensor1) & set(tensor2))
+    assert list(shared1.polys(rows1)) == [tensor1[keys1[i]] for i in rows1]
+
+    rows1, rows2 = shared1.matching_rows(shared2, 10, 20)
+    assert all(10 <= i < 20 for i in rows1)
+    assert [keys1[i] for i in rows1] == [
+        k for k in keys1[10:20] if k in tensor2
+    ]
+
+
+def test_shared_tensor_edge_cases(tmp_path):
+    empty = SharedTensor.create([], 4, directory=tmp_path)
+    assert len(empty) == 0
+    assert dict(empty.items()) == {}
+
+    scalar = SharedTensor.create([((), SimplePoly({2: 3}))], 0, directory=tmp_path)
+    assert scalar[()] == SimplePoly({2: 3})
+
+    with pytest.raises(ValueError):
+        SharedTensor.create([((0,), SimplePoly({0: -1}))], 1, directory=tmp_path)
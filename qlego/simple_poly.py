@@ -146,6 +146,21 @@ class SimplePoly:
                     res._dict[d1 + d2] = res._dict.get(d1 + d2, 0) + coeff1 * coeff2
             return res
 
+    def truncate(self, max_degree: int) -> "SimplePoly":
+        """Returns the polynomial without the terms of degree higher than max_degree."""
+        return SimplePoly({k: v for k, v in self._dict.items() if k <= max_degree})
+
+    def mul_truncated(self, other: "SimplePoly", max_degree: int) -> "SimplePoly":
+        """Product of two single variable polynomials without the terms above max_degree."""
+        res = SimplePoly()
+        for d1, coeff1 in self._dict.items():
+            if d1 > max_degree:
+                continue
+            for d2, coeff2 in other._dict.items():
+                if d1 + d2 <= max_degree:
+                    res._dict[d1 + d2] = res._dict.get(d1 + d2, 0) + coeff1 * coeff2
+        return res
+
     def _homogenize(self, n: int):
         """Homogenize a polynomial in n variables to a polynomial in 2 variables.
 
@@ -23,3 +23,15 @@ def test_normalizer_enumerator_polynomial_422():
 
     poly_a = poly_b.macwilliams_dual(n=n, k=k, to_normalizer=False)
     assert poly_a == SimplePoly({0: 1, 4: 3})
+
+
+def test_truncate():
+    assert SimplePoly({0: 1, 2: 3, 5: 1}).truncate(2) == SimplePoly({0: 1, 2: 3})
+    assert SimplePoly({3: 1}).truncate(2) == SimplePoly()
+
+
+def test_mul_truncated():
+    p1 = SimplePoly({0: 1, 1: 2, 3: 1})
+    p2 = SimplePoly({1: 1, 2: 5})
+    assert p1.mul_truncated(p2, 2) == SimplePoly({1: 1, 2: 7})
+    assert p1.mul_truncated(p2, 10) == p1 * p2
@@ -9,6 +9,7 @@ from tqdm import tqdm
 from qlego.legos import LegoAnnotation
 from qlego.linalg import gauss
 from qlego.parity_check import conjoin, self_trace, tensor_product
+from qlego.progress import CancellationToken, check_cancelled
 from qlego.simple_poly import SimplePoly
 from qlego.symplectic import omega, sslice, weight
 
@@ -26,6 +27,32 @@ def _index_legs(idx, legs):
 TensorEnumerator = Dict[Tuple[GF2, ...], SimplePoly]
 
 
+def _css_split(h_reduced: GF2) -> Optional[Tuple[GF2, GF2]]:
+    """Splits the rows of a reduced parity check matrix into X type and Z type ones.
+
+    Returns None if a row has both X and Z parts. The reduced row echelon form of a CSS
+    code's parity check matrix never has such rows.
+    """
+    n = h_reduced.shape[1] // 2
+    is_x = ~np.any(h_reduced[:, n:], axis=1)
+    is_z = ~np.any(h_reduced[:, :n], axis=1)
+    if not np.all(is_x | is_z):
+        return None
+    return h_reduced[is_x][:, :n], h_reduced[is_z & ~is_x][:, n:]
+
+
+def _bits_to_int(bits) -> int:
+    return int(sum(1 << i for i, b in enumerate(bits) if b))
+
+
+def _span(generators: List[int]) -> List[int]:
+    """All GF2 linear combinations of the generators (as int bitmasks)."""
+    elements = [0]
+    for g in generators:
+        elements += [e ^ g for e in elements]
+    return elements
+
+
 class SimpleStabilizerCollector:
     def __init__(self, k, n, coset, open_cols, verbose=False, progress_bar=False):
         self.k = k
@@ -41,7 +68,7 @@ class SimpleStabilizerCollector:
         # print(f"simple {stabilizer + self.coset} => {stab_weight}")
         self.tensor_wep.add_inplace(SimplePoly({stab_weight: 1}))
 
-    def finalize(self):
+    def finalize(self, cancel: Optional[CancellationToken] = None):
         self.tensor_wep = self.tensor_wep.normalize(verbose=self.verbose)
 
 
@@ -60,11 +87,12 @@ class TensorElementCollector:
     def collect(self, stabilizer):
         self.matching_stabilizers.append(stabilizer)
 
-    def finalize(self):
+    def finalize(self, cancel: Optional[CancellationToken] = None):
         prog = tqdm(
-            self.matching_stabilizers,
+            check_cancelled(self.matching_stabilizers, cancel),
             desc="Collecting stabilizers",
             disable=not self.progress_bar,
+            total=len(self.matching_stabilizers),
         )
 
         for s in prog:
@@ -226,6 +254,7 @@ class StabilizerCodeTensorEnumerator:
         open_legs=[],
         verbose=False,
         progress_bar=False,
+        cancel: Optional[CancellationToken] = None,
     ) -> Union[TensorEnumerator, SimplePoly]:
 
         open_legs = _index_legs(self.idx, open_legs)
@@ -266,15 +295,29 @@ class StabilizerCodeTensorEnumerator:
         h_reduced = h_reduced[~np.all(h_reduced == 0, axis=1)]
         r = len(h_reduced)
 
+        css = _css_split(h_reduced)
+        if css is not None:
+            if verbose:
+                print(
+                    f"CSS WEP calc for [[{self.n}, {self.k}]] tensor {self.idx} - {len(css[0])} X and {len(css[1])} Z generators"
+                )
+            tensor_wep = self._css_stabilizer_enumerator(
+                *css, coset, open_cols, progress_bar, cancel
+            )
+            if open_cols == []:
+                return tensor_wep[()].normalize(verbose=verbose)
+            return tensor_wep
+
         if verbose:
             reduction = r < len(self.h)
             print(
                 f"Brute force WEP calc for [[{self.n}, {self.k}]] tensor {self.idx} - {r} {"REDUCED" if reduction else ""} generators, verbose={verbose}, progress_bar={progress_bar} "
             )
         progress_bar = tqdm(
-            range(2**r),
+            check_cancelled(range(2**r), cancel),
             desc=f"Brute force WEP calc for [[{self.n}, {self.k}]] tensor {self.idx} - {r} generators",
             disable=not progress_bar,
+            total=2**r,
         )
         for i in progress_bar:
             picked_generators = GF2(list(np.binary_repr(i, width=r)), dtype=int)
@@ -287,24 +330,74 @@ class StabilizerCodeTensorEnumerator:
                 stabilizer = picked_generators @ h_reduced
 
             collector.collect(stabilizer)
-        collector.finalize()
+        collector.finalize(cancel)
         return collector.tensor_wep
 
+    def _css_stabilizer_enumerator(
+        self,
+        hx: GF2,
+        hz: GF2,
+        coset: GF2,
+        open_cols: List[int],
+        progress_bar=False,
+        cancel: Optional[CancellationToken] = None,
+    ) -> TensorEnumerator:
+        """Enumerates a CSS code's X and Z type stabilizers separately.
+
+        The X and Z parts of the key only depend on the X and Z type part of a stabilizer
+        respectively, so both parts are enumerated (2**rx + 2**rz elements), grouped by
+        their key part, and combined key by key. The combination is not a plain
+        convolution of the X and Z weights: Y's count once, so the weight of a pair is the
+        size of the union of their supports on the legs that are not open.
+        """
+        dangling_mask = _bits_to_int([i not in open_cols for i in range(self.n)])
+
+        def group(generators, coset_part):
+            # key part -> weight mask of the dangling legs -> count
+            groups = defaultdict(lambda: defaultdict(int))
+            for e in check_cancelled(
+                _span([_bits_to_int(row) for row in generators]), cancel
+            ):
+                key = tuple((e >> c) & 1 for c in open_cols)
+                groups[key][(e ^ coset_part) & dangling_mask] += 1
+            return groups
+
+        groups_x = group(hx, _bits_to_int(coset[: self.n]))
+        groups_z = group(hz, _bits_to_int(coset[self.n :]))
+
+        tensor_wep: TensorEnumerator = defaultdict(lambda: SimplePoly())
+        for key_x, masks_x in tqdm(
+            check_cancelled(groups_x.items(), cancel, every=1),
+            desc=f"CSS WEP calc for [[{self.n}, {self.k}]] tensor {self.idx}",
+            disable=not progress_bar,
+            total=len(groups_x),
+        ):
+            for key_z, masks_z in groups_z.items():
+                counts = defaultdict(int)
+                for mask_x, count_x in masks_x.items():
+                    for mask_z, count_z in masks_z.items():
+                        counts[(mask_x | mask_z).bit_count()] += count_x * count_z
+                tensor_wep[key_x + key_z] = SimplePoly(dict(counts))
+        return tensor_wep
+
     def stabilizer_enumerator_polynomial(
         self,
         open_legs=[],
         verbose=False,
         progress_bar=False,
+        cancel: Optional[CancellationToken] = None,
     ) -> Union[TensorEnumerator, SimplePoly]:
         """Stabilizer enumerator polynomial.
 
         If open_legs left empty, it gives the scalar stabilizer enumerator polynomial.
         If open_legs is not empty, then the result is a sparse tensor, with non-zero values on the open_legs.
+        The enumeration stops with ContractionCancelled once cancel is cancelled.
         """
         wep = self._brute_force_stabilizer_enumerator_from_parity(
             open_legs=open_legs,
             verbose=verbose,
             progress_bar=progress_bar,
+            cancel=cancel,
         )
         return wep
 
@@ -2,10 +2,12 @@ from galois import GF2
 import scipy.linalg
 import numpy as np
 import pytest
+from qlego.legos import Legos
 from qlego.linalg import gauss
 from qlego.simple_poly import SimplePoly
+import qlego.stabilizer_tensor_enumerator as ste
 from qlego.stabilizer_tensor_enumerator import StabilizerCodeTensorEnumerator
-from qlego.tensor_network import PAULI_I, PAULI_X, PAULI_Z
+from qlego.tensor_network import PAULI_I, PAULI_X, PAULI_Y, PAULI_Z
 
 
 @pytest.mark.parametrize(
@@ -325,3 +327,32 @@ def tensor_with_scalar():
     )
 
     assert wep == {0: 1}
+
+
+def test_css_enumerator_matches_brute_force(monkeypatch):
+    css_split = ste._css_split
+    assert css_split(gauss(Legos.enconding_tensor_512)) is not None
+    h513 = GF2(
+        [
+            [1, 0, 0, 1, 0, 0, 1, 1, 0, 0],
+            [0, 1, 0, 0, 1, 0, 0, 1, 1, 0],
+            [1, 0, 1, 0, 0, 0, 0, 0, 1, 1],
+            [0, 1, 0, 1, 0, 1, 0, 0, 0, 1],
+        ]
+    )
+    assert css_split(gauss(h513)) is None
+
+    enum = StabilizerCodeTensorEnumerator(
+        Legos.enconding_tensor_603,
+        idx=0,
+        coset_flipped_legs=[((0, 1), PAULI_X), ((0, 2), PAULI_Y), ((0, 4), PAULI_Z)],
+    )
+    for open_legs in [[], [0, 2], [3, 0, 5]]:
+        css = enum.stabilizer_enumerator_polynomial(open_legs=open_legs)
+        monkeypatch.setattr(ste, "_css_split", lambda h: None)
+        brute_force = enum.stabilizer_enumerator_polynomial(open_legs=open_legs)
+        monkeypatch.setattr(ste, "_css_split", css_split)
+        if open_legs == []:
+            assert css == brute_force
+        else:
+            assert dict(css) == dict(brute_force)
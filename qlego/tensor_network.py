@@ -1,5 +1,14 @@
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from copy import deepcopy
+import itertools
+import math
+import os
+from operator import itemgetter
+import threading
+import time
+import uuid
+import attrs
 from typing_extensions import deprecated
 import cotengra as ctg
 
@@ -9,9 +18,60 @@ import numpy as np
 import sympy
 from tqdm import tqdm
 
+from qlego.affine_tensor import AffineTensor
+from qlego.approximation import (
+    KEY_PRIORITIES,
+    ApproximationReport,
+    contraction_mass,
+    poly_mass,
+    select_top_keys,
+)
+from qlego.checkpoint import (
+    ContractionCheckpoint,
+    contraction_fingerprint,
+    load_checkpoint,
+    read_tensor,
+)
+from qlego.cluster import Cluster
+from qlego.contraction_cost import (
+    ContractionCostReport,
+    HybridDecision,
+    HybridPlan,
+    PTECostObjective,
+    estimate_contraction_cost,
+    estimate_step_operations,
+    plan_hybrid_contraction,
+)
+from qlego.contraction_schedule import (
+    SweepPlan,
+    UnionFind,
+    fuse_traces,
+    subtree_tasks,
+    sweep_schedule,
+)
 from qlego.legos import LegoAnnotation, Legos
 from qlego.linalg import gauss
+from qlego.open_leg_tensor import OpenLegTensor
 from qlego.parity_check import conjoin, self_trace, sprint, sstr, tensor_product
+from qlego.partition import (
+    kahypar_partition,
+    partition_summary,
+    partitioned_schedule,
+)
+from qlego.plan_cache import ContractionPlan, PlanCache, structural_hash
+from qlego.progress import (
+    CancellationToken,
+    ContractionProgress,
+    ProgressCallback,
+    check_cancelled,
+)
+from qlego.pte_storage import (
+    SpilledTensor,
+    TensorAccumulator,
+    estimate_tensor_bytes,
+    spill_tensor,
+)
+from qlego.shared_tensor import SharedTensor, SharedTensorHandle
 from qlego.simple_poly import SimplePoly
 from qlego.stabilizer_tensor_enumerator import (
     StabilizerCodeTensorEnumerator,
@@ -19,6 +79,7 @@ from qlego.stabilizer_tensor_enumerator import (
     _index_legs,
 )
 from qlego.symplectic import omega, sconcat, sslice, weight
+from qlego.tree_decomposition import TreeDecompositionPlan, tree_decomposition_schedule
 
 
 PAULI_I = GF2([0, 0])
@@ -26,6 +87,72 @@ PAULI_X = GF2([1, 0])
 PAULI_Z = GF2([0, 1])
 PAULI_Y = GF2([1, 1])
 
+# Subtree tasks per worker of a parallel contraction, more tasks balance the load better
+# but move more intermediate results between the workers.
+TASKS_PER_WORKER = 4
+
+# cotengra objectives of the PTE cost model (see PTECostObjective) by what they minimize
+PTE_OBJECTIVES = {"pte": "operations", "pte-size": "size"}
+
+
+def _check_planner(sweep: bool, tree_decomposition: bool, max_treewidth: Optional[int]):
+    """Raises ValueError for planner options that exclude each other."""
+    if sweep and tree_decomposition:
+        raise ValueError("Contractions can't both sweep and use a tree decomposition.")
+    if max_treewidth is not None and not tree_decomposition:
+        raise ValueError("max_treewidth only applies with tree_decomposition.")
+
+
+def _symplectic_positions(indices: List[int], n_legs: int) -> List[int]:
+    """Positions of the X and then the Z bits of the given legs in a PTE key."""
+    return list(indices) + [i + n_legs for i in indices]
+
+
+def _key_getter(positions: List[int]) -> Callable[[Tuple[int, ...]], Tuple[int, ...]]:
+    """Returns a function that picks the given positions of a key as a tuple."""
+    if len(positions) == 0:
+        return lambda key: ()
+    if len(positions) == 1:
+        pos = positions[0]
+        return lambda key: (key[pos],)
+    return itemgetter(*positions)
+
+
+@attrs.define
+class ContractionMemoryStats:
+    """Estimated memory of the live PTEs during a contraction (see estimate_tensor_bytes).
+
+    step_bytes has the live PTE bytes after each step, peak_bytes is the high-water mark,
+    including the moments a step's result and its inputs are alive at the same time.
+    peak_step is the step it was reached at, None if before the first step.
+    """
+
+    peak_bytes: int = 0
+    peak_step: Optional[int] = None
+    step_bytes: List[int] = attrs.Factory(list)
+
+    def record(self, live_bytes: int, step: Optional[int]):
+        if live_bytes > self.peak_bytes:
+            self.peak_bytes = live_bytes
+            self.peak_step = step
+
+
+@attrs.define
+class ContractionContext:
+    """The execution state of a single contraction of a TensorNetwork.
+
+    The network is only read during a query, everything a contraction updates lives here,
+    so concurrent queries on the same network each work on their own context. ptes has the
+    PTE of each component of the nodes traced so far, under the component's root.
+    """
+
+    legs_left_to_join: Dict[Any, List[Tuple]]
+    ptes: Dict[Any, "_PartiallyTracedEnumerator"] = attrs.Factory(dict)
+    memory_stats: ContractionMemoryStats = attrs.Factory(ContractionMemoryStats)
+    approximation: Optional[ApproximationReport] = None
+    # the PTE of each subtree of an incremental contraction, by its subtree key
+    subtree_ptes: Dict[Tuple, "_PartiallyTracedEnumerator"] = attrs.Factory(dict)
+
 
 class TensorNetwork:
     def __init__(
@@ -53,14 +180,37 @@ class TensorNetwork:
         self.traces = []
         self._cot_tree = None
         self._cot_traces = None
+        # the cotengra plan, and the objective and open legs it was searched for
+        self._cot_plan: Optional[ContractionPlan] = None
+        self._cot_key = None
 
         self.legs_left_to_join = {idx: [] for idx in self.nodes.keys()}
         # self.open_legs = [n.legs for n in self.nodes]
 
-        self._wep = None
-        self.ptes: Dict[int, _PartiallyTracedEnumerator] = {}
+        # exact results by open legs
+        self._weps: Dict[Tuple, Any] = {}
+        # the reports of the last finished query
+        self.memory_stats: Optional[ContractionMemoryStats] = None
+        self.approximation: Optional[ApproximationReport] = None
+        self.hybrid_decisions: Optional[List[HybridDecision]] = None
+        # the subtree PTEs of the last incremental query, and the number of times each
+        # node was replaced, so that the PTEs of replaced nodes are not reused
+        self._subtree_ptes: Dict[Tuple, Any] = {}
+        self._node_versions: Dict[Any, int] = {}
         self._coset = None
         self.truncate_length = truncate_length
+        # guards the cotengra plan and the result cache
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_subtree_ptes"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
 
     def __eq__(self, other: "TensorNetwork") -> bool:
         """Compare two TensorNetworks for equality."""
@@ -178,9 +328,37 @@ class TensorNetwork:
     def n_qubits(self):
         raise NotImplementedError(f"n_qubits() is not implemented for {type(self)}")
 
+    def node_coordinates(self) -> Optional[Dict[Any, Tuple[int, int]]]:
+        """The (r, c) lattice position of each node, None without a lattice."""
+        return None
+
+    def sweep_plan(self) -> SweepPlan:
+        """The sweep across the lattice of the nodes with the smallest frontier.
+
+        No search is needed (see sweep_schedule). The max_frontier of the plan bounds
+        the traced legs of every PTE: d + 1 for RotatedSurfaceCodeTN, 2(d - 1) for
+        SurfaceCodeTN and CompassCodeTN.
+        """
+        coordinates = self.node_coordinates()
+        if coordinates is None:
+            raise ValueError(f"{type(self).__name__} has no lattice to sweep.")
+        return sweep_schedule(self.traces, coordinates)
+
+    def tree_decomposition_plan(
+        self, max_width: Optional[int] = None, heuristic: str = "min_degree"
+    ) -> TreeDecompositionPlan:
+        """A contraction order from a tree decomposition of the network's traces.
+
+        Meant for sparse networks without a lattice, like the Tanner graph codes. The
+        width bounds the traced legs of every PTE, see tree_decomposition_schedule.
+        Raises TreewidthExceeded as soon as the decomposition goes over max_width.
+        """
+        return tree_decomposition_schedule(self.traces, max_width, heuristic)
+
     def _reset_wep(self, keep_cot=False):
 
-        self._wep = None
+        self._weps = {}
+        self._subtree_ptes = {}
 
         prev_traces = deepcopy(self.traces)
         self.traces = []
@@ -189,12 +367,12 @@ class TensorNetwork:
         for trace in prev_traces:
             self.self_trace(trace[0], trace[1], [trace[2][0]], [trace[3][0]])
 
-        self.ptes: Dict[int, _PartiallyTracedEnumerator] = {}
         self._coset = None
 
         if keep_cot:
             self._cot_tree = None
             self._cot_traces = None
+            self._cot_plan = None
 
     def set_coset(self, coset_error: GF2):
         """Sets the coset_error to the tensornetwork.
@@ -251,10 +429,6 @@ class TensorNetwork:
             )
 
     def self_trace(self, node_idx1, node_idx2, join_leg1, join_leg2):
-        if self._wep is not None:
-            raise ValueError(
-                "Tensor network weight enumerator is already traced no new tracing schedule is allowed."
-            )
         join_leg1 = _index_legs(node_idx1, join_leg1)
         join_leg2 = _index_legs(node_idx2, join_leg2)
 
@@ -263,6 +437,49 @@ class TensorNetwork:
 
         self.legs_left_to_join[node_idx1] += join_leg1
         self.legs_left_to_join[node_idx2] += join_leg2
+        self._edited()
+
+    def remove_trace(self, node_idx1, node_idx2, join_leg1, join_leg2):
+        """Removes a trace added by self_trace, leaving its legs dangling."""
+        trace = (
+            node_idx1,
+            node_idx2,
+            _index_legs(node_idx1, join_leg1),
+            _index_legs(node_idx2, join_leg2),
+        )
+        if trace not in self.traces:
+            raise ValueError(f"No trace {trace} in the network.")
+        self.traces.remove(trace)
+        for node_idx, legs in ((node_idx1, trace[2]), (node_idx2, trace[3])):
+            self.legs_left_to_join[node_idx] = [
+                leg for leg in self.legs_left_to_join[node_idx] if leg not in legs
+            ]
+        self._edited()
+
+    def replace_node(self, node: StabilizerCodeTensorEnumerator):
+        """Replaces the node with the same idx, e.g. to change a stopper.
+
+        The new node needs the same legs, so that the traces still apply.
+        """
+        old = self.nodes.get(node.idx)
+        if old is None:
+            raise ValueError(f"No node {node.idx} in the network.")
+        if sorted(node.legs) != sorted(old.legs):
+            raise ValueError(
+                f"Node {node.idx} has legs {node.legs} instead of {old.legs}."
+            )
+        self.nodes[node.idx] = node
+        self._node_versions[node.idx] = self._node_versions.get(node.idx, 0) + 1
+        self._edited()
+
+    def _edited(self):
+        """Drops the results and the schedule, subtree PTEs are kept by their key."""
+        with self._lock:
+            self._weps = {}
+            self._cot_tree = None
+            self._cot_traces = None
+            self._cot_plan = None
+            self._cot_key = None
 
     def traces_to_dot(self):
         print("-----")
@@ -280,28 +497,21 @@ class TensorNetwork:
             leg_indices, free_legs, True
         )
 
-        path = []
-        terms = [{node_idx} for node_idx in input_names]
-
-        def idx(node_id):
-            for i, term in enumerate(terms):
-                if node_id in term:
-                    return i
-            assert (
-                False
-            ), "This should not happen, nodes should be always present in at least one of the terms."
+        # the inputs are the first ssa ids, each contraction creates the next one
+        ssa_path = []
+        components = UnionFind()
+        ssa_of_root = {node_idx: i for i, node_idx in enumerate(input_names)}
 
         for node_idx1, node_idx2, join_legs1, join_legs2 in self.traces:
-            i, j = sorted([idx(node_idx1), idx(node_idx2)])
-            # print((node_idx1, node_idx2), f"=> {i,j}", terms)
-            if i == j:
+            root1 = components.find(node_idx1)
+            root2 = components.find(node_idx2)
+            if root1 == root2:
                 continue
-            path.append({i, j})
-            term2 = terms.pop(j)
-            term1 = terms.pop(i)
-            terms.append(term1.union(term2))
+            ssa_path.append((ssa_of_root.pop(root1), ssa_of_root.pop(root2)))
+            root = components.union(root1, root2)
+            ssa_of_root[root] = len(input_names) + len(ssa_path) - 1
         return ctg.ContractionTree.from_path(
-            inputs, output, size_dict, path=path, check=True
+            inputs, output, size_dict, ssa_path=ssa_path, check=True
         )
 
     def analyze_traces(
@@ -422,12 +632,12 @@ class TensorNetwork:
         if len(self.nodes) == 1 and len(self.traces) == 0:
             return list(self.nodes.values())[0]
 
-        # Map from node_idx to the index of its PTE in ptes list
+        # PTEs by the position of their first node, the components are tracked by
+        # a union-find over the nodes
         nodes = list(self.nodes.values())
-        ptes: List[Tuple[StabilizerCodeTensorEnumerator, Set[str]]] = [
-            (node, {node.idx}) for node in nodes
-        ]
-        node_to_pte = {node.idx: i for i, node in enumerate(nodes)}
+        ptes: Dict[int, StabilizerCodeTensorEnumerator] = dict(enumerate(nodes))
+        components = UnionFind()
+        pte_of_root = {node.idx: i for i, node in enumerate(nodes)}
 
         prog = lambda x: x if not progress_bar else tqdm(x, leave=False)
         for node_idx1, node_idx2, join_legs1, join_legs2 in prog(self.traces):
@@ -439,8 +649,10 @@ class TensorNetwork:
             join_legs1 = _index_legs(node_idx1, join_legs1)
             join_legs2 = _index_legs(node_idx2, join_legs2)
 
-            pte1_idx = node_to_pte.get(node_idx1)
-            pte2_idx = node_to_pte.get(node_idx2)
+            root1 = components.find(node_idx1)
+            root2 = components.find(node_idx2)
+            pte1_idx = pte_of_root[root1]
+            pte2_idx = pte_of_root[root2]
 
             # Case 1: Both nodes are in the same PTE
             if pte1_idx == pte2_idx:
@@ -448,89 +660,71 @@ class TensorNetwork:
                     print(
                         f"Self trace in PTE containing both {node_idx1} and {node_idx2}"
                     )
-                pte, nodes = ptes[pte1_idx]
-                new_pte = pte.self_trace(join_legs1, join_legs2)
-                ptes[pte1_idx] = (new_pte, nodes)
+                ptes[pte1_idx] = ptes[pte1_idx].self_trace(join_legs1, join_legs2)
 
             # Case 2: Nodes are in different PTEs - merge them
             else:
                 if verbose:
                     print(f"Merging PTEs containing {node_idx1} and {node_idx2}")
-                pte1, nodes1 = ptes[pte1_idx]
-                pte2, nodes2 = ptes[pte2_idx]
-                new_pte = pte1.conjoin(pte2, legs1=join_legs1, legs2=join_legs2)
-                merged_nodes = nodes1.union(nodes2)
-
-                # Update the first PTE with merged result
-                ptes[pte1_idx] = (new_pte, merged_nodes)
-                # Remove the second PTE
-                ptes.pop(pte2_idx)
-
-                # Update node_to_pte mappings
-                for node in nodes2:
-                    node_to_pte[node] = pte1_idx
-                # Adjust indices for all nodes in PTEs after the removed one
-                for node, pte_idx in node_to_pte.items():
-                    if pte_idx > pte2_idx:
-                        node_to_pte[node] = pte_idx - 1
+                # Update the first PTE with merged result and remove the second PTE
+                ptes[pte1_idx] = ptes[pte1_idx].conjoin(
+                    ptes.pop(pte2_idx), legs1=join_legs1, legs2=join_legs2
+                )
+                del pte_of_root[root1], pte_of_root[root2]
+                pte_of_root[components.union(root1, root2)] = pte1_idx
 
             if verbose:
                 print("H:")
-                sprint(ptes[0][0].h)
+                sprint(next(iter(ptes.values())).h)
 
         # If we have multiple components at the end, tensor them together
-        if len(ptes) > 1:
-            for other in ptes[1:]:
-                ptes[0] = (ptes[0][0].tensor_with(other[0]), ptes[0][1].union(other[1]))
+        ptes = list(ptes.values())
+        for other in ptes[1:]:
+            ptes[0] = ptes[0].tensor_with(other)
 
-        return ptes[0][0]
+        return ptes[0]
 
     def _collect_legs(self):
         leg_indices = {}
         index_to_legs = {}
-        current_index = 0
         free_legs = []
+        # the trace joining each leg
+        trace_of_leg = {}
+        for node_idx1, node_idx2, join_legs1, join_legs2 in self.traces:
+            for leg1, leg2 in zip(join_legs1, join_legs2):
+                trace_of_leg[leg1] = (node_idx1, node_idx2, leg1, leg2)
+                trace_of_leg[leg2] = (node_idx1, node_idx2, leg1, leg2)
         # Iterate over each node in the tensor network
         for node_idx, node in self.nodes.items():
             # Iterate over each leg in the node
             for leg in node.legs:
-                current_idx_name = f"{leg}"
                 # If the leg is already indexed, skip it
                 if leg in leg_indices:
                     continue
-                # Assign the current index to the leg
-                leg_indices[leg] = current_idx_name
-                index_to_legs[current_idx_name] = [(node_idx, leg)]
-                open_leg = True
-                # Check for traces and assign the same index to traced legs
-                for node_idx1, node_idx2, join_legs1, join_legs2 in self.traces:
-                    idx = -1
-                    if leg in join_legs1:
-                        idx = join_legs1.index(leg)
-                    elif leg in join_legs2:
-                        idx = join_legs2.index(leg)
-                    else:
-                        continue
-                    open_leg = False
-                    current_idx_name = f"{join_legs1[idx]}_{join_legs2[idx]}"
-                    leg_indices[join_legs1[idx]] = current_idx_name
-                    leg_indices[join_legs2[idx]] = current_idx_name
-                    index_to_legs[current_idx_name] = [
-                        (node_idx1, join_legs1[idx]),
-                        (node_idx2, join_legs2[idx]),
-                    ]
-                # Move to the next index
-                if open_leg:
+                trace = trace_of_leg.get(leg)
+                if trace is None:
+                    current_idx_name = f"{leg}"
+                    leg_indices[leg] = current_idx_name
+                    index_to_legs[current_idx_name] = [(node_idx, leg)]
                     free_legs.append(leg)
-                current_index += 1
+                    continue
+                # traced legs share the same index
+                node_idx1, node_idx2, leg1, leg2 = trace
+                current_idx_name = f"{leg1}_{leg2}"
+                leg_indices[leg1] = current_idx_name
+                leg_indices[leg2] = current_idx_name
+                index_to_legs[current_idx_name] = [(node_idx1, leg1), (node_idx2, leg2)]
         return free_legs, leg_indices, index_to_legs
 
-    def _prep_cotengra_inputs(self, leg_indices, free_legs, verbose=False):
+    def _prep_cotengra_inputs(
+        self, leg_indices, free_legs, verbose=False, leg_dimension=2
+    ):
         inputs = []
         output = []  #  tuple(leg_indices[leg] for leg in free_legs)
-        size_dict = {leg: 2 for leg in leg_indices.values()}
+        size_dict = {leg: leg_dimension for leg in leg_indices.values()}
 
         input_names = []
+        free_legs = set(free_legs)
 
         for node_idx, node in self.nodes.items():
             inputs.append(tuple(leg_indices[leg] for leg in node.legs))
@@ -551,14 +745,20 @@ class TensorNetwork:
     def _traces_from_cotengra_tree(
         self, tree: ctg.ContractionTree, index_to_legs, inputs
     ):
+        leaves_of_index = defaultdict(list)
+        for leaf_idx, term in enumerate(inputs):
+            for idx in term:
+                leaves_of_index[idx].append(leaf_idx)
+
         def legs_to_contract(l: frozenset, r: frozenset):
+            # scanning the smaller side only keeps the whole traversal O(n log n)
+            small, large = (l, r) if len(l) <= len(r) else (r, l)
             res = []
-            left_indices = sum((list(inputs[leaf_idx]) for leaf_idx in l), [])
-            right_indices = sum((list(inputs[leaf_idx]) for leaf_idx in r), [])
-            for idx1 in left_indices:
-                if idx1 in right_indices:
-                    legs = index_to_legs[idx1]
-                    res.append((legs[0][0], legs[1][0], [legs[0][1]], [legs[1][1]]))
+            for leaf_idx in small:
+                for idx in inputs[leaf_idx]:
+                    if any(other in large for other in leaves_of_index[idx]):
+                        legs = index_to_legs[idx]
+                        res.append((legs[0][0], legs[1][0], [legs[0][1]], [legs[1][1]]))
             return res
 
         # We convert the tree back to a list of traces
@@ -568,10 +768,15 @@ class TensorNetwork:
             new_traces = legs_to_contract(l, r)
             traces += new_traces
 
+        trace_positions = {}
+        for i, (node_idx1, node_idx2, join_legs1, join_legs2) in enumerate(self.traces):
+            trace_positions.setdefault(
+                (node_idx1, node_idx2, tuple(join_legs1), tuple(join_legs2)), i
+            )
         trace_indices = []
         for t in traces:
-            assert t in self.traces, f"{t} not in traces. Traces: {self.traces}"
-            idx = self.traces.index(t)
+            idx = trace_positions.get((t[0], t[1], tuple(t[2]), tuple(t[3])))
+            assert idx is not None, f"{t} not in traces. Traces: {self.traces}"
             trace_indices.append(idx)
 
         assert set(trace_indices) == set(
@@ -586,18 +791,99 @@ class TensorNetwork:
         index_to_legs,
         verbose=False,
         progress_bar=False,
+        open_legs_per_node=None,
+        plan_cache: Optional[PlanCache] = None,
         **cotengra_opts,
     ):
 
-        if self._cot_traces is not None:
-            return self._cot_traces, self._cot_tree
+        with self._lock:
+            minimize = cotengra_opts.get("minimize", "size")
+            memo_key = (minimize, None)
+            if minimize in PTE_OBJECTIVES:
+                if open_legs_per_node is None:
+                    open_legs_per_node = self._open_legs_per_node(free_legs, [])
+                # PTE costs, unlike cotengra's, depend on the open legs
+                memo_key = (
+                    minimize,
+                    frozenset(
+                        (node_idx, tuple(legs))
+                        for node_idx, legs in open_legs_per_node.items()
+                    ),
+                )
+            plan = self._cot_plan if self._cot_key == memo_key else None
+
+            def search():
+                return self._cotengra_search(
+                    free_legs,
+                    leg_indices,
+                    index_to_legs,
+                    verbose,
+                    progress_bar,
+                    open_legs_per_node=open_legs_per_node,
+                    **cotengra_opts,
+                )
+
+            if plan_cache is not None:
+                key = structural_hash(
+                    self.nodes,
+                    self.traces,
+                    minimize,
+                    open_legs_per_node if minimize in PTE_OBJECTIVES else None,
+                )
+                cached = plan_cache.get(key)
+                if plan_cache.refine or (plan is None and cached is None):
+                    plan = search()
+                elif plan is None:
+                    plan = cached
+                # keeps the better of the two plans, and shares ours if it is better
+                plan = plan_cache.put(key, plan)
+            elif plan is None:
+                plan = search()
+            if plan is not self._cot_plan:
+                self._cot_tree = plan.tree
+                self._cot_traces = deepcopy(plan.traces)
+                self._cot_plan = plan
+            self._cot_key = memo_key
+        return self._cot_traces, self._cot_tree
+
+    def _cotengra_search(
+        self,
+        free_legs,
+        leg_indices,
+        index_to_legs,
+        verbose=False,
+        progress_bar=False,
+        open_legs_per_node=None,
+        **cotengra_opts,
+    ) -> ContractionPlan:
+        """Searches a contraction tree with cotengra, returns it with its traces.
 
+        minimize can be one of cotengra's objectives, or one of PTE_OBJECTIVES to score
+        trees by the estimated PTE cost (see PTECostObjective) of the contraction with
+        open_legs_per_node (default: no open legs). As PTE keys are Paulis, legs then
+        have dimension 4 for cotengra's own heuristics.
+        """
+        minimize = cotengra_opts.pop("minimize", "size")
         inputs, output, size_dict, input_names = self._prep_cotengra_inputs(
-            leg_indices, free_legs, verbose
+            leg_indices,
+            free_legs,
+            verbose,
+            leg_dimension=4 if minimize in PTE_OBJECTIVES else 2,
         )
+        if minimize in PTE_OBJECTIVES:
+            if open_legs_per_node is None:
+                open_legs_per_node = self._open_legs_per_node(free_legs, [])
+            minimize = PTECostObjective(
+                self.nodes,
+                input_names,
+                self.traces,
+                open_legs_per_node,
+                truncate_length=self.truncate_length,
+                minimize=PTE_OBJECTIVES[minimize],
+            )
 
         contengra_params = {
-            "minimize": "size",
+            "minimize": minimize,
             "parallel": True,
         }
         contengra_params.update(cotengra_opts)
@@ -606,13 +892,193 @@ class TensorNetwork:
             progbar=progress_bar,
         )
 
-        self._cot_tree = opt.search(inputs, output, size_dict)
+        tree = opt.search(inputs, output, size_dict)
 
-        self._cot_traces = self._traces_from_cotengra_tree(
-            self._cot_tree, index_to_legs=index_to_legs, inputs=inputs
+        traces = self._traces_from_cotengra_tree(
+            tree, index_to_legs=index_to_legs, inputs=inputs
         )
 
-        return self._cot_traces, self._cot_tree
+        return ContractionPlan(tree, traces, opt.best["score"])
+
+    def _open_legs_per_node(self, free_legs, open_legs):
+        """The legs each node's tensor is computed with: its traced legs and the open_legs."""
+        open_legs_per_node = defaultdict(list)
+        free_legs = set(free_legs)
+        for node_idx, node in self.nodes.items():
+            for leg in node.legs:
+                if leg not in free_legs:
+                    open_legs_per_node[node_idx].append(_index_leg(node_idx, leg))
+
+        for node_idx, leg_index in open_legs:
+            open_legs_per_node[node_idx].append(_index_leg(node_idx, leg_index))
+        return open_legs_per_node
+
+    def _node_pte(
+        self,
+        node_idx,
+        traced_legs: List[Tuple],
+        verbose: bool = False,
+        progress_bar: bool = False,
+        memory_limit: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        compress: bool = False,
+        leg_values: Optional[Dict[Tuple, Tuple[int, int]]] = None,
+        cancel: Optional[CancellationToken] = None,
+    ) -> "_PartiallyTracedEnumerator":
+        """The PTE of a single node, enumerated on its traced_legs.
+
+        Only the keys with the given Paulis (as (x, z) bits) on the legs in leg_values are kept.
+        """
+        node = self.nodes[node_idx]
+        return self._enumerated_pte(
+            node,
+            {node_idx},
+            traced_legs,
+            verbose=verbose,
+            progress_bar=progress_bar,
+            memory_limit=memory_limit,
+            spill_dir=spill_dir,
+            compress=compress,
+            leg_values=leg_values,
+            cancel=cancel,
+        )
+
+    def _enumerated_pte(
+        self,
+        enum: StabilizerCodeTensorEnumerator,
+        nodes: Set,
+        traced_legs: List[Tuple],
+        verbose: bool = False,
+        progress_bar: bool = False,
+        memory_limit: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        compress: bool = False,
+        leg_values: Optional[Dict[Tuple, Tuple[int, int]]] = None,
+        cancel: Optional[CancellationToken] = None,
+    ) -> "_PartiallyTracedEnumerator":
+        """The PTE of the subnetwork of nodes, enumerated by brute force from enum."""
+        tensor = enum.stabilizer_enumerator_polynomial(
+            open_legs=traced_legs,
+            verbose=verbose,
+            progress_bar=progress_bar,
+            cancel=cancel,
+        )
+        if len(traced_legs) == 0:
+            tensor = {(): tensor}
+        if leg_values:
+            n = len(traced_legs)
+            fixed = [
+                (i, leg_values[leg])
+                for i, leg in enumerate(traced_legs)
+                if leg in leg_values
+            ]
+            tensor = {
+                k: v
+                for k, v in tensor.items()
+                if all((k[i], k[i + n]) == pauli for i, pauli in fixed)
+            }
+        if compress:
+            tensor = AffineTensor.from_items(tensor.items(), 2 * len(traced_legs))
+        pte = _PartiallyTracedEnumerator(
+            nodes=set(nodes),
+            tracable_legs=traced_legs,
+            tensor=tensor,
+            truncate_length=self.truncate_length,
+            memory_limit=memory_limit,
+            spill_dir=spill_dir,
+        )
+        pte.spill_if_needed()
+        return pte
+
+    def _with_cosets(
+        self, enum: StabilizerCodeTensorEnumerator, nodes: Set
+    ) -> StabilizerCodeTensorEnumerator:
+        """The conjoined parity check of nodes with their cosets and truncation."""
+        return StabilizerCodeTensorEnumerator(
+            enum.h,
+            idx=enum.idx,
+            legs=enum.legs,
+            coset_flipped_legs=[
+                flip
+                for node_idx in nodes
+                for flip in self.nodes[node_idx].coset_flipped_legs
+            ],
+            truncate_length=self.truncate_length,
+        )
+
+    def _coset_traced_nodes(self) -> Set:
+        """Nodes with a coset flipped leg that is traced, they can't be conjoined."""
+        traced = {
+            _index_leg(node_idx, leg)
+            for node_idx1, node_idx2, join_legs1, join_legs2 in self.traces
+            for node_idx, legs in ((node_idx1, join_legs1), (node_idx2, join_legs2))
+            for leg in legs
+        }
+        return {
+            node_idx
+            for node_idx, node in self.nodes.items()
+            if any(leg in traced for leg, _ in node.coset_flipped_legs)
+        }
+
+    def estimate_cost(
+        self,
+        open_legs: List[Tuple[int, int]] = [],
+        truncate_length: Optional[int] = None,
+        cotengra: bool = True,
+        verbose: bool = False,
+        progress_bar: bool = False,
+        cotengra_minimize: str = "size",
+        plan_cache: Optional[PlanCache] = None,
+        sweep: bool = False,
+        tree_decomposition: bool = False,
+        max_treewidth: Optional[int] = None,
+    ) -> ContractionCostReport:
+        """Predicts the per step PTE sizes, peak memory and operation counts of a contraction.
+
+        Nothing is enumerated: the key count of each PTE is derived from the GF2 rank of the
+        parity check of its subnetwork. The schedule is the same one
+        stabilizer_enumerator_polynomial would run with the same open_legs and planner
+        options.
+        """
+        _check_planner(sweep, tree_decomposition, max_treewidth)
+        free_legs, leg_indices, index_to_legs = self._collect_legs()
+        open_legs_per_node = self._open_legs_per_node(free_legs, open_legs)
+        traces = self.traces
+        if sweep:
+            traces = self.sweep_plan().traces
+        elif tree_decomposition:
+            traces = self.tree_decomposition_plan(max_treewidth).traces
+        elif cotengra:
+            traces, _ = self._cotengra_contraction(
+                free_legs,
+                leg_indices,
+                index_to_legs,
+                verbose,
+                progress_bar,
+                open_legs_per_node=open_legs_per_node,
+                plan_cache=plan_cache,
+                minimize=cotengra_minimize,
+            )
+        return estimate_contraction_cost(
+            self.nodes,
+            traces,
+            open_legs_per_node,
+            truncate_length=(
+                truncate_length if truncate_length is not None else self.truncate_length
+            ),
+        )
+
+    def partition_nodes(
+        self, k: int, imbalance: float = 0.03, seed: int = 0
+    ) -> Dict[Any, int]:
+        """Splits the nodes into k balanced parts with few traced legs between them.
+
+        The partitioning is done by kahypar (see kahypar_partition), returns the part of
+        each node.
+        """
+        return kahypar_partition(
+            list(self.nodes), self.traces, k, imbalance=imbalance, seed=seed
+        )
 
     def stabilizer_enumerator_polynomial(
         self,
@@ -620,216 +1086,1054 @@ class TensorNetwork:
         verbose: bool = False,
         progress_bar: bool = False,
         cotengra: bool = True,
+        memory_limit: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        workers: int = 1,
+        checkpoint_dir: Optional[str] = None,
+        checkpoint_every: Optional[int] = None,
+        checkpoint_interval: Optional[float] = 600.0,
+        resume_from: Optional[str] = None,
+        compress: bool = False,
+        max_keys: Optional[int] = None,
+        key_priority: str = "min_weight",
+        slice_legs: Optional[List[Tuple]] = None,
+        progress_callback: Optional[ProgressCallback] = None,
+        cancel: Optional[CancellationToken] = None,
+        parallel_subtrees: bool = False,
+        partitions: Optional[int] = None,
+        cluster: Optional[Cluster] = None,
+        hybrid: bool = False,
+        incremental: bool = False,
+        cotengra_minimize: str = "size",
+        plan_cache: Optional[PlanCache] = None,
+        sweep: bool = False,
+        tree_decomposition: bool = False,
+        max_treewidth: Optional[int] = None,
     ) -> SimplePoly:
+        """Stabilizer enumerator polynomial of the tensor network via contraction.
+
+        If open_legs is left empty, the result is the scalar stabilizer enumerator polynomial,
+        otherwise it is a tensor keyed by the Pauli operators on the open_legs.
+
+        With cotengra, the schedule is searched to minimize cotengra_minimize: one of
+        cotengra's objectives on legs of dimension 2, or "pte" / "pte-size" for the
+        estimated operations / largest PTE of the contraction (see PTECostObjective).
+        The schedule is kept for later queries with the same objective. With a
+        plan_cache, schedules are also shared with other networks of the same structure
+        (see PlanCache), and only searched when the cache has none.
+
+        With sweep, networks on a lattice skip the search and run their sweep_plan,
+        which keeps the PTEs to the legs on the O(d) frontier of the sweep.
+
+        With tree_decomposition, the schedule is derived from a tree decomposition of
+        the traces instead (see tree_decomposition_plan), which takes milliseconds on
+        sparse networks. It fails with TreewidthExceeded before contracting anything if
+        the width is over max_treewidth. sweep and tree_decomposition exclude each other.
+
+        memory_limit (in bytes) bounds the estimated size of any single PTE tensor kept in
+        memory. Tensors beyond it are spilled to memory-mapped partitions under spill_dir
+        (default: the system temp dir), and merges and self traces on them run as
+        partition-wise external joins.
+
+        A merge that leaves no legs open (typically the last step of a scalar enumerator) is
+        computed as a streamed inner product, sharded across `workers` processes.
+
+        With a checkpoint_dir, the live PTEs, legs_left_to_join and the position in the trace
+        schedule are saved there every checkpoint_every steps or checkpoint_interval seconds.
+        Only the PTEs created since the previous checkpoint are written. resume_from continues
+        a contraction of the same network and open_legs from the checkpoint in that directory
+        (and keeps checkpointing there unless another checkpoint_dir is given).
+
+        With compress, PTE tensors are stored as AffineTensors: polynomials indexed by the
+        coordinates of their key in a basis of the support of the tensor, and merges and
+        self traces between them run on those coordinates.
+
+        max_keys makes the contraction approximate: after each step only the max_keys keys
+        of the PTE with the lowest minimum weight (key_priority="min_weight") or the largest
+        sum of coefficients (key_priority="mass") are kept. What was discarded and the
+        resulting error bound on the coefficients are reported in self.approximation.
+
+        The network is not modified by a query, so queries can run concurrently from several
+        threads. Exact results are cached by open_legs. memory_stats and approximation are
+        the reports of the last finished query. Without truncation, a query on a subset
+        of the open legs of a cached tensor is answered from it (see open_leg_tensor).
+
+        progress_callback is called with a ContractionProgress after each step (each slice
+        for sliced contractions). Cancelling cancel, from any thread, stops the contraction
+        with ContractionCancelled within a chunk of its inner loops.
+
+        slice_legs (e.g. from cotengra_slice_legs) splits the contraction into independent
+        slices, one for each combination of Paulis on the given traced legs, that are summed
+        at the end. With workers > 1 the slices run in a process pool.
+
+        With parallel_subtrees and workers > 1, the independent subtrees of the schedule
+        (including disjoint components) are contracted concurrently in a process pool,
+        each as soon as its inputs are ready.
+
+        partitions splits the network into that many balanced parts with few legs traced
+        between them (see partition_nodes). Each part is contracted on its own with its
+        cut legs open, then the part tensors are joined across the cut. With workers > 1
+        the parts are contracted concurrently, as with parallel_subtrees (and with the
+        same restrictions).
+
+        With a cluster (see qlego.cluster), the subtrees of the schedule are contracted
+        on its workers, possibly on other hosts, as with parallel_subtrees.
+
+        With hybrid, subtrees of the schedule whose conjoined parity check is estimated
+        to be cheaper to brute force than to contract are brute forced (see
+        plan_hybrid_contraction). Subtrees with a sliced trace are always contracted.
+        The decisions are kept in self.hybrid_decisions.
+
+        With incremental, the PTE of each subtree of the schedule is kept after the
+        query. The next incremental query, after editing the network with self_trace,
+        remove_trace or replace_node, reuses the PTEs of the subtrees that have the same
+        nodes, traces and open legs, and only contracts the rest. Subtrees are matched
+        by their steps, so only a schedule that keeps the untouched subtrees (e.g.
+        cotengra=False) reuses them. The kept PTEs take memory until the next query.
+        """
+        if key_priority not in KEY_PRIORITIES:
+            raise ValueError(
+                f"Unknown key priority {key_priority}, it should be one of {KEY_PRIORITIES}"
+            )
+        _check_planner(sweep, tree_decomposition, max_treewidth)
+        query = tuple(open_legs)
+        with self._lock:
+            if query in self._weps:
+                return self._weps[query]
+            wep = self._derived_wep(open_legs)
+            if wep is not None:
+                self._weps[query] = wep
+                return wep
         free_legs, leg_indices, index_to_legs = self._collect_legs()
 
-        open_legs_per_node = defaultdict(list)
-        for node_idx, node in self.nodes.items():
-            for leg in node.legs:
-                if leg not in free_legs:
-                    open_legs_per_node[node_idx].append(_index_leg(node_idx, leg))
-
-        for node_idx, leg_index in open_legs:
-            open_legs_per_node[node_idx].append(_index_leg(node_idx, leg_index))
+        open_legs_per_node = self._open_legs_per_node(free_legs, open_legs)
 
         if verbose:
             print("open_legs_per_node", open_legs_per_node)
+        fingerprint = None
+        manifest = None
+        if checkpoint_dir is not None or resume_from is not None:
+            fingerprint = contraction_fingerprint(
+                self.nodes, self.traces, open_legs_per_node, self.truncate_length
+            )
         traces = self.traces
-        if cotengra:
+        if resume_from is not None:
+            manifest = load_checkpoint(resume_from, fingerprint)
+            # cotengra's search is randomized, the checkpointed schedule has to be kept
+            traces = manifest["traces"]
+        elif sweep:
+            traces = self.sweep_plan().traces
+        elif tree_decomposition:
+            plan = self.tree_decomposition_plan(max_treewidth)
+            if verbose:
+                print(f"tree decomposition of width {plan.width}")
+            traces = plan.traces
+        elif cotengra:
             traces, _ = self._cotengra_contraction(
-                free_legs, leg_indices, index_to_legs, verbose, progress_bar
+                free_legs,
+                leg_indices,
+                index_to_legs,
+                verbose,
+                progress_bar,
+                open_legs_per_node=open_legs_per_node,
+                plan_cache=plan_cache,
+                minimize=cotengra_minimize,
             )
-        summed_legs = [leg for leg in free_legs if leg not in open_legs]
-        if self._wep is not None:
-            return self._wep
 
         if len(self.traces) == 0 and len(self.nodes) == 1:
             return list(self.nodes.items())[0][1].stabilizer_enumerator_polynomial(
-                verbose=verbose, progress_bar=progress_bar
+                verbose=verbose, progress_bar=progress_bar, cancel=cancel
             )
 
-        parity_check_enums = {}
+        if partitions is not None and resume_from is None:
+            parts = self.partition_nodes(partitions)
+            traces = partitioned_schedule(traces, parts)
+            if verbose:
+                sizes, cut_legs = partition_summary(self.traces, parts)
+                print(f"partitioned into parts of {sizes} nodes, {cut_legs} cut legs")
+
+        # what makes the contraction run on parallel subtrees, for the errors
+        parallel = None
+        if parallel_subtrees:
+            parallel = "parallel subtrees"
+        elif cluster is not None:
+            parallel = "a cluster"
+        elif partitions is not None and resume_from is None and workers > 1:
+            parallel = "partitions with workers > 1"
+        parallel_subtrees = parallel is not None
+
+        if slice_legs and (checkpoint_dir is not None or resume_from is not None):
+            raise ValueError("Sliced contractions can't be checkpointed.")
+        if parallel_subtrees and (
+            slice_legs or checkpoint_dir is not None or resume_from is not None
+        ):
+            raise ValueError(
+                f"Contractions on {parallel} can't be sliced or checkpointed."
+            )
+        if incremental and (
+            slice_legs
+            or parallel_subtrees
+            or hybrid
+            or max_keys is not None
+            or checkpoint_dir is not None
+            or resume_from is not None
+        ):
+            raise ValueError(
+                "Incremental contractions can't be sliced, approximate, hybrid, "
+                f"checkpointed or run on {parallel or 'parallel subtrees'}."
+            )
+        hybrid_plan = None
+        if hybrid:
+            if parallel_subtrees:
+                raise ValueError(f"Contractions on {parallel} can't be hybrid.")
+            # brute forced subtrees only see the values of their boundary legs, so
+            # the sliced traces have to stay outside of them
+            sliced_nodes = {
+                leg[0] for pair in self._slice_pairs(slice_legs or []) for leg in pair
+            }
+            hybrid_plan = plan_hybrid_contraction(
+                self.nodes,
+                traces,
+                open_legs_per_node,
+                self.truncate_length,
+                excluded_nodes=self._coset_traced_nodes() | sliced_nodes,
+            )
+            if verbose:
+                for decision in hybrid_plan.decisions:
+                    print(decision)
+        checkpoint = None
+        if checkpoint_dir is not None or resume_from is not None:
+            checkpoint = ContractionCheckpoint(
+                checkpoint_dir if checkpoint_dir is not None else resume_from,
+                fingerprint,
+                every_steps=checkpoint_every,
+                interval=checkpoint_interval,
+            )
 
-        for node_idx, node in self.nodes.items():
-            traced_legs = open_legs_per_node[node_idx]
-            # TODO: figure out tensor caching
-            # traced_leg_indices = "".join(
-            #     [str(i) for i in sorted([node.legs.index(leg) for leg in traced_legs])]
-            # )
-            # hkey = sstr(gauss(node.h)) + ";" + traced_leg_indices
-            # if hkey not in parity_check_enums:
-            #     parity_check_enums[hkey] = node.stabilizer_enumerator_polynomial(
-            #         open_legs=traced_legs
-            #     )
-            # else:
-            #     print("Found one!")
-            #     calc = node.stabilizer_enumerator_polynomial(open_legs=traced_legs)
-            #     assert (
-            #         calc == parity_check_enums[hkey]
-            #     ), f"for key {hkey}\n calc\n{calc}\n vs retrieved\n{parity_check_enums[hkey]}"
-            tensor = node.stabilizer_enumerator_polynomial(
-                open_legs=traced_legs, verbose=verbose, progress_bar=progress_bar
+        context = ContractionContext(legs_left_to_join=deepcopy(self.legs_left_to_join))
+        contraction_opts = dict(
+            verbose=verbose,
+            progress_bar=progress_bar,
+            memory_limit=memory_limit,
+            spill_dir=spill_dir,
+            compress=compress,
+            max_keys=max_keys,
+            key_priority=key_priority,
+        )
+        if hybrid_plan is not None:
+            contraction_opts["hybrid_plan"] = hybrid_plan
+        if incremental:
+            contraction_opts["subtree_cache"] = self._subtree_ptes
+        if slice_legs:
+            wep = self._sliced_contraction(
+                context,
+                traces,
+                open_legs,
+                open_legs_per_node,
+                slice_legs,
+                workers=workers,
+                cancel=cancel,
+                progress_callback=progress_callback,
+                **contraction_opts,
             )
-            if len(traced_legs) == 0:
-                tensor = {(): tensor}
-            self.ptes[node_idx] = _PartiallyTracedEnumerator(
-                nodes={node_idx},
-                tracable_legs=open_legs_per_node[node_idx],
-                tensor=tensor,  # deepcopy(parity_check_enums[hkey]),
-                truncate_length=self.truncate_length,
+        elif parallel_subtrees and (workers > 1 or cluster is not None):
+            wep = self._parallel_contraction(
+                context,
+                traces,
+                open_legs,
+                open_legs_per_node,
+                workers=workers,
+                cancel=cancel,
+                progress_callback=progress_callback,
+                cluster=cluster,
+                **contraction_opts,
+            )
+        else:
+            wep = self._contract(
+                context,
+                traces,
+                open_legs,
+                open_legs_per_node,
+                workers=workers,
+                checkpoint=checkpoint,
+                manifest=manifest,
+                resume_from=resume_from,
+                cancel=cancel,
+                progress_callback=progress_callback,
+                **contraction_opts,
+            )
+
+        approximation = context.approximation
+        if isinstance(wep, SimplePoly):
+            if verbose:
+                print(f"final scalar wep: {wep}")
+            if approximation is not None:
+                approximation.computed_mass = poly_mass(wep)
+                if wep[0] > 1:
+                    approximation.normalization = wep[0]
+            wep = wep.normalize(verbose=verbose)
+        elif approximation is not None:
+            approximation.computed_mass = sum(poly_mass(v) for v in wep.values())
+
+        with self._lock:
+            self.memory_stats = context.memory_stats
+            self.approximation = approximation
+            self.hybrid_decisions = (
+                hybrid_plan.decisions if hybrid_plan is not None else None
             )
+            if incremental:
+                self._subtree_ptes = context.subtree_ptes
+            if max_keys is None:
+                self._weps[query] = wep
+        return wep
+
+    def _derived_wep(self, open_legs: List[Tuple[int, int]]):
+        """The result for open_legs marginalized from the smallest cached superset.
 
+        Truncated contractions drop terms along the way, so their marginals don't match
+        what contracting with fewer open legs gives, and are not used.
+        """
+        if self.truncate_length is not None:
+            return None
+        supersets = [
+            cached
+            for cached, wep in self._weps.items()
+            if isinstance(wep, dict) and set(open_legs) <= set(cached)
+        ]
+        if not supersets:
+            return None
+        cached = min(supersets, key=len)
+        return self.open_leg_tensor(cached).query(open_legs)
+
+    def open_leg_tensor(
+        self, open_legs: List[Tuple[int, int]], **kwargs
+    ) -> OpenLegTensor:
+        """Contracts the network once with open_legs open and keeps the tensor.
+
+        stabilizer_enumerator_polynomial then answers queries on any subset of
+        open_legs, including the scalar enumerator, by marginalizing this tensor. The
+        returned OpenLegTensor also derives punctured and shortened enumerators and
+        slices. kwargs are passed on to stabilizer_enumerator_polynomial.
+        """
+        tensor = self.stabilizer_enumerator_polynomial(open_legs=open_legs, **kwargs)
+        if isinstance(tensor, SimplePoly):
+            # a network of a single node ignores open_legs
+            raise ValueError(f"Contracting with {open_legs} open gave a scalar.")
+        flips = {}
+        for node_idx, leg in open_legs:
+            for flipped_leg, pauli in self.nodes[node_idx].coset_flipped_legs:
+                if flipped_leg == _index_leg(node_idx, leg):
+                    flips[(node_idx, leg)] = (int(pauli[0]), int(pauli[1]))
+        return OpenLegTensor(open_legs, tensor, self.truncate_length, flips)
+
+    def _contract(
+        self,
+        context: ContractionContext,
+        traces: List[Tuple],
+        open_legs: List[Tuple[int, int]],
+        open_legs_per_node: Dict[Any, List[Tuple]],
+        verbose: bool = False,
+        progress_bar: bool = False,
+        memory_limit: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        workers: int = 1,
+        checkpoint: Optional[ContractionCheckpoint] = None,
+        manifest: Optional[Dict[str, Any]] = None,
+        resume_from: Optional[str] = None,
+        compress: bool = False,
+        max_keys: Optional[int] = None,
+        key_priority: str = "min_weight",
+        leg_values: Optional[Dict[Tuple, Tuple[int, int]]] = None,
+        cancel: Optional[CancellationToken] = None,
+        progress_callback: Optional[ProgressCallback] = None,
+        hybrid_plan: Optional[HybridPlan] = None,
+        subtree_cache: Optional[Dict[Tuple, "_PartiallyTracedEnumerator"]] = None,
+    ) -> Union[SimplePoly, Dict[Tuple[int, ...], SimplePoly]]:
+        """Runs the trace schedule on the node PTEs.
+
+        Returns the unnormalized scalar polynomial, or the tensor keyed by the Paulis on
+        open_legs. leg_values fixes the Pauli (as (x, z) bits) on some of the traced legs.
+        The subtrees in hybrid_plan.brute_force are enumerated from their conjoined
+        parity checks at their last step. With a subtree_cache, the PTEs of the subtrees
+        in it are reused, and the PTEs of all subtrees are kept in context.subtree_ptes.
+        All state is kept in context.
+        """
+        # only the PTEs alive at a time are counted, each once, by id as hashing a PTE
+        # hashes its nodes
+        live_bytes: Dict[int, int] = {}
+        live_total = 0
+        started = time.monotonic()
+        ptes = context.ptes
+        memory_stats = context.memory_stats
+        if max_keys is not None:
+            context.approximation = ApproximationReport(
+                max_keys=max_keys,
+                key_priority=key_priority,
+                exact_mass=contraction_mass(self.nodes, self.traces),
+            )
+
+        components = UnionFind()
+        # the key of a subtree is made of the keys of its two subtrees and its step,
+        # down to the version and open legs of its nodes
+        subtree_keys: Dict[Any, Tuple] = {}
+
+        def subtree_key(root) -> Tuple:
+            if root not in subtree_keys:
+                subtree_keys[root] = (
+                    "node",
+                    root,
+                    self._node_versions.get(root, 0),
+                    tuple(open_legs_per_node[root]),
+                    compress,
+                )
+            return subtree_keys[root]
+
+        def node_pte(node_idx):
+            nonlocal live_total
+            root = components.find(node_idx)
+            # node tensors are enumerated right before their first use
+            if root not in ptes:
+                pte = None
+                if subtree_cache is not None:
+                    pte = subtree_cache.get(subtree_key(root))
+                if pte is None:
+                    pte = self._node_pte(
+                        node_idx,
+                        open_legs_per_node[node_idx],
+                        verbose=verbose,
+                        progress_bar=progress_bar,
+                        memory_limit=memory_limit,
+                        spill_dir=spill_dir,
+                        compress=compress,
+                        leg_values=leg_values,
+                        cancel=cancel,
+                    )
+                if subtree_cache is not None:
+                    context.subtree_ptes[subtree_key(root)] = pte
+                ptes[root] = pte
+                live_bytes[id(pte)] = estimate_tensor_bytes(pte.tensor)
+                live_total += live_bytes[id(pte)]
+                memory_stats.record(live_total, cursor)
+            return ptes[root]
+
+        start = 0
+        if manifest is not None:
+            if verbose:
+                print(f"resuming from step {manifest['cursor']} of {resume_from}")
+            start = manifest["cursor"]
+            context.legs_left_to_join = deepcopy(manifest["legs_left_to_join"])
+            for record in manifest["ptes"]:
+                pte = _PartiallyTracedEnumerator(
+                    nodes=record["nodes"],
+                    tracable_legs=record["tracable_legs"],
+                    tensor={},
+                    truncate_length=self.truncate_length,
+                    memory_limit=memory_limit,
+                    spill_dir=spill_dir,
+                )
+                tensor = pte._accumulator(len(pte.tracable_legs))
+                for k, v in read_tensor(
+                    os.path.join(resume_from, record["file"]),
+                    2 * len(pte.tracable_legs),
+                ):
+                    tensor.add(k, v)
+                pte.tensor = tensor.finalize()
+                if compress and not isinstance(pte.tensor, SpilledTensor):
+                    pte.tensor = AffineTensor.from_items(
+                        pte.tensor.items(), 2 * len(pte.tracable_legs)
+                    )
+                first = next(iter(pte.nodes))
+                for node_idx in pte.nodes:
+                    components.union(first, node_idx)
+                ptes[components.find(first)] = pte
+                live_bytes[id(pte)] = estimate_tensor_bytes(pte.tensor)
+                live_total += live_bytes[id(pte)]
+                if checkpoint.directory == resume_from:
+                    checkpoint.register(pte, record["file"])
+
+        steps = fuse_traces(traces)
         prog = lambda x: (
             x
             if not progress_bar
-            else tqdm(x, leave=False, desc=f"{len(traces)} traces")
+            else tqdm(
+                x, leave=False, desc=f"{len(traces)} traces in {len(steps)} steps"
+            )
         )
-        for node_idx1, node_idx2, join_legs1, join_legs2 in prog(traces):
+        cursor = None
+        for cursor, step in enumerate(prog(steps[start:]), start=start):
+            if cancel is not None:
+                cancel.check()
+            node_idx1, node_idx2, _, _ = step[0]
             if verbose:
+                print(f"==== step {step} ==== ")
                 print(
-                    f"==== trace { node_idx1, node_idx2, join_legs1, join_legs2} ==== "
+                    f"Total legs left to join: {sum(len(legs) for legs in context.legs_left_to_join.values())}"
                 )
-                print(
-                    f"Total legs left to join: {sum(len(legs) for legs in self.legs_left_to_join.values())}"
+            legs_left_to_join = context.legs_left_to_join
+            for n1, n2, legs1, legs2 in step:
+                legs_left_to_join[n1] = [
+                    leg for leg in legs_left_to_join[n1] if leg not in legs1
+                ]
+                legs_left_to_join[n2] = [
+                    leg for leg in legs_left_to_join[n2] if leg not in legs2
+                ]
+            key = cached = None
+            if subtree_cache is not None:
+                root1 = components.find(node_idx1)
+                root2 = components.find(node_idx2)
+                key = (
+                    "step",
+                    subtree_key(root1),
+                    subtree_key(root2) if root2 != root1 else None,
+                    tuple((n1, n2, tuple(l1), tuple(l2)) for n1, n2, l1, l2 in step),
                 )
-            node1_pte = None if node_idx1 not in self.ptes else self.ptes[node_idx1]
-            node2_pte = None if node_idx2 not in self.ptes else self.ptes[node_idx2]
-
-            # print(f"PTEs: {node1_pte}, {node2_pte}")
-
-            if node1_pte == node2_pte:
-                # both nodes are in the same PTE!
+                cached = subtree_cache.get(key)
+            if hybrid_plan is not None and cursor in hybrid_plan.skipped:
+                # part of a subtree that is brute forced at its last step
+                components.union(node_idx1, node_idx2)
+                continue
+            if hybrid_plan is not None and cursor in hybrid_plan.brute_force:
+                enum, nodes, tracable_legs = hybrid_plan.brute_force[cursor]
                 if verbose:
-                    print(f"self trace within PTE {node1_pte}")
-                pte = node1_pte.self_trace(
-                    join_legs1=[
-                        (node_idx1, leg) if isinstance(leg, int) else leg
-                        for leg in join_legs1
-                    ],
-                    join_legs2=[
-                        (node_idx2, leg) if isinstance(leg, int) else leg
-                        for leg in join_legs2
-                    ],
-                    progress_bar=progress_bar,
+                    print(f"brute forcing the subnetwork of {len(nodes)} nodes")
+                pte = self._enumerated_pte(
+                    self._with_cosets(enum, nodes),
+                    nodes,
+                    tracable_legs,
                     verbose=verbose,
+                    progress_bar=progress_bar,
+                    memory_limit=memory_limit,
+                    spill_dir=spill_dir,
+                    compress=compress,
+                    leg_values=leg_values,
+                    cancel=cancel,
                 )
-                for node in pte.nodes:
-                    self.ptes[node] = pte
-                self.legs_left_to_join[node_idx1] = [
-                    leg
-                    for leg in self.legs_left_to_join[node_idx1]
-                    if leg not in join_legs1
-                ]
-                self.legs_left_to_join[node_idx2] = [
-                    leg
-                    for leg in self.legs_left_to_join[node_idx2]
-                    if leg not in join_legs2
-                ]
-            else:
+                consumed = []
+            elif cached is not None:
                 if verbose:
-                    print(f"MERGING two components {node1_pte} and {node2_pte}")
-                    print(f"node1_pte {node1_pte}:")
-                    for k in list(node1_pte.tensor.keys()):
-                        v = node1_pte.tensor[k]
-                        sprint(GF2([k]), end=" ")
-                        print(v)
-                    print(f"node2_pte {node2_pte}:")
-                    for k in list(node2_pte.tensor.keys()):
-                        v = node2_pte.tensor[k]
-                        sprint(GF2([k]), end=" ")
-                        print(v)
-                pte = node1_pte.merge_with(
+                    print(f"reusing the PTE of the unchanged subtree {cached}")
+                pte = cached
+                # the reused subtrees below this one, if they were looked up
+                consumed = [ptes[root] for root in {root1, root2} if root in ptes]
+            else:
+                node1_pte = node_pte(node_idx1)
+                node2_pte = node_pte(node_idx2)
+                pte = self._contract_step(
+                    step,
+                    node1_pte,
                     node2_pte,
-                    join_legs1=[
-                        (node_idx1, leg) if isinstance(leg, int) else leg
-                        for leg in join_legs1
-                    ],
-                    join_legs2=[
-                        (node_idx2, leg) if isinstance(leg, int) else leg
-                        for leg in join_legs2
-                    ],
                     verbose=verbose,
                     progress_bar=progress_bar,
+                    workers=workers,
+                    cancel=cancel,
                 )
-
-                for node in pte.nodes:
-                    self.ptes[node] = pte
-                self.legs_left_to_join[node_idx1] = [
-                    leg
-                    for leg in self.legs_left_to_join[node_idx1]
-                    if leg not in join_legs1
-                ]
-                self.legs_left_to_join[node_idx2] = [
-                    leg
-                    for leg in self.legs_left_to_join[node_idx2]
-                    if leg not in join_legs2
-                ]
-
-            node1_pte = None if node_idx1 not in self.ptes else self.ptes[node_idx1]
+                consumed = [node1_pte, node2_pte]
+                del node1_pte, node2_pte
+
+            root1 = components.find(node_idx1)
+            root2 = components.find(node_idx2)
+            ptes.pop(root1, None)
+            ptes.pop(root2, None)
+            root = components.union(root1, root2)
+            ptes[root] = pte
+            pte_bytes = estimate_tensor_bytes(pte.tensor)
+            memory_stats.record(live_total + pte_bytes, cursor)
+            # release the consumed PTEs before truncating the result
+            for consumed_pte in consumed:
+                live_total -= live_bytes.pop(id(consumed_pte), 0)
+            del consumed
 
             if verbose:
-                print(f"PTE nodes: {node1_pte.nodes}")
-                print(f"PTE tracable legs: {node1_pte.tracable_legs}")
-            if verbose:
-                print("PTE tensor: ")
-            for k in list(node1_pte.tensor.keys()):
-                v = node1_pte.tensor[k]
-                # if not 0 in v:
-                #     continue
+                print(f"PTE nodes: {pte.nodes}")
+                print(f"PTE tracable legs: {pte.tracable_legs}")
+            if cached is None:
+                pte.truncate(verbose=verbose)
+            if key is not None:
+                subtree_keys[root] = key
+                context.subtree_ptes[key] = pte
+            n_discarded = 0
+            if max_keys is not None:
+                n_discarded, discarded_mass = pte.keep_top_keys(max_keys, key_priority)
+                context.approximation.discarded_keys.append(n_discarded)
+                context.approximation.discarded_mass.append(discarded_mass)
+                if verbose and n_discarded > 0:
+                    print(f"discarded {n_discarded} keys of mass {discarded_mass}")
+            if self.truncate_length is not None or n_discarded > 0:
+                pte_bytes = estimate_tensor_bytes(pte.tensor)
+            live_bytes[id(pte)] = pte_bytes
+            live_total += pte_bytes
+            memory_stats.step_bytes.append(live_total)
+            if progress_callback is not None:
+                progress_callback(
+                    ContractionProgress(
+                        step=cursor + 1,
+                        n_steps=len(steps),
+                        pte_keys=len(pte.tensor),
+                        live_bytes=live_total,
+                        elapsed=time.monotonic() - started,
+                    )
+                )
+
+            if checkpoint is not None and checkpoint.step_done(
+                cursor + 1, traces, ptes, context.legs_left_to_join
+            ):
                 if verbose:
-                    sprint(GF2([k]), end=" ")
-                    print(v, end="")
-                if self.truncate_length is None:
-                    if verbose:
-                        print()
-                    continue
-                if v.minw()[0] > self.truncate_length:
-                    del pte.tensor[k]
-                    if verbose:
-                        print(" -- removed")
-                else:
-                    if v.leading_order_poly() != v:
-                        if verbose:
-                            print(" -- truncated")
-                        pte.tensor[k] = v.leading_order_poly()
-                    else:
-                        if verbose:
-                            print()
+                    print(f"checkpoint saved after step {cursor + 1}")
 
-                print(f"PTEs: {self.ptes}")
+        # nodes without traces
+        for node_idx in self.nodes:
+            node_pte(node_idx)
 
         if verbose:
-            print("summed legs: ", summed_legs)
-            print("PTEs: ", self.ptes)
-        if len(set(self.ptes.values())) > 1:
+            free_legs = self._collect_legs()[0]
+            print("summed legs: ", [leg for leg in free_legs if leg not in open_legs])
+            print("PTEs: ", ptes)
+        wep = self._final_wep(
+            list(ptes.values()), open_legs, verbose=verbose, cancel=cancel
+        )
+        ptes.clear()
+        return wep
+
+    def _contract_step(
+        self,
+        step: List[Tuple],
+        node1_pte: "_PartiallyTracedEnumerator",
+        node2_pte: "_PartiallyTracedEnumerator",
+        verbose: bool = False,
+        progress_bar: bool = False,
+        workers: int = 1,
+        cancel: Optional[CancellationToken] = None,
+    ) -> "_PartiallyTracedEnumerator":
+        """Traces the legs of a fused step, within node1_pte or between the two PTEs."""
+        # all traces of a step join legs of the same two PTEs, so they are
+        # traced at once
+        join_legs1 = [_index_leg(n1, leg) for n1, _, legs1, _ in step for leg in legs1]
+        join_legs2 = [_index_leg(n2, leg) for _, n2, _, legs2 in step for leg in legs2]
+        if node1_pte is node2_pte:
+            # both nodes are in the same PTE!
             if verbose:
-                print(
-                    f"tensoring { len(set(self.ptes.values()))} disjoint PTEs: {self.ptes}"
-                )
+                print(f"self trace within PTE {node1_pte}")
+            return node1_pte.self_trace(
+                join_legs1=join_legs1,
+                join_legs2=join_legs2,
+                progress_bar=progress_bar,
+                verbose=verbose,
+                cancel=cancel,
+            )
+        if verbose:
+            print(f"MERGING two components {node1_pte} and {node2_pte}")
+            print(f"node1_pte {node1_pte}:")
+            for k, v in node1_pte.tensor.items():
+                sprint(GF2([k]), end=" ")
+                print(v)
+            print(f"node2_pte {node2_pte}:")
+            for k, v in node2_pte.tensor.items():
+                sprint(GF2([k]), end=" ")
+                print(v)
+        return node1_pte.merge_with(
+            node2_pte,
+            join_legs1=join_legs1,
+            join_legs2=join_legs2,
+            verbose=verbose,
+            progress_bar=progress_bar,
+            workers=workers,
+            cancel=cancel,
+        )
+
+    def _final_wep(
+        self,
+        components: List["_PartiallyTracedEnumerator"],
+        open_legs: List[Tuple[int, int]],
+        verbose: bool = False,
+        cancel: Optional[CancellationToken] = None,
+    ) -> Union[SimplePoly, Dict[Tuple[int, ...], SimplePoly]]:
+        """Tensors the PTEs of the disjoint components together, unpacks the result."""
+        pte = components[0]
+        if len(components) > 1:
+            if verbose:
+                print(f"tensoring {len(components)} disjoint PTEs: {components}")
 
-            pte = list(self.ptes.values())[0]
-            for pte2 in list(set(self.ptes.values()))[1:]:
-                pte = pte.tensor_product(pte2, verbose=verbose)
+            for pte2 in components[1:]:
+                pte = pte.tensor_product(pte2, verbose=verbose, cancel=cancel)
 
-        if len(pte.tensor) > 1:
+        # slices and truncated tensors can have any number of keys, including none
+        if len(open_legs) > 0:
             if verbose:
                 print(f"final PTE is a tensor: {pte}")
-                for k in list(pte.tensor.keys()):
-                    v = pte.tensor[k]
-                    if verbose:
-                        sprint(GF2([k]), end=" ")
-                        print(v)
-
-            self._wep = pte.ordered_key_tensor(open_legs)
-            # self._wep = SimplePoly()
+                for k, v in pte.tensor.items():
+                    sprint(GF2([k]), end=" ")
+                    print(v)
+            wep = pte.ordered_key_tensor(open_legs)
+            # wep = SimplePoly()
             # for k, sub_wep in pte.tensor.items():
-            #     self._wep.add_inplace(sub_wep * SimplePoly({weight(GF2(k)): 1}))
+            #     wep.add_inplace(sub_wep * SimplePoly({weight(GF2(k)): 1}))
         else:
-            self._wep = pte.tensor[()]
-            if verbose:
-                print(f"final scalar wep: {self._wep}")
-            self._wep = self._wep.normalize(verbose=verbose)
-        return self._wep
+            wep = pte.tensor.get((), SimplePoly())
+        return wep
+
+    def _slice_pairs(self, slice_legs: List[Tuple]) -> List[Tuple[Tuple, Tuple]]:
+        """The two legs of the trace of each of the slice_legs."""
+        pairs = []
+        for leg in slice_legs:
+            for node_idx1, node_idx2, join_legs1, join_legs2 in self.traces:
+                for leg1, leg2 in zip(join_legs1, join_legs2):
+                    leg1 = _index_leg(node_idx1, leg1)
+                    leg2 = _index_leg(node_idx2, leg2)
+                    if leg in (leg1, leg2):
+                        pairs.append((leg1, leg2))
+            if len(pairs) == 0 or leg not in pairs[-1]:
+                raise ValueError(f"Can't slice {leg}, it is not a traced leg.")
+        return pairs
+
+    def _sliced_contraction(
+        self,
+        context: ContractionContext,
+        traces: List[Tuple],
+        open_legs: List[Tuple[int, int]],
+        open_legs_per_node: Dict[Any, List[Tuple]],
+        slice_legs: List[Tuple],
+        workers: int = 1,
+        cancel: Optional[CancellationToken] = None,
+        progress_callback: Optional[ProgressCallback] = None,
+        **contraction_opts,
+    ) -> Union[SimplePoly, Dict[Tuple[int, ...], SimplePoly]]:
+        """Sums the contractions with every combination of Paulis on the slice_legs.
+
+        Both legs of a trace carry the same Pauli in every term of the contraction, so
+        fixing it on both splits the contraction into 4 independent ones per sliced trace.
+        The slices run in a process pool with workers > 1, each with its own context, their
+        reports are combined into context. Running slices in the pool are not interrupted
+        by cancel, the pending ones are dropped.
+        """
+        pairs = self._slice_pairs(slice_legs)
+        slices = [
+            {
+                leg: pauli
+                for (leg1, leg2), pauli in zip(pairs, paulis)
+                for leg in (leg1, leg2)
+            }
+            for paulis in itertools.product(
+                [(0, 0), (1, 0), (0, 1), (1, 1)], repeat=len(pairs)
+            )
+        ]
+        if contraction_opts.get("verbose"):
+            print(f"contracting {len(slices)} slices on {pairs}")
+        # tokens don't cross process boundaries, only serial slices check cancel
+        slice_opts = dict(contraction_opts, cancel=cancel if workers <= 1 else None)
+        args = (
+            [self] * len(slices),
+            [context.legs_left_to_join] * len(slices),
+            [traces] * len(slices),
+            [open_legs] * len(slices),
+            [open_legs_per_node] * len(slices),
+            slices,
+            [slice_opts] * len(slices),
+            [workers > 1] * len(slices),
+        )
+        started = time.monotonic()
+        if workers <= 1:
+            results = map(_contract_slice, *args)
+        else:
+            pool = ProcessPoolExecutor(max_workers=workers)
+            futures = [pool.submit(_contract_slice, *a) for a in zip(*args)]
+            results = (future.result() for future in futures)
+        if contraction_opts.get("progress_bar"):
+            results = tqdm(results, total=len(slices), desc="slices")
+
+        total = None
+        peak_bytes = -1
+        n_read = 0
+        try:
+            for n_done, (wep, slice_context) in enumerate(results, start=1):
+                n_read = n_done
+                # the workers leave the files of a handle behind, they are removed
+                # here before anything else can raise
+                if isinstance(wep, SharedTensorHandle):
+                    shared = SharedTensor(wep, owner=True)
+                    wep = dict(shared.items())
+                    shared.cleanup()
+                if cancel is not None:
+                    cancel.check()
+                if progress_callback is not None:
+                    progress_callback(
+                        ContractionProgress(
+                            step=n_done,
+                            n_steps=len(slices),
+                            pte_keys=len(wep),
+                            live_bytes=slice_context.memory_stats.peak_bytes,
+                            elapsed=time.monotonic() - started,
+                        )
+                    )
+                if slice_context.memory_stats.peak_bytes > peak_bytes:
+                    context.memory_stats = slice_context.memory_stats
+                    peak_bytes = context.memory_stats.peak_bytes
+                approximation = slice_context.approximation
+                if approximation is not None:
+                    if context.approximation is None:
+                        context.approximation = approximation
+                    else:
+                        for i, n in enumerate(approximation.discarded_keys):
+                            context.approximation.discarded_keys[i] += n
+                        for i, m in enumerate(approximation.discarded_mass):
+                            context.approximation.discarded_mass[i] += m
+                if isinstance(wep, SimplePoly):
+                    total = SimplePoly() if total is None else total
+                    total.add_inplace(wep)
+                else:
+                    total = {} if total is None else total
+                    for k, v in wep.items():
+                        if k in total:
+                            total[k].add_inplace(v)
+                        else:
+                            total[k] = SimplePoly(v)
+        finally:
+            if workers > 1:
+                pool.shutdown(cancel_futures=True)
+                for future in futures[n_read:]:
+                    if not future.cancelled() and future.exception() is None:
+                        wep = future.result()[0]
+                        if isinstance(wep, SharedTensorHandle):
+                            SharedTensor(wep, owner=True).cleanup()
+        if self.truncate_length is not None and total is not None:
+            # each slice kept its own leading order terms, only the lowest of them are
+            # leading in the sum
+            if isinstance(total, SimplePoly):
+                total = _leading_order_terms(total)
+            else:
+                total = {k: _leading_order_terms(v) for k, v in total.items()}
+        return total
+
+    def _parallel_contraction(
+        self,
+        context: ContractionContext,
+        traces: List[Tuple],
+        open_legs: List[Tuple[int, int]],
+        open_legs_per_node: Dict[Any, List[Tuple]],
+        workers: int,
+        verbose: bool = False,
+        progress_bar: bool = False,
+        memory_limit: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        compress: bool = False,
+        max_keys: Optional[int] = None,
+        key_priority: str = "min_weight",
+        cancel: Optional[CancellationToken] = None,
+        progress_callback: Optional[ProgressCallback] = None,
+        cluster: Optional[Cluster] = None,
+    ) -> Union[SimplePoly, Dict[Tuple[int, ...], SimplePoly]]:
+        """Contracts the independent subtrees of the schedule concurrently in a pool.
+
+        The step forest is cut into subtree tasks of similar estimated cost (see
+        estimate_step_operations), several per worker. A task is submitted as soon as
+        the tasks it depends on are done, idle workers pick up the next ready task from
+        the pool's queue. Results travel between the workers as SharedTensors, only the
+        roots of the forest are read back here and tensored together. Running tasks are
+        not interrupted by cancel, the ones not yet started are dropped.
+
+        With a cluster, the tasks run on its workers instead of a local process pool,
+        and the results are sent back and forth in the messages.
+        """
+        if cluster is not None:
+            workers = cluster.n_workers
+        steps = fuse_traces(traces)
+        weights = [
+            max(1, operations)
+            for operations in estimate_step_operations(
+                self.nodes, traces, open_legs_per_node, self.truncate_length
+            )
+        ]
+        tasks = subtree_tasks(
+            steps, weights, max_weight=sum(weights) / (TASKS_PER_WORKER * workers)
+        )
+        if verbose:
+            print(f"contracting {len(steps)} steps in {len(tasks)} subtree tasks")
+        if max_keys is not None:
+            context.approximation = ApproximationReport(
+                max_keys=max_keys,
+                key_priority=key_priority,
+                exact_mass=contraction_mass(self.nodes, self.traces),
+            )
+
+        waiting_on = [len(task.deps) for task in tasks]
+        consumer: Dict[int, int] = {}
+        for t, task in enumerate(tasks):
+            for d in task.deps:
+                consumer[d] = t
+        # task index -> (tensor, nodes, tracable legs) of its result, the tensor is a
+        # SharedTensor in a local pool and a dict on a cluster
+        results: Dict[int, Tuple[Any, Set, List[Tuple]]] = {}
+        live_total = 0
+        started = time.monotonic()
+        memory_stats = context.memory_stats
+        pbar = tqdm(total=len(tasks), desc="subtree tasks") if progress_bar else None
+
+        # workers of a cluster keep the state of each of its queries under their id
+        query_id = uuid.uuid4().hex
+        worker_setup = (
+            query_id,
+            self,
+            open_legs_per_node,
+            dict(
+                verbose=verbose,
+                memory_limit=memory_limit,
+                spill_dir=spill_dir,
+                compress=compress,
+                max_keys=max_keys,
+                key_priority=key_priority,
+                share_results=cluster is None,
+            ),
+        )
+        if cluster is None:
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_subtree_worker,
+                initargs=worker_setup,
+            )
+        else:
+            pool = cluster
+            pool.broadcast(_init_subtree_worker, *worker_setup)
+        running = {}
+
+        def submit(t):
+            inputs = [
+                (
+                    results[d][0].handle if cluster is None else results[d][0],
+                    results[d][1],
+                    results[d][2],
+                )
+                for d in tasks[t].deps
+            ]
+            future = pool.submit(
+                _contract_subtree, query_id, [steps[i] for i in tasks[t].steps], inputs
+            )
+            running[future] = t
+
+        try:
+            for t, n in enumerate(waiting_on):
+                if n == 0:
+                    submit(t)
+            n_done = 0
+            while running:
+                done, _ = wait(running, timeout=0.1, return_when=FIRST_COMPLETED)
+                if cancel is not None:
+                    cancel.check()
+                for future in done:
+                    t = running.pop(future)
+                    tensor, nodes, tracable_legs, peak_bytes, discarded = (
+                        future.result()
+                    )
+                    if cluster is None:
+                        tensor = SharedTensor(tensor, owner=True)
+                    results[t] = (tensor, nodes, tracable_legs)
+                    for d in tasks[t].deps:
+                        consumed = results.pop(d)[0]
+                        live_total -= estimate_tensor_bytes(consumed)
+                        if cluster is None:
+                            consumed.cleanup()
+                    # the inputs were alive in the worker until the result was written
+                    memory_stats.record(live_total + peak_bytes, n_done)
+                    live_total += estimate_tensor_bytes(tensor)
+                    memory_stats.step_bytes.append(live_total)
+                    if context.approximation is not None:
+                        context.approximation.discarded_keys.extend(discarded[0])
+                        context.approximation.discarded_mass.extend(discarded[1])
+                    for n1, n2, legs1, legs2 in (
+                        trace for i in tasks[t].steps for trace in steps[i]
+                    ):
+                        legs_left_to_join = context.legs_left_to_join
+                        legs_left_to_join[n1] = [
+                            leg for leg in legs_left_to_join[n1] if leg not in legs1
+                        ]
+                        legs_left_to_join[n2] = [
+                            leg for leg in legs_left_to_join[n2] if leg not in legs2
+                        ]
+                    n_done += 1
+                    if pbar is not None:
+                        pbar.update()
+                    if progress_callback is not None:
+                        progress_callback(
+                            ContractionProgress(
+                                step=n_done,
+                                n_steps=len(tasks),
+                                pte_keys=len(tensor),
+                                live_bytes=live_total,
+                                elapsed=time.monotonic() - started,
+                            )
+                        )
+                    if t in consumer:
+                        waiting_on[consumer[t]] -= 1
+                        if waiting_on[consumer[t]] == 0:
+                            submit(consumer[t])
+
+            components = []
+            traced_nodes = set()
+            for tensor, nodes, tracable_legs in results.values():
+                components.append(
+                    _pte_from_result(
+                        tensor,
+                        nodes,
+                        tracable_legs,
+                        self.truncate_length,
+                        memory_limit=memory_limit,
+                        spill_dir=spill_dir,
+                        compress=compress,
+                    )
+                )
+                traced_nodes |= nodes
+            # nodes without traces
+            for node_idx in self.nodes:
+                if node_idx not in traced_nodes:
+                    components.append(
+                        self._node_pte(
+                            node_idx,
+                            open_legs_per_node[node_idx],
+                            memory_limit=memory_limit,
+                            spill_dir=spill_dir,
+                            compress=compress,
+                            cancel=cancel,
+                        )
+                    )
+            return self._final_wep(
+                components, open_legs, verbose=verbose, cancel=cancel
+            )
+        finally:
+            if pbar is not None:
+                pbar.close()
+            if cluster is None:
+                pool.shutdown(cancel_futures=True)
+                for future in running:
+                    if not future.cancelled() and future.exception() is None:
+                        SharedTensor(future.result()[0], owner=True).cleanup()
+                for shared, _, _ in results.values():
+                    shared.cleanup()
+            else:
+                # the cluster outlives the query, the calls not yet sent are dropped
+                for future in running:
+                    future.cancel()
+                try:
+                    pool.broadcast(_drop_subtree_worker, query_id)
+                except (EOFError, OSError):
+                    pass
+
+    def cotengra_slice_legs(self, max_legs: int, **cotengra_opts) -> List[Tuple]:
+        """Legs to slice so that no intermediate of the contraction has more than max_legs legs.
+
+        The legs are picked by cotengra's slicing, they can be passed to
+        stabilizer_enumerator_polynomial as slice_legs.
+        """
+        free_legs, leg_indices, index_to_legs = self._collect_legs()
+        inputs, output, size_dict, _ = self._prep_cotengra_inputs(
+            leg_indices, free_legs
+        )
+        contengra_params = {
+            "minimize": "size",
+            "parallel": True,
+            "slicing_opts": {"target_size": 2**max_legs},
+            "progbar": False,
+        }
+        contengra_params.update(cotengra_opts)
+        tree = ctg.HyperOptimizer(**contengra_params).search(inputs, output, size_dict)
+        return [index_to_legs[ind][0][1] for ind in tree.sliced_inds]
 
     def stabilizer_enumerator(self, verbose=False, progress_bar=False):
         wep = self.stabilizer_enumerator_polynomial(
@@ -844,6 +2148,217 @@ class TensorNetwork:
         self._reset_wep(keep_cot=True)
 
 
+def _leading_order_terms(wep: SimplePoly) -> SimplePoly:
+    return wep.leading_order_poly() if len(wep) > 0 else wep
+
+
+def _contract_slice(
+    network: TensorNetwork,
+    legs_left_to_join: Dict[Any, List[Tuple]],
+    traces: List[Tuple],
+    open_legs: List[Tuple[int, int]],
+    open_legs_per_node: Dict[Any, List[Tuple]],
+    leg_values: Dict[Tuple, Tuple[int, int]],
+    contraction_opts: Dict[str, Any],
+    share_result: bool = False,
+):
+    """Contracts a slice of the network, returns the result and the slice's context.
+
+    With share_result, a tensor result is returned as the handle of a SharedTensor that
+    the caller has to take ownership of.
+    """
+    context = ContractionContext(legs_left_to_join=deepcopy(legs_left_to_join))
+    wep = network._contract(
+        context,
+        traces,
+        open_legs,
+        open_legs_per_node,
+        leg_values=leg_values,
+        **contraction_opts,
+    )
+    if share_result and not isinstance(wep, SimplePoly):
+        wep = SharedTensor.create(wep.items(), 2 * len(open_legs), owner=False).handle
+    return wep, context
+
+
+# query id -> the network and contraction options of the query in a subtree worker
+_subtree_workers: Dict[str, Dict[str, Any]] = {}
+
+
+def _init_subtree_worker(
+    query_id: str,
+    network: TensorNetwork,
+    open_legs_per_node: Dict[Any, List[Tuple]],
+    contraction_opts: Dict[str, Any],
+):
+    _subtree_workers[query_id] = dict(
+        network=network, open_legs_per_node=open_legs_per_node, opts=contraction_opts
+    )
+
+
+def _drop_subtree_worker(query_id: str):
+    _subtree_workers.pop(query_id, None)
+
+
+def _pte_from_result(
+    tensor: Union[SharedTensor, Dict[Tuple[int, ...], SimplePoly]],
+    nodes: Set,
+    tracable_legs: List[Tuple],
+    truncate_length: Optional[int],
+    memory_limit: Optional[int] = None,
+    spill_dir: Optional[str] = None,
+    compress: bool = False,
+) -> "_PartiallyTracedEnumerator":
+    tensor = dict(tensor.items())
+    if compress:
+        tensor = AffineTensor.from_items(tensor.items(), 2 * len(tracable_legs))
+    pte = _PartiallyTracedEnumerator(
+        nodes=nodes,
+        tracable_legs=tracable_legs,
+        tensor=tensor,
+        truncate_length=truncate_length,
+        memory_limit=memory_limit,
+        spill_dir=spill_dir,
+    )
+    pte.spill_if_needed()
+    return pte
+
+
+def _contract_subtree(
+    query_id: str,
+    steps: List[List[Tuple]],
+    inputs: List[Tuple[Any, Set, List[Tuple]]],
+):
+    """Runs the steps of a subtree task in a worker set up by _init_subtree_worker.
+
+    inputs are the results of the tasks it depends on, the node tensors of the subtree's
+    leaves are enumerated here. Returns the result (the handle of a SharedTensor with
+    share_results, a dict otherwise), its nodes and tracable legs, the peak estimated
+    bytes of the task's PTEs and the keys and mass discarded by max_keys at each step.
+    """
+    worker = _subtree_workers[query_id]
+    network: TensorNetwork = worker["network"]
+    open_legs_per_node = worker["open_legs_per_node"]
+    opts = worker["opts"]
+    verbose = opts["verbose"]
+    max_keys = opts["max_keys"]
+
+    components = UnionFind()
+    ptes = {}
+    for tensor, nodes, tracable_legs in inputs:
+        pte = _pte_from_result(
+            SharedTensor(tensor) if isinstance(tensor, SharedTensorHandle) else tensor,
+            nodes,
+            tracable_legs,
+            network.truncate_length,
+            memory_limit=opts["memory_limit"],
+            spill_dir=opts["spill_dir"],
+            compress=opts["compress"],
+        )
+        first = next(iter(nodes))
+        for node_idx in nodes:
+            components.union(first, node_idx)
+        ptes[components.find(first)] = pte
+    live_bytes = {id(pte): estimate_tensor_bytes(pte.tensor) for pte in ptes.values()}
+    peak_bytes = sum(live_bytes.values())
+
+    def node_pte(node_idx):
+        root = components.find(node_idx)
+        if root not in ptes:
+            pte = network._node_pte(
+                node_idx,
+                open_legs_per_node[node_idx],
+                verbose=verbose,
+                memory_limit=opts["memory_limit"],
+                spill_dir=opts["spill_dir"],
+                compress=opts["compress"],
+            )
+            ptes[root] = pte
+            live_bytes[id(pte)] = estimate_tensor_bytes(pte.tensor)
+        return ptes[root]
+
+    discarded_keys = []
+    discarded_mass = []
+    for step in steps:
+        node_idx1, node_idx2, _, _ = step[0]
+        node1_pte = node_pte(node_idx1)
+        node2_pte = node_pte(node_idx2)
+        pte = network._contract_step(step, node1_pte, node2_pte, verbose=verbose)
+        root1 = components.find(node_idx1)
+        root2 = components.find(node_idx2)
+        del ptes[root1]
+        ptes.pop(root2, None)
+        ptes[components.union(root1, root2)] = pte
+        live_bytes[id(pte)] = estimate_tensor_bytes(pte.tensor)
+        peak_bytes = max(peak_bytes, sum(live_bytes.values()))
+        live_bytes.pop(id(node1_pte))
+        live_bytes.pop(id(node2_pte), None)
+        del node1_pte, node2_pte
+        pte.truncate(verbose=verbose)
+        if max_keys is not None:
+            n_discarded, mass = pte.keep_top_keys(max_keys, opts["key_priority"])
+            discarded_keys.append(n_discarded)
+            discarded_mass.append(mass)
+        live_bytes[id(pte)] = estimate_tensor_bytes(pte.tensor)
+
+    assert len(ptes) == 1, f"{steps} is not a connected subtree: {ptes}"
+    (pte,) = ptes.values()
+    if opts["share_results"]:
+        result = SharedTensor.create(
+            pte.tensor.items(), 2 * len(pte.tracable_legs), owner=False
+        ).handle
+    else:
+        result = dict(pte.tensor.items())
+    return (
+        result,
+        pte.nodes,
+        pte.tracable_legs,
+        peak_bytes,
+        (discarded_keys, discarded_mass),
+    )
+
+
+def _inner_product_shard(
+    items1: Iterable[Tuple[Tuple[int, ...], SimplePoly]],
+    tensor2: Dict[Tuple[int, ...], SimplePoly],
+    truncate_length: Optional[int],
+) -> SimplePoly:
+    """Sum of the products of the polynomials of items1 with the ones under the same key in tensor2."""
+    pairs = ((wep1, tensor2.get(k)) for k, wep1 in items1)
+    return _sum_of_products(
+        ((wep1, wep2) for wep1, wep2 in pairs if wep2 is not None), truncate_length
+    )
+
+
+def _sum_of_products(
+    pairs: Iterable[Tuple[SimplePoly, SimplePoly]], truncate_length: Optional[int]
+) -> SimplePoly:
+    total = SimplePoly()
+    for wep1, wep2 in pairs:
+        if truncate_length is None:
+            total.add_inplace(wep1 * wep2)
+        elif wep1.minw()[0] + wep2.minw()[0] <= truncate_length:
+            total.add_inplace(wep1.mul_truncated(wep2, truncate_length))
+    return total
+
+
+def _shared_inner_product_shard(
+    handle1: SharedTensorHandle,
+    handle2: SharedTensorHandle,
+    start: int,
+    end: int,
+    truncate_length: Optional[int],
+) -> SimplePoly:
+    # the keys of rows start to end are matched on the mapped key matrices, only the
+    # polynomials of the matching keys are read
+    tensor1 = SharedTensor(handle1)
+    tensor2 = SharedTensor(handle2)
+    rows1, rows2 = tensor1.matching_rows(tensor2, start, end)
+    return _sum_of_products(
+        zip(tensor1.polys(rows1), tensor2.polys(rows2)), truncate_length
+    )
+
+
 class _PartiallyTracedEnumerator:
     def __init__(
         self,
@@ -851,18 +2366,28 @@ class _PartiallyTracedEnumerator:
         tracable_legs: List[Tuple[int, int]],
         tensor: Dict[Tuple, SimplePoly],
         truncate_length: int,
+        memory_limit: Optional[int] = None,
+        spill_dir: Optional[str] = None,
     ):
         self.nodes = nodes
         self.tracable_legs = tracable_legs
         self.tensor = tensor
 
-        tensor_key_length = (
-            len(list(self.tensor.keys())[0]) if len(self.tensor) > 0 else 0
-        )
+        if isinstance(self.tensor, SpilledTensor):
+            tensor_key_length = self.tensor.key_length
+        else:
+            # an empty tensor (e.g. everything truncated) is valid for any number of legs
+            tensor_key_length = (
+                len(next(iter(self.tensor.keys())))
+                if len(self.tensor) > 0
+                else 2 * len(tracable_legs)
+            )
         assert tensor_key_length == 2 * len(
             tracable_legs
         ), f"tensor keys of length {tensor_key_length} != {2 * len(tracable_legs)} (2 * len tracable legs)"
         self.truncate_length = truncate_length
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
 
     def __str__(self):
         return f"PartiallyTracedEnumerator[nodes={self.nodes}, tracable_legs={self.tracable_legs}]"
@@ -878,11 +2403,56 @@ class _PartiallyTracedEnumerator:
     def __hash__(self):
         return hash((frozenset(self.nodes)))
 
+    def _new_pte(self, nodes, tracable_legs, tensor):
+        return _PartiallyTracedEnumerator(
+            nodes,
+            tracable_legs=tracable_legs,
+            tensor=tensor,
+            truncate_length=self.truncate_length,
+            memory_limit=self.memory_limit,
+            spill_dir=self.spill_dir,
+        )
+
+    def _accumulator(self, n_legs: int) -> TensorAccumulator:
+        return TensorAccumulator(
+            2 * n_legs, memory_limit=self.memory_limit, spill_dir=self.spill_dir
+        )
+
+    def spill_if_needed(self):
+        """Moves the tensor to disk if it is over the memory limit."""
+        if self.memory_limit is None or isinstance(self.tensor, SpilledTensor):
+            return
+        tensor_bytes = estimate_tensor_bytes(self.tensor)
+        if tensor_bytes > self.memory_limit:
+            self.tensor = spill_tensor(
+                self.tensor.items(),
+                2 * len(self.tracable_legs),
+                n_partitions=math.ceil(tensor_bytes / self.memory_limit),
+                spill_dir=self.spill_dir,
+            )
+
+    def _external_join_partitions(self, other: "_PartiallyTracedEnumerator") -> int:
+        """Number of partitions to join the two tensors on disk, 0 if they fit in memory."""
+        if self.memory_limit is None:
+            return 0
+        total_bytes = estimate_tensor_bytes(self.tensor) + estimate_tensor_bytes(
+            other.tensor
+        )
+        if (
+            not isinstance(self.tensor, SpilledTensor)
+            and not isinstance(other.tensor, SpilledTensor)
+            and total_bytes <= self.memory_limit
+        ):
+            return 0
+        # each pair of partitions has to fit in the memory limit
+        return max(2, math.ceil(2 * total_bytes / self.memory_limit))
+
     def ordered_key_tensor(self, open_legs: List[Tuple[int, int]]):
-        reindex = lambda key: tuple(
-            sslice(
-                GF2(key), [self.tracable_legs.index(leg) for leg in open_legs]
-            ).tolist()
+        reindex = _key_getter(
+            _symplectic_positions(
+                [self.tracable_legs.index(leg) for leg in open_legs],
+                len(self.tracable_legs),
+            )
         )
 
         return {reindex(k): v for k, v in self.tensor.items()}
@@ -895,7 +2465,9 @@ class _PartiallyTracedEnumerator:
 
         return self.tensor[indices]
 
-    def tensor_product(self, other, verbose=False):
+    def tensor_product(
+        self, other, verbose=False, cancel: Optional[CancellationToken] = None
+    ):
         if verbose:
             print(f"tensoring {self}")
             for k, v in self.tensor.items():
@@ -903,16 +2475,19 @@ class _PartiallyTracedEnumerator:
             print(f"with {other}")
             for k, v in other.tensor.items():
                 print(f"{k}: {v}")
-        new_tensor = {}
-        for k1 in self.tensor.keys():
-            for k2 in other.tensor.keys():
-                new_tensor[tuple(sconcat(k1, k2))] = self.tensor[k1] * other.tensor[k2]
-
-        return _PartiallyTracedEnumerator(
+        n1 = len(self.tracable_legs)
+        n2 = len(other.tracable_legs)
+        new_tensor = self._accumulator(n1 + n2)
+        for k1, v1 in check_cancelled(self.tensor.items(), cancel, every=1):
+            for k2, v2 in other.tensor.items():
+                product = self._truncated_product(v1, v2)
+                if product is not None:
+                    new_tensor.add(k1[:n1] + k2[:n2] + k1[n1:] + k2[n2:], product)
+
+        return self._new_pte(
             self.nodes.union(other.nodes),
             tracable_legs=self.tracable_legs + other.tracable_legs,
-            tensor=new_tensor,
-            truncate_length=self.truncate_length,
+            tensor=new_tensor.finalize(),
         )
 
     def merge_with(
@@ -922,20 +2497,47 @@ class _PartiallyTracedEnumerator:
         join_legs2,
         progress_bar: bool = False,
         verbose: bool = False,
+        workers: int = 1,
+        cancel: Optional[CancellationToken] = None,
     ):
         assert len(join_legs1) == len(join_legs2)
 
-        wep = defaultdict(lambda: SimplePoly())
         open_legs1 = [leg for leg in self.tracable_legs if leg not in join_legs1]
 
         open_legs2 = [leg for leg in pte2.tracable_legs if leg not in join_legs2]
 
-        # print(f"traceable legs: {self.tracable_legs} <- {open_legs}")
-        join_indices1 = [self.tracable_legs.index(leg) for leg in join_legs1]
+        compressed = (
+            isinstance(self.tensor, AffineTensor)
+            and isinstance(pte2.tensor, AffineTensor)
+            and self._external_join_partitions(pte2) == 0
+        )
 
-        # print(f"join indices1: {join_indices1}")
+        if (
+            len(open_legs1) == 0
+            and len(open_legs2) == 0
+            and not (compressed and workers <= 1)
+        ):
+            if verbose:
+                print(f"inner product of {self} and {pte2}")
+            total = self.inner_product(
+                pte2,
+                join_legs1,
+                join_legs2,
+                progress_bar=progress_bar,
+                workers=workers,
+                cancel=cancel,
+            )
+            return self._new_pte(
+                self.nodes.union(pte2.nodes),
+                tracable_legs=[],
+                tensor={(): total} if len(total) > 0 else {},
+            )
+
+        n1 = len(self.tracable_legs)
+        n2 = len(pte2.tracable_legs)
+
+        join_indices1 = [self.tracable_legs.index(leg) for leg in join_legs1]
         join_indices2 = [pte2.tracable_legs.index(leg) for leg in join_legs2]
-        # print(f"join indices2: {join_indices2}")
 
         kept_indices1 = [
             i for i, leg in enumerate(self.tracable_legs) if leg in open_legs1
@@ -943,7 +2545,46 @@ class _PartiallyTracedEnumerator:
         kept_indices2 = [
             i for i, leg in enumerate(pte2.tracable_legs) if leg in open_legs2
         ]
-        # print(f"kept indices: {kept_indices}")
+
+        join1 = _key_getter(_symplectic_positions(join_indices1, n1))
+        join2 = _key_getter(_symplectic_positions(join_indices2, n2))
+        # the new key is the X part of the kept legs of both keys, then their Z parts
+        kept_x1 = _key_getter(kept_indices1)
+        kept_z1 = _key_getter([i + n1 for i in kept_indices1])
+        kept_x2 = _key_getter(kept_indices2)
+        kept_z2 = _key_getter([i + n2 for i in kept_indices2])
+
+        tracable_legs = [
+            (idx, leg) if isinstance(leg, int) else leg for idx, leg in open_legs1
+        ]
+        tracable_legs += [
+            (idx, leg) if isinstance(leg, int) else leg for idx, leg in open_legs2
+        ]
+
+        if compressed:
+            if verbose:
+                print(f"merge of {self.tensor} and {pte2.tensor} on coordinates")
+            m1 = len(kept_indices1)
+            m = m1 + len(kept_indices2)
+            out1 = {i: j for j, i in enumerate(kept_indices1)}
+            out1.update({i + n1: m + j for j, i in enumerate(kept_indices1)})
+            out2 = {i: m1 + j for j, i in enumerate(kept_indices2)}
+            out2.update({i + n2: m + m1 + j for j, i in enumerate(kept_indices2)})
+            return self._new_pte(
+                self.nodes.union(pte2.nodes),
+                tracable_legs=tracable_legs,
+                tensor=self.tensor.merge(
+                    pte2.tensor,
+                    _symplectic_positions(join_indices1, n1),
+                    _symplectic_positions(join_indices2, n2),
+                    out1,
+                    out2,
+                    2 * m,
+                    self.truncate_if_needed,
+                    self.truncate_length,
+                    cancel=cancel,
+                ),
+            )
 
         def prog(x):
             return (
@@ -956,58 +2597,182 @@ class _PartiallyTracedEnumerator:
                 )
             )
 
-        for k1 in prog(self.tensor.keys()):
-            k1_gf2 = GF2(k1)
-            for k2 in pte2.tensor.keys():
-                k2_gf2 = GF2(k2)
-                if not np.array_equal(
-                    sslice(k1_gf2, join_indices1),
-                    sslice(k2_gf2, join_indices2),
-                ):
-                    continue
-
-                wep1 = self.tensor[k1]
-                wep2 = pte2.tensor[k2]
+        wep = self._accumulator(len(open_legs1) + len(open_legs2))
 
-                # we have to cut off the join legs from both keys and concatenate them
-                key = tuple(
-                    sconcat(
-                        sslice(k1_gf2, kept_indices1),
-                        sslice(k2_gf2, kept_indices2),
-                    ).tolist()
-                )
+        n_partitions = self._external_join_partitions(pte2)
+        if n_partitions == 0:
+            partition_pairs = [(self.tensor.items(), pte2.tensor.items())]
+        else:
+            if verbose:
+                print(f"external merge of {self} and {pte2} in {n_partitions} parts")
+            parts1 = spill_tensor(
+                self.tensor.items(), 2 * n1, n_partitions, join1, self.spill_dir
+            )
+            parts2 = spill_tensor(
+                pte2.tensor.items(), 2 * n2, n_partitions, join2, self.spill_dir
+            )
+            partition_pairs = (
+                (parts1.iter_partition(p), parts2.iter_partition(p))
+                for p in range(n_partitions)
+            )
 
-                # assert len(key[0]) == 2 * (
-                #     len(open_legs1) + len(open_legs2)
-                # ), f"key length: {len(key[0])} != 2*({len(open_legs1)}  + {len(open_legs2)}) = {2 * (
-                #     len(open_legs1) + len(open_legs2)
-                # )}"
-                # print(f"key: {key}")
-                # print(f"wep1: {wep1}")
-                # print(f"wep2: {wep2}")
-                wep[key].add_inplace(wep1 * wep2)
+        truncate_length = self.truncate_length
 
-        tracable_legs = [
-            (idx, leg) if isinstance(leg, int) else leg for idx, leg in open_legs1
-        ]
-        tracable_legs += [
-            (idx, leg) if isinstance(leg, int) else leg for idx, leg in open_legs2
-        ]
+        for items1, items2 in partition_pairs:
+            # hash join: index the second tensor by the values on the join legs
+            index = defaultdict(list)
+            for k2, wep2 in check_cancelled(items2, cancel):
+                wep2 = self.truncate_if_needed(wep2)
+                if wep2 is None:
+                    continue
+                min_w2 = wep2.minw()[0] if truncate_length is not None else 0
+                index[join2(k2)].append((min_w2, kept_x2(k2), kept_z2(k2), wep2))
+            if truncate_length is not None:
+                # lowest minimum weight first, so we can stop at the first pair beyond
+                # the truncation length
+                for matches in index.values():
+                    matches.sort(key=lambda match: match[0])
+
+            for k1, wep1 in prog(check_cancelled(items1, cancel)):
+                matches = index.get(join1(k1))
+                if matches is None:
+                    continue
+                wep1 = self.truncate_if_needed(wep1)
+                if wep1 is None:
+                    continue
+                x1 = kept_x1(k1)
+                z1 = kept_z1(k1)
+                if truncate_length is None:
+                    for _, x2, z2, wep2 in matches:
+                        wep.add(x1 + x2 + z1 + z2, wep1 * wep2)
+                    continue
+                min_w1 = wep1.minw()[0]
+                for min_w2, x2, z2, wep2 in matches:
+                    if min_w1 + min_w2 > truncate_length:
+                        break
+                    wep.add(
+                        x1 + x2 + z1 + z2, wep1.mul_truncated(wep2, truncate_length)
+                    )
 
-        return _PartiallyTracedEnumerator(
+        return self._new_pte(
             self.nodes.union(pte2.nodes),
             tracable_legs=tracable_legs,
-            tensor=wep,
-            truncate_length=self.truncate_length,
+            tensor=wep.finalize(),
+        )
+
+    def inner_product(
+        self,
+        pte2,
+        join_legs1,
+        join_legs2,
+        progress_bar: bool = False,
+        workers: int = 1,
+        cancel: Optional[CancellationToken] = None,
+    ) -> SimplePoly:
+        """Fully contracts the two PTEs, joining all of their legs, into a scalar polynomial.
+
+        This is the sum of the products over matching keys, streamed over the keys of this
+        PTE with a single lookup in pte2 for each. With workers > 1, both tensors are
+        written to SharedTensors, and each worker in a process pool joins a range of the
+        keys of this PTE with pte2 on the mapped arrays.
+        """
+        assert len(join_legs1) == len(self.tracable_legs) == len(pte2.tracable_legs)
+        # for each leg of pte2, the position of the leg it is joined with in this PTE
+        leg_positions = [
+            self.tracable_legs.index(join_legs1[join_legs2.index(leg)])
+            for leg in pte2.tracable_legs
+        ]
+        to_key2 = _key_getter(
+            _symplectic_positions(leg_positions, len(self.tracable_legs))
         )
 
+        def prog(x):
+            return (
+                x
+                if not progress_bar
+                else tqdm(
+                    x,
+                    leave=False,
+                    desc=f"PTE inner product: {len(self.tensor)} x {len(pte2.tensor)} elements",
+                )
+            )
+
+        n_partitions = self._external_join_partitions(pte2)
+        if n_partitions > 0:
+            key_length = 2 * len(pte2.tracable_legs)
+            parts1 = spill_tensor(
+                ((to_key2(k1), v1) for k1, v1 in self.tensor.items()),
+                key_length,
+                n_partitions,
+                spill_dir=self.spill_dir,
+            )
+            parts2 = spill_tensor(
+                pte2.tensor.items(), key_length, n_partitions, spill_dir=self.spill_dir
+            )
+            total = SimplePoly()
+            for p in prog(check_cancelled(range(n_partitions), cancel, every=1)):
+                total.add_inplace(
+                    _inner_product_shard(
+                        list(parts1.iter_partition(p)),
+                        dict(parts2.iter_partition(p)),
+                        self.truncate_length,
+                    )
+                )
+            return total
+
+        if workers <= 1:
+            return _inner_product_shard(
+                (
+                    (to_key2(k1), v1)
+                    for k1, v1 in prog(check_cancelled(self.tensor.items(), cancel))
+                ),
+                pte2.tensor,
+                self.truncate_length,
+            )
+
+        key_length = 2 * len(pte2.tracable_legs)
+        shared = []
+        try:
+            shared.append(
+                SharedTensor.create(
+                    ((to_key2(k1), v1) for k1, v1 in self.tensor.items()), key_length
+                )
+            )
+            shared.append(SharedTensor.create(pte2.tensor.items(), key_length))
+            bounds = [len(shared[0]) * i // workers for i in range(workers + 1)]
+
+            total = SimplePoly()
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for res in prog(
+                    check_cancelled(
+                        pool.map(
+                            _shared_inner_product_shard,
+                            [shared[0].handle] * workers,
+                            [shared[1].handle] * workers,
+                            bounds[:-1],
+                            bounds[1:],
+                            [self.truncate_length] * workers,
+                        ),
+                        cancel,
+                        every=1,
+                    )
+                ):
+                    total.add_inplace(res)
+        finally:
+            for t in shared:
+                t.cleanup()
+        return total
+
     def self_trace(
-        self, join_legs1, join_legs2, progress_bar: bool = False, verbose: bool = False
+        self,
+        join_legs1,
+        join_legs2,
+        progress_bar: bool = False,
+        verbose: bool = False,
+        cancel: Optional[CancellationToken] = None,
     ):
         assert len(join_legs1) == len(join_legs2)
-        join_length = len(join_legs1)
 
-        wep = defaultdict(SimplePoly)
         open_legs = [
             leg
             for leg in self.tracable_legs
@@ -1030,6 +2795,28 @@ class _PartiallyTracedEnumerator:
         if verbose:
             print(f"[self_trace] kept indices: {kept_indices}")
 
+        n = len(self.tracable_legs)
+        join1 = _key_getter(_symplectic_positions(join_indices1, n))
+        join2 = _key_getter(_symplectic_positions(join_indices2, n))
+        kept = _key_getter(_symplectic_positions(kept_indices, n))
+
+        if isinstance(self.tensor, AffineTensor):
+            m = len(kept_indices)
+            out = {i: j for j, i in enumerate(kept_indices)}
+            out.update({i + n: m + j for j, i in enumerate(kept_indices)})
+            return self._new_pte(
+                self.nodes,
+                tracable_legs=[(idx, leg) for idx, leg in open_legs],
+                tensor=self.tensor.self_trace(
+                    _symplectic_positions(join_indices1, n),
+                    _symplectic_positions(join_indices2, n),
+                    out,
+                    2 * m,
+                    self.truncate_if_needed,
+                    cancel=cancel,
+                ),
+            )
+
         def prog(x):
             return (
                 x
@@ -1041,38 +2828,118 @@ class _PartiallyTracedEnumerator:
                 )
             )
 
-        for old_key in prog(self.tensor.keys()):
-            if not np.array_equal(
-                sslice(GF2(old_key), join_indices1),
-                sslice(GF2(old_key), join_indices2),
-            ):
-                continue
-
-            wep1 = self.tensor[old_key]
-
-            k1_gf2 = GF2(old_key)
-
-            # we have to cut off the join legs from both keys and concatenate them
+        if len(open_legs) == 0:
+            # the scalar result is summed directly
+            total = SimplePoly()
+            for old_key, wep1 in prog(check_cancelled(self.tensor.items(), cancel)):
+                if join1(old_key) != join2(old_key):
+                    continue
+                truncated = self.truncate_if_needed(wep1)
+                if truncated is not None:
+                    total.add_inplace(truncated)
+            return self._new_pte(
+                self.nodes,
+                tracable_legs=[],
+                tensor={(): total} if len(total) > 0 else {},
+            )
 
-            key = tuple(sslice(k1_gf2, kept_indices).tolist())
+        wep = self._accumulator(len(open_legs))
+        for old_key, wep1 in prog(check_cancelled(self.tensor.items(), cancel)):
+            if join1(old_key) != join2(old_key):
+                continue
+            truncated = self.truncate_if_needed(wep1)
+            if truncated is None:
+                continue
 
-            assert len(key) == 2 * (
-                len(open_legs)
-            ), f"key length: {len(key)} != 2*{len(open_legs)} = {2 * len(open_legs)}"
-            # print(f"key: {key}")
-            # print(f"wep: {wep1}")
+            # we have to cut off the join legs from the key
+            wep.add(
+                kept(old_key), SimplePoly(wep1) if truncated is wep1 else truncated
+            )
 
-            wep[key].add_inplace(wep1)
         tracable_legs = [(idx, leg) for idx, leg in open_legs]
 
-        return _PartiallyTracedEnumerator(
+        return self._new_pte(
             self.nodes,
             tracable_legs=tracable_legs,
-            tensor=wep,
-            truncate_length=self.truncate_length,
+            tensor=wep.finalize(),
         )
 
-    def truncate_if_needed(self, key, wep):
-        if self.truncate_length is not None:
-            if np.count_nonzero(key) + wep[key].minw()[0] > self.truncate_length:
-                del wep[key]
+    def truncate(self, verbose: bool = False):
+        """Drops keys beyond truncate_length and keeps only the leading order terms."""
+        if verbose:
+            print("PTE tensor: ")
+        if self.truncate_length is None:
+            if verbose:
+                for k, v in self.tensor.items():
+                    sprint(GF2([k]), end=" ")
+                    print(v)
+            return
+
+        if isinstance(self.tensor, AffineTensor):
+            self.tensor = self.tensor.truncated(self.truncate_length)
+            return
+
+        tensor = self._accumulator(len(self.tracable_legs))
+        for k, v in self.tensor.items():
+            if verbose:
+                sprint(GF2([k]), end=" ")
+                print(v, end="")
+            if v.minw()[0] > self.truncate_length:
+                if verbose:
+                    print(" -- removed")
+                continue
+            if v.leading_order_poly() != v:
+                if verbose:
+                    print(" -- truncated")
+                v = v.leading_order_poly()
+            elif verbose:
+                print()
+            tensor.add(k, v)
+        self.tensor = tensor.finalize()
+
+    def keep_top_keys(self, max_keys: int, key_priority: str) -> Tuple[int, int]:
+        """Keeps only max_keys keys, see select_top_keys.
+
+        Returns the number of discarded keys and their total mass.
+        """
+        if len(self.tensor) <= max_keys:
+            return 0, 0
+        if isinstance(self.tensor, AffineTensor):
+            kept, n_discarded, discarded_mass = select_top_keys(
+                self.tensor.polys.items(), max_keys, key_priority
+            )
+            self.tensor = AffineTensor(
+                self.tensor.key_length,
+                self.tensor.basis,
+                self.tensor.offset,
+                dict(kept),
+            )
+        else:
+            kept, n_discarded, discarded_mass = select_top_keys(
+                self.tensor.items(), max_keys, key_priority
+            )
+            self.tensor = dict(kept)
+        return n_discarded, discarded_mass
+
+    def truncate_if_needed(self, wep: SimplePoly) -> Optional[SimplePoly]:
+        """Drops the terms of wep beyond truncate_length.
+
+        Returns None if no terms are left, and wep itself if it needed no truncation.
+        Terms beyond truncate_length can't change the leading order terms kept by
+        truncate(), so merges and self traces drop them as early as possible.
+        """
+        if self.truncate_length is None:
+            return wep
+        min_w, _ = wep.minw()
+        if min_w > self.truncate_length:
+            return None
+        if max(wep._dict.keys()) <= self.truncate_length:
+            return wep
+        return wep.truncate(self.truncate_length)
+
+    def _truncated_product(self, wep1: SimplePoly, wep2: SimplePoly):
+        if self.truncate_length is None:
+            return wep1 * wep2
+        if wep1.minw()[0] + wep2.minw()[0] > self.truncate_length:
+            return None
+        return wep1.mul_truncated(wep2, self.truncate_length)
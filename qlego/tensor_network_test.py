@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 import sys
 from galois import GF, GF2
@@ -7,10 +8,15 @@ import scipy
 import sympy
 import os
 
+from qlego import shared_tensor, tensor_network
+from qlego.cluster import local_cluster
+from qlego.codes.rotated_surface_code import RotatedSurfaceCodeTN
 from qlego.codes.surface_code import SurfaceCodeTN
 from qlego.legos import Legos
 from qlego.linalg import gauss
 from qlego.parity_check import conjoin, sprint, sstr, tensor_product
+from qlego.progress import CancellationToken, ContractionCancelled
+from qlego.pte_storage import estimate_tensor_bytes
 from qlego.symplectic import weight
 from qlego.tensor_network import (
     PAULI_I,
@@ -20,6 +26,7 @@ from qlego.tensor_network import (
     SimplePoly,
     TensorNetwork,
     StabilizerCodeTensorEnumerator,
+    _PartiallyTracedEnumerator,
     sconcat,
     sslice,
 )
@@ -989,3 +996,633 @@ def test_disconnected_networks():
         progress_bar=False,
     )
     assert wep._dict == {0: 1, 2: 12, 4: 54, 6: 108, 8: 81}
+
+
+def test_memory_limit_spills_ptes_to_disk(tmp_path):
+    expected = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(cotengra=False)
+
+    tn = SurfaceCodeTN(d=3)
+    wep = tn.stabilizer_enumerator_polynomial(
+        cotengra=False, memory_limit=20_000, spill_dir=tmp_path
+    )
+    assert wep == expected
+
+    open_legs = [((0, 0), 4), ((2, 2), 4)]
+    expected_tensor = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False
+    )
+    tensor = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False, memory_limit=20_000, spill_dir=tmp_path
+    )
+    assert tensor == expected_tensor
+
+
+def test_merge_with_truncates_inside_the_join():
+    pte1 = _PartiallyTracedEnumerator(
+        nodes={0},
+        tracable_legs=[(0, 0), (0, 1)],
+        tensor={
+            (0, 0, 0, 0): SimplePoly({0: 1}),
+            (1, 0, 0, 0): SimplePoly({3: 1}),
+            (1, 1, 0, 0): SimplePoly({1: 1, 4: 1}),
+        },
+        truncate_length=2,
+    )
+    pte2 = _PartiallyTracedEnumerator(
+        nodes={1},
+        tracable_legs=[(1, 0)],
+        tensor={
+            (0, 0): SimplePoly({0: 1, 4: 2}),
+            (1, 0): SimplePoly({1: 1}),
+        },
+        truncate_length=2,
+    )
+
+    merged = pte1.merge_with(pte2, [(0, 0)], [(1, 0)])
+
+    # (1, 0, 0, 0) x (1, 0) has minimum weight 4 and is skipped altogether,
+    # the degree 4 terms never make it into the products
+    assert merged.tracable_legs == [(0, 1)]
+    assert merged.tensor == {
+        (0, 0): SimplePoly({0: 1}),
+        (1, 0): SimplePoly({2: 1}),
+    }
+
+    traced = pte1.self_trace([(0, 0)], [(0, 1)])
+    assert traced.tensor == {(): SimplePoly({0: 1, 1: 1})}
+
+
+def test_inner_product_of_fully_joined_ptes():
+    pte1 = _PartiallyTracedEnumerator(
+        nodes={0},
+        tracable_legs=[(0, 0), (0, 1)],
+        tensor={
+            (0, 0, 0, 0): SimplePoly({0: 1}),
+            (1, 0, 0, 0): SimplePoly({1: 2}),
+            (0, 1, 0, 1): SimplePoly({2: 1}),
+            (1, 1, 1, 0): SimplePoly({1: 1}),
+        },
+        truncate_length=None,
+    )
+    # legs in the opposite order: the key (X1, X0, Z1, Z0) of pte2 matches (X0, X1, Z0, Z1)
+    pte2 = _PartiallyTracedEnumerator(
+        nodes={1},
+        tracable_legs=[(1, 1), (1, 0)],
+        tensor={
+            (0, 0, 0, 0): SimplePoly({0: 1, 1: 1}),
+            (0, 1, 0, 0): SimplePoly({3: 1}),
+            (1, 0, 1, 0): SimplePoly({1: 1}),
+            (1, 1, 0, 1): SimplePoly({2: 5}),
+        },
+        truncate_length=None,
+    )
+    join_legs1 = [(0, 0), (0, 1)]
+    join_legs2 = [(1, 0), (1, 1)]
+    expected = SimplePoly({0: 1, 1: 1, 3: 6, 4: 2})
+
+    assert pte1.inner_product(pte2, join_legs1, join_legs2) == expected
+    assert pte1.inner_product(pte2, join_legs1, join_legs2, workers=2) == expected
+
+    merged = pte1.merge_with(pte2, join_legs1, join_legs2)
+    assert merged.tracable_legs == []
+    assert merged.tensor == {(): expected}
+
+
+def test_parallel_final_inner_product():
+    expected = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(cotengra=False)
+    wep = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+        cotengra=False, workers=2
+    )
+    assert wep == expected
+
+
+def test_resume_from_checkpoint(tmp_path, monkeypatch):
+    open_legs = [((0, 0), 4)]
+    expected = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False
+    )
+
+    merge_with = _PartiallyTracedEnumerator.merge_with
+    merges = []
+
+    def crashing_merge_with(self, *args, **kwargs):
+        merges.append(1)
+        if len(merges) == 6:
+            raise KeyboardInterrupt()
+        return merge_with(self, *args, **kwargs)
+
+    monkeypatch.setattr(_PartiallyTracedEnumerator, "merge_with", crashing_merge_with)
+    with pytest.raises(KeyboardInterrupt):
+        SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+            open_legs=open_legs,
+            cotengra=False,
+            checkpoint_dir=tmp_path,
+            checkpoint_every=1,
+        )
+    assert os.path.exists(tmp_path / "manifest.pkl")
+
+    monkeypatch.setattr(_PartiallyTracedEnumerator, "merge_with", merge_with)
+    n_node_enumerations = []
+    node_wep = StabilizerCodeTensorEnumerator.stabilizer_enumerator_polynomial
+    monkeypatch.setattr(
+        StabilizerCodeTensorEnumerator,
+        "stabilizer_enumerator_polynomial",
+        lambda *args, **kwargs: n_node_enumerations.append(1)
+        or node_wep(*args, **kwargs),
+    )
+    tensor = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False, resume_from=tmp_path
+    )
+    assert tensor == expected
+    # node tensors are enumerated lazily, only the ones not used before the
+    # checkpoint are left
+    assert len(n_node_enumerations) < len(SurfaceCodeTN(d=3).nodes)
+
+    with pytest.raises(ValueError):
+        SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+            cotengra=False, resume_from=tmp_path
+        )
+
+
+def test_compressed_ptes():
+    open_legs = [((0, 0), 4), ((2, 2), 4)]
+    for truncate_length in [None, 3]:
+        expected = SurfaceCodeTN(
+            d=3, truncate_length=truncate_length
+        ).stabilizer_enumerator_polynomial(cotengra=False)
+        wep = SurfaceCodeTN(
+            d=3, truncate_length=truncate_length
+        ).stabilizer_enumerator_polynomial(cotengra=False, compress=True)
+        assert wep == expected
+
+    expected_tensor = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False
+    )
+    tensor = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False, compress=True
+    )
+    assert tensor == expected_tensor
+
+
+def test_node_ptes_are_enumerated_lazily_and_released():
+    tn = SurfaceCodeTN(d=3)
+    free_legs, _, _ = tn._collect_legs()
+    all_node_bytes = sum(
+        estimate_tensor_bytes(tn._node_pte(node_idx, legs).tensor)
+        for node_idx, legs in tn._open_legs_per_node(free_legs, []).items()
+    )
+
+    tn.stabilizer_enumerator_polynomial(cotengra=False)
+    stats = tn.memory_stats
+    # after the first step only the merged pair of nodes is alive
+    assert stats.step_bytes[0] < all_node_bytes / 4
+    assert stats.peak_bytes >= max(stats.step_bytes)
+    assert stats.peak_step is not None
+
+
+def test_approximate_contraction_with_top_keys():
+    expected = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(cotengra=False)
+
+    tn = SurfaceCodeTN(d=3)
+    wep = tn.stabilizer_enumerator_polynomial(cotengra=False, max_keys=8)
+    report = tn.approximation
+    assert sum(report.discarded_keys) > 0
+    assert not report.is_exact
+    assert wep[0] == expected[0]
+    for w in range(14):
+        assert 0 <= expected[w] - wep[w] <= report.error_bound
+
+    tn = SurfaceCodeTN(d=3)
+    wep = tn.stabilizer_enumerator_polynomial(
+        cotengra=False, max_keys=10**6, key_priority="mass"
+    )
+    assert wep == expected
+    assert tn.approximation.is_exact
+    assert tn.approximation.error_bound == 0
+
+    with pytest.raises(ValueError):
+        SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+            max_keys=8, key_priority="largest"
+        )
+
+
+def test_sliced_contraction():
+    expected = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(cotengra=False)
+    tn = SurfaceCodeTN(d=3)
+    slice_legs = [tn.traces[0][2][0], tn.traces[1][3][0]]
+    assert (
+        tn.stabilizer_enumerator_polynomial(cotengra=False, slice_legs=slice_legs)
+        == expected
+    )
+
+    tn = SurfaceCodeTN(d=3)
+    assert (
+        tn.stabilizer_enumerator_polynomial(
+            cotengra=False, slice_legs=slice_legs, workers=2
+        )
+        == expected
+    )
+
+    open_legs = [((0, 0), 4), ((2, 2), 4)]
+    expected = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False
+    )
+    tn = SurfaceCodeTN(d=3)
+    assert (
+        tn.stabilizer_enumerator_polynomial(
+            open_legs=open_legs, cotengra=False, slice_legs=slice_legs
+        )
+        == expected
+    )
+
+    # the workers hand their open legs tensors back in shared memory
+    tn = SurfaceCodeTN(d=3)
+    assert (
+        tn.stabilizer_enumerator_polynomial(
+            open_legs=open_legs, cotengra=False, slice_legs=slice_legs, workers=2
+        )
+        == expected
+    )
+
+    tn = SurfaceCodeTN(d=3)
+    assert len(tn.cotengra_slice_legs(max_legs=2)) > 0
+
+    with pytest.raises(ValueError):
+        SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+            slice_legs=[((0, 0), 4)]
+        )
+
+
+def test_sliced_contraction_keeps_the_leading_order_terms():
+    # the slices have different leading orders, only the lowest is leading in the sum
+    tn = RotatedSurfaceCodeTN(d=5, truncate_length=4)
+    slice_legs = [tn.traces[3][2][0], tn.traces[10][2][0]]
+    expected = RotatedSurfaceCodeTN(d=5, truncate_length=4)
+    assert tn.stabilizer_enumerator_polynomial(
+        cotengra=False, slice_legs=slice_legs
+    ) == expected.stabilizer_enumerator_polynomial(cotengra=False)
+
+    open_legs = [((4, 4), 4)]
+    tn = RotatedSurfaceCodeTN(d=5, truncate_length=4)
+    assert tn.stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False, slice_legs=slice_legs
+    ) == expected.stabilizer_enumerator_polynomial(open_legs=open_legs, cotengra=False)
+
+    # a single key is left, with or without slices
+    open_legs = [((2, 2), 4)]
+    expected = {(0, 0): SimplePoly({0: 1})}
+    tn = SurfaceCodeTN(d=3, truncate_length=2)
+    assert tn.stabilizer_enumerator_polynomial(open_legs=open_legs) == expected
+    tn = SurfaceCodeTN(d=3, truncate_length=2)
+    assert (
+        tn.stabilizer_enumerator_polynomial(
+            open_legs=open_legs, slice_legs=[tn.traces[0][2][0]], workers=2
+        )
+        == expected
+    )
+
+
+def test_cancelled_sliced_contraction_removes_the_shared_tensors(
+    tmp_path, monkeypatch
+):
+    # the forked workers write their results here too
+    monkeypatch.setattr(shared_tensor, "_default_dir", lambda: str(tmp_path))
+    tn = SurfaceCodeTN(d=3)
+    cancel = CancellationToken()
+    with pytest.raises(ContractionCancelled):
+        tn.stabilizer_enumerator_polynomial(
+            open_legs=[((0, 0), 4), ((2, 2), 4)],
+            cotengra=False,
+            slice_legs=[tn.traces[0][2][0], tn.traces[1][3][0]],
+            workers=2,
+            progress_callback=lambda p: cancel.cancel(),
+            cancel=cancel,
+        )
+    assert os.listdir(tmp_path) == []
+
+
+def test_concurrent_queries_on_a_shared_network():
+    open_legs = [((0, 0), 4), ((2, 2), 4)]
+    expected_scalar = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial()
+    expected_tensor = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+        open_legs=open_legs
+    )
+
+    tn = SurfaceCodeTN(d=3)
+    legs_left_to_join = deepcopy(tn.legs_left_to_join)
+    # sequential queries with different open legs don't see each other's results
+    assert tn.stabilizer_enumerator_polynomial(open_legs=open_legs) == expected_tensor
+    assert tn.stabilizer_enumerator_polynomial() == expected_scalar
+    assert tn.legs_left_to_join == legs_left_to_join
+
+    tn = SurfaceCodeTN(d=3)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(
+            pool.map(
+                lambda legs: tn.stabilizer_enumerator_polynomial(
+                    open_legs=legs, cotengra=False
+                ),
+                [[], open_legs, [], open_legs],
+            )
+        )
+    assert results == [expected_scalar, expected_tensor] * 2
+    assert tn.legs_left_to_join == legs_left_to_join
+
+
+def test_progress_callback_and_cancellation():
+    expected = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(cotengra=False)
+
+    tn = SurfaceCodeTN(d=3)
+    progress = []
+    assert (
+        tn.stabilizer_enumerator_polynomial(
+            cotengra=False, progress_callback=progress.append
+        )
+        == expected
+    )
+    assert [p.step for p in progress] == list(range(1, progress[0].n_steps + 1))
+    assert progress[-1].eta == 0
+    assert all(p.pte_keys > 0 for p in progress)
+
+    tn = SurfaceCodeTN(d=3)
+    cancel = CancellationToken()
+
+    def cancel_after_two_steps(p):
+        if p.step == 2:
+            cancel.cancel()
+
+    with pytest.raises(ContractionCancelled):
+        tn.stabilizer_enumerator_polynomial(
+            cotengra=False, progress_callback=cancel_after_two_steps, cancel=cancel
+        )
+    # the network is still usable
+    assert tn.stabilizer_enumerator_polynomial(cotengra=False) == expected
+
+    with pytest.raises(ContractionCancelled):
+        SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+            cotengra=False,
+            slice_legs=[tn.traces[0][2][0]],
+            progress_callback=cancel_after_two_steps,
+            cancel=cancel,
+        )
+
+    node = StabilizerCodeTensorEnumerator(Legos.enconding_tensor_512, idx=0)
+    with pytest.raises(ContractionCancelled):
+        node.stabilizer_enumerator_polynomial(open_legs=[0, 1], cancel=cancel)
+
+
+def _three_component_network():
+    tn = TensorNetwork(
+        [
+            StabilizerCodeTensorEnumerator(Legos.enconding_tensor_512, idx=i)
+            for i in range(6)
+        ]
+    )
+    tn.self_trace(0, 1, [0], [0])
+    tn.self_trace(1, 2, [1], [1])
+    tn.self_trace(0, 2, [2], [2])
+    tn.self_trace(3, 4, [0], [0])
+    # node 5 has no traces
+    return tn
+
+
+def test_parallel_subtrees():
+    # the tasks truncate their own PTEs, and their progress and memory is reported
+    open_legs = [((4, 4), 4)]
+    tn = RotatedSurfaceCodeTN(d=5, truncate_length=4)
+    progress = []
+    assert tn.stabilizer_enumerator_polynomial(
+        open_legs=open_legs,
+        cotengra=False,
+        workers=2,
+        parallel_subtrees=True,
+        progress_callback=progress.append,
+    ) == RotatedSurfaceCodeTN(d=5, truncate_length=4).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False
+    )
+    assert len(progress) > 1
+    assert tn.memory_stats.peak_bytes > 0
+
+    # every task reports the keys it discarded
+    serial = RotatedSurfaceCodeTN(d=5)
+    expected = serial.stabilizer_enumerator_polynomial(cotengra=False, max_keys=8)
+    tn = RotatedSurfaceCodeTN(d=5)
+    assert (
+        tn.stabilizer_enumerator_polynomial(
+            cotengra=False, max_keys=8, workers=2, parallel_subtrees=True
+        )
+        == expected
+    )
+    assert sorted(tn.approximation.discarded_keys) == sorted(
+        serial.approximation.discarded_keys
+    )
+
+
+def test_parallel_subtrees_of_disjoint_components():
+    open_legs = [(0, 4), (3, 4), (5, 0)]
+    for legs in ([], open_legs):
+        assert _three_component_network().stabilizer_enumerator_polynomial(
+            open_legs=legs, cotengra=False, workers=2, parallel_subtrees=True
+        ) == _three_component_network().stabilizer_enumerator_polynomial(
+            open_legs=legs, cotengra=False
+        )
+
+
+def test_partitioned_contraction():
+    # the parts keep their cut legs open next to the open legs of the query, the
+    # join across the cut has to leave the same keys and leading order terms
+    open_legs = [((0, 0), 4), ((4, 4), 4)]
+    for truncate_length in (None, 4):
+        expected = RotatedSurfaceCodeTN(
+            d=5, truncate_length=truncate_length
+        ).stabilizer_enumerator_polynomial(open_legs=open_legs, cotengra=False)
+        for workers in (1, 2):
+            tn = RotatedSurfaceCodeTN(d=5, truncate_length=truncate_length)
+            assert (
+                tn.stabilizer_enumerator_polynomial(
+                    open_legs=open_legs, cotengra=False, partitions=3, workers=workers
+                )
+                == expected
+            )
+
+
+def test_partitioned_contraction_runs_parts_in_parallel_only_with_workers():
+    tn = RotatedSurfaceCodeTN(d=5)
+    assert tn.stabilizer_enumerator_polynomial(
+        cotengra=False, partitions=3, hybrid=True
+    ) == RotatedSurfaceCodeTN(d=5).stabilizer_enumerator_polynomial(cotengra=False)
+    assert "brute_force" in {d.strategy for d in tn.hybrid_decisions}
+
+    with pytest.raises(ValueError, match="partitions"):
+        RotatedSurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+            partitions=2, workers=2, hybrid=True
+        )
+
+
+def _worker_queries():
+    return len(tensor_network._subtree_workers)
+
+
+def test_concurrent_queries_on_a_local_cluster():
+    def closed_query(**kwargs):
+        return RotatedSurfaceCodeTN(d=5).stabilizer_enumerator_polynomial(
+            cotengra=False, **kwargs
+        )
+
+    def open_query(**kwargs):
+        return SurfaceCodeTN(d=3, truncate_length=3).stabilizer_enumerator_polynomial(
+            open_legs=[((0, 0), 4), ((2, 2), 4)], cotengra=False, **kwargs
+        )
+
+    queries = [closed_query, open_query]
+    expected = [query() for query in queries]
+    with local_cluster(2) as cluster:
+        # both queries share the workers, each with its own network
+        with ThreadPoolExecutor(2) as threads:
+            results = list(threads.map(lambda query: query(cluster=cluster), queries))
+        assert results == expected
+        # the workers drop the state of finished queries
+        assert cluster.broadcast(_worker_queries) == [0, 0]
+
+
+def test_hybrid_contraction():
+    tn = RotatedSurfaceCodeTN(d=5)
+    assert tn.stabilizer_enumerator_polynomial(
+        cotengra=False, hybrid=True
+    ) == RotatedSurfaceCodeTN(d=5).stabilizer_enumerator_polynomial(cotengra=False)
+    assert {d.strategy for d in tn.hybrid_decisions} == {"contract", "brute_force"}
+
+    # brute forced subtrees keep only the leading order terms of their keys
+    open_legs = [((4, 4), 4)]
+    tn = RotatedSurfaceCodeTN(d=5, truncate_length=4)
+    assert tn.stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False, hybrid=True
+    ) == RotatedSurfaceCodeTN(d=5, truncate_length=4).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False
+    )
+    assert "brute_force" in {d.strategy for d in tn.hybrid_decisions}
+
+
+def test_hybrid_contraction_keeps_sliced_traces_contracted():
+    # a brute forced subtree only fixes the Paulis on its boundary legs, one around a
+    # sliced trace would sum all 4 slices in each slice; scalars hide this behind
+    # normalize(), tensors don't
+    open_legs = [((4, 4), 4)]
+    expected = RotatedSurfaceCodeTN(d=5).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False
+    )
+    tn = RotatedSurfaceCodeTN(d=5)
+    assert (
+        tn.stabilizer_enumerator_polynomial(
+            open_legs=open_legs, cotengra=False, hybrid=True, slice_legs=[((0, 0), 2)]
+        )
+        == expected
+    )
+    assert all(
+        d.strategy == "contract" for d in tn.hybrid_decisions if d.n_nodes > 1
+    )
+
+
+def test_incremental_editing(monkeypatch):
+    steps = []
+    merge_with = _PartiallyTracedEnumerator.merge_with
+
+    def counting_merge_with(self, *args, **kwargs):
+        steps.append(self.nodes)
+        return merge_with(self, *args, **kwargs)
+
+    monkeypatch.setattr(_PartiallyTracedEnumerator, "merge_with", counting_merge_with)
+
+    tn = RotatedSurfaceCodeTN(d=5)
+    expected = tn.stabilizer_enumerator_polynomial(cotengra=False, incremental=True)
+    n_steps = len(steps)
+
+    last_trace = tn.traces[-1]
+    reference = RotatedSurfaceCodeTN(d=5)
+    reference.remove_trace(*last_trace)
+    expected_removed = reference.stabilizer_enumerator_polynomial(cotengra=False)
+    tn.remove_trace(*last_trace)
+    steps.clear()
+    assert (
+        tn.stabilizer_enumerator_polynomial(cotengra=False, incremental=True)
+        == expected_removed
+    )
+    assert len(steps) < n_steps / 4
+
+    tn.self_trace(*last_trace)
+    steps.clear()
+    assert tn.stabilizer_enumerator_polynomial(cotengra=False, incremental=True) == (
+        expected
+    )
+    assert len(steps) < n_steps / 4
+
+    # swapping X and Z on a corner node
+    node = tn.nodes[(0, 0)]
+    swapped = StabilizerCodeTensorEnumerator(
+        sconcat(node.h[:, node.n :], node.h[:, : node.n]),
+        idx=node.idx,
+        legs=node.legs,
+    )
+    tn.replace_node(swapped)
+    reference = RotatedSurfaceCodeTN(d=5)
+    reference.replace_node(swapped)
+    assert tn.stabilizer_enumerator_polynomial(
+        cotengra=False, incremental=True
+    ) == reference.stabilizer_enumerator_polynomial(cotengra=False)
+
+    with pytest.raises(ValueError):
+        tn.remove_trace((0, 0), (0, 1), [((0, 0), 3)], [((0, 1), 3)])
+    with pytest.raises(ValueError):
+        tn.replace_node(StabilizerCodeTensorEnumerator(GF2([[1, 0]]), idx=(0, 0)))
+    with pytest.raises(ValueError):
+        RotatedSurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+            cotengra=False, incremental=True, max_keys=4
+        )
+
+
+def test_sweep_contraction_is_bounded_by_the_frontier():
+    tn = RotatedSurfaceCodeTN(d=5)
+    assert tn.stabilizer_enumerator_polynomial(
+        sweep=True
+    ) == RotatedSurfaceCodeTN(d=5).stabilizer_enumerator_polynomial(cotengra=False)
+    assert tn.estimate_cost(sweep=True).max_legs <= tn.sweep_plan().max_frontier
+
+    with pytest.raises(ValueError, match="no lattice"):
+        TensorNetwork(RotatedSurfaceCodeTN(d=3).nodes).stabilizer_enumerator_polynomial(
+            sweep=True
+        )
+
+
+def test_sweep_contraction_with_truncated_open_legs():
+    # the open legs sit on both ends of the sweep
+    open_legs = [((0, 0), 4), ((4, 4), 4)]
+    tn = RotatedSurfaceCodeTN(d=5, truncate_length=4)
+    assert tn.stabilizer_enumerator_polynomial(
+        open_legs=open_legs, sweep=True
+    ) == RotatedSurfaceCodeTN(d=5, truncate_length=4).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False
+    )
+
+
+def test_sliced_sweep_contraction():
+    open_legs = [((0, 0), 4), ((2, 2), 4)]
+    expected = SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+        open_legs=open_legs, cotengra=False
+    )
+    tn = SurfaceCodeTN(d=3)
+    # a leg on the frontier in the middle of the sweep
+    traces = tn.sweep_plan().traces
+    slice_legs = [traces[len(traces) // 2][2][0]]
+    assert (
+        tn.stabilizer_enumerator_polynomial(
+            open_legs=open_legs, sweep=True, slice_legs=slice_legs
+        )
+        == expected
+    )
+    # the subtrees of a sweep are a chain
+    assert (
+        SurfaceCodeTN(d=3).stabilizer_enumerator_polynomial(
+            open_legs=open_legs, sweep=True, parallel_subtrees=True, workers=2
+        )
+        == expected
+    )
@@ -0,0 +1,96 @@
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Set
+
+import attrs
+from networkx.algorithms.approximation.treewidth import (
+    MinDegreeHeuristic,
+    min_fill_in_heuristic,
+)
+
+from qlego.contraction_schedule import Trace
+
+
+# networkx's elimination heuristics, by name, as functions picking the next vertex of
+# a graph given as a dict of sets
+HEURISTICS = {
+    "min_degree": lambda graph: MinDegreeHeuristic(graph).best_node,
+    "min_fill_in": lambda graph: min_fill_in_heuristic,
+}
+
+
+class TreewidthExceeded(ValueError):
+    """Raised when a network has no tree decomposition within the width limit."""
+
+
+@attrs.define
+class TreeDecompositionPlan:
+    # the width of the decomposition of the line graph, which bounds the legs traced
+    # between the part of the network an intermediate PTE covers and the rest
+    width: int
+    traces: List[Trace]
+
+
+def _line_graph(traces: List[Trace]) -> Dict[int, Set[int]]:
+    """The traces that share a node with each trace, by position in traces."""
+    traces_of_node = defaultdict(list)
+    for i, (node_idx1, node_idx2, _, _) in enumerate(traces):
+        traces_of_node[node_idx1].append(i)
+        if node_idx2 != node_idx1:
+            traces_of_node[node_idx2].append(i)
+    graph = {i: set() for i in range(len(traces))}
+    for shared in traces_of_node.values():
+        for i in shared:
+            graph[i].update(shared)
+    for i, neighbors in graph.items():
+        neighbors.discard(i)
+    return graph
+
+
+def tree_decomposition_schedule(
+    traces: List[Trace],
+    max_width: Optional[int] = None,
+    heuristic: str = "min_degree",
+) -> TreeDecompositionPlan:
+    """Orders the traces by a tree decomposition of the line graph of the network.
+
+    The vertices are the traces, adjacent when they share a node. networkx's min_degree
+    (or min_fill_in) heuristic eliminates them one by one, and tracing them in that
+    order contracts the nodes of each trace into one PTE whose traced legs are among
+    its neighbors at elimination, so no PTE has more than width of them. The bags of
+    the decomposition are not built, they are implicit in the elimination order.
+
+    Raises TreewidthExceeded as soon as an elimination goes over max_width, before the
+    rest of the graph is filled in.
+    """
+    if heuristic not in HEURISTICS:
+        raise ValueError(
+            f"Unknown heuristic {heuristic}, it should be one of {list(HEURISTICS)}"
+        )
+    graph = _line_graph(traces)
+    best_vertex = HEURISTICS[heuristic](graph)
+
+    def check(width):
+        if max_width is not None and width > max_width:
+            raise TreewidthExceeded(
+                f"The tree decomposition has a width of at least {width}, over the "
+                f"limit of {max_width}."
+            )
+
+    width = 0
+    order = []
+    vertex = best_vertex(graph)
+    while vertex is not None:
+        neighbors = graph.pop(vertex)
+        width = max(width, len(neighbors))
+        check(width)
+        for u in neighbors:
+            graph[u].discard(vertex)
+            graph[u].update(neighbors)
+            graph[u].discard(u)
+        order.append(vertex)
+        vertex = best_vertex(graph)
+    # the heuristics stop at a clique, its vertices share a bag
+    width = max(width, len(graph) - 1)
+    check(width)
+    order += list(graph)
+    return TreeDecompositionPlan(width, [traces[i] for i in order])
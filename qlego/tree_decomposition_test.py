@@ -0,0 +1,77 @@
+from galois import GF2
+import pytest
+
+from qlego.codes.css_tanner_code import CssTannerCodeTN
+from qlego.codes.stabilizer_measurement_state_prep import (
+    StabilizerMeasurementStatePrepTN,
+)
+from qlego.contraction_schedule import max_traced_legs
+from qlego.tree_decomposition import TreewidthExceeded, tree_decomposition_schedule
+
+HZ = GF2(
+    [
+        [1, 1, 0, 1, 1, 0, 1, 1, 0],
+        [0, 1, 1, 0, 0, 0, 0, 0, 0],
+        [0, 0, 0, 0, 1, 1, 0, 1, 1],
+    ]
+)
+HX = GF2(
+    [
+        [1, 0, 0, 1, 0, 0, 0, 0, 0],
+        [0, 1, 1, 0, 1, 1, 0, 0, 0],
+        [0, 0, 0, 1, 0, 0, 1, 0, 0],
+        [0, 0, 0, 0, 1, 0, 0, 1, 0],
+        [0, 0, 0, 0, 0, 1, 0, 0, 1],
+    ]
+)
+
+
+def test_width_bounds_the_traced_legs_of_every_pte():
+    tn = CssTannerCodeTN(HX, HZ)
+    for heuristic in ("min_degree", "min_fill_in"):
+        plan = tree_decomposition_schedule(tn.traces, heuristic=heuristic)
+        assert sorted(map(repr, plan.traces)) == sorted(map(repr, tn.traces))
+        assert max_traced_legs(plan.traces) <= plan.width
+
+    expected = CssTannerCodeTN(HX, HZ).stabilizer_enumerator_polynomial(cotengra=False)
+    assert tn.stabilizer_enumerator_polynomial(tree_decomposition=True) == expected
+
+
+def test_fails_fast_over_the_width_limit():
+    tn = CssTannerCodeTN(HX, HZ)
+    width = tn.tree_decomposition_plan().width
+    assert tn.tree_decomposition_plan(max_width=width).width == width
+    with pytest.raises(TreewidthExceeded):
+        tn.tree_decomposition_plan(max_width=width - 1)
+    with pytest.raises(TreewidthExceeded):
+        tn.stabilizer_enumerator_polynomial(
+            tree_decomposition=True, max_treewidth=width - 1
+        )
+    with pytest.raises(ValueError):
+        tn.tree_decomposition_plan(heuristic="min_width")
+
+
+def test_conflicting_planner_options_are_rejected():
+    tn = CssTannerCodeTN(HX, HZ)
+    with pytest.raises(ValueError, match="sweep"):
+        tn.stabilizer_enumerator_polynomial(sweep=True, tree_decomposition=True)
+    with pytest.raises(ValueError, match="sweep"):
+        tn.estimate_cost(sweep=True, tree_decomposition=True)
+    with pytest.raises(ValueError, match="max_treewidth"):
+        tn.stabilizer_enumerator_polynomial(max_treewidth=4)
+    with pytest.raises(ValueError, match="max_treewidth"):
+        tn.estimate_cost(max_treewidth=4)
+
+
+def test_state_prep_network():
+    h = GF2(
+        [
+            [1, 0, 0, 1, 0, 0, 1, 1, 0, 0],
+            [0, 1, 0, 0, 1, 0, 0, 1, 1, 0],
+            [1, 0, 1, 0, 0, 0, 0, 0, 1, 1],
+            [0, 1, 0, 1, 0, 1, 0, 0, 0, 1],
+        ]
+    )
+    tn = StabilizerMeasurementStatePrepTN(h)
+    wep = tn.stabilizer_enumerator_polynomial(tree_decomposition=True)
+    assert wep._dict == {0: 1, 4: 15}